@@ -11,13 +11,42 @@ def read_env(name, defaultValue):
     return defaultValue
 
 
-WEB_SERVER = read_env('LIMBO_WEB_SERVER', 'wsgiref')
+WEB_SERVER = read_env('LIMBO_WEB_SERVER', 'threaded')
+
+# Settings of built-in 'threaded' and 'asyncio' web servers:
+# number of worker threads serving connections (request handlers of
+# 'asyncio' server),
+# number of accepted connections waiting for free worker ('asyncio' server
+# uses it as listen backlog),
+# idle time of persistent connection (0 disables persistent connections)
+SERVER_THREADS = int(read_env('LIMBO_SERVER_THREADS', '16'))
+SERVER_QUEUE_SIZE = int(read_env('LIMBO_SERVER_QUEUE_SIZE', '64'))
+SERVER_KEEPALIVE_SECONDS = int(read_env('LIMBO_SERVER_KEEPALIVE_SECONDS',
+                                        '5'))
+
+# Number of worker processes serving requests. Values greater than 1
+# enable pre-fork mode ('threaded' and 'asyncio' web servers only)
+WORKER_PROCESSES = int(read_env('LIMBO_WORKER_PROCESSES', '1'))
+
+# How often web page gets changes of stored files list from /cgi/events/.
+# Event streams of 'asyncio' server stay open and changes are checked
+# with this period. Other servers answer at once and page reconnects
+# after this delay.
+EVENTS_POLL_SECONDS = float(read_env('LIMBO_EVENTS_POLL_SECONDS', '2'))
+
+# Web page is static shell, file list is rendered by browser with only
+# visible rows in DOM (it is always available at /list/)
+CLIENT_RENDERED_PAGE = bool(int(read_env('LIMBO_CLIENT_RENDERED_PAGE', '0')))
 
 LISTEN_HOST = read_env('LIMBO_LISTEN_HOST', 'localhost')
 LISTEN_PORT = int(read_env('LIMBO_LISTEN_PORT', '8080'))
 
 STORAGE_DIRECTORY = read_env('LIMBO_STORAGE_DIRECTORY', './storage')
 
+# Number of hash prefix subdirectory levels to store files in.
+# 0 means flat layout. Existing files are moved to new layout on start.
+STORAGE_SHARD_LEVELS = int(read_env('LIMBO_STORAGE_SHARD_LEVELS', '0'))
+
 # STORAGE_WEB_URL_BASE allows to specify alternative web url to
 # read files stored in STORAGE_DIRECTORY through HTTP/HTTPS.
 # It is expected those URL is served by standalone web server.
@@ -25,8 +54,70 @@ STORAGE_DIRECTORY = read_env('LIMBO_STORAGE_DIRECTORY', './storage')
 # NOTE: value requires ending '/' character
 STORAGE_WEB_URL_BASE = read_env('LIMBO_STORAGE_WEB_URL_BASE', '')
 
+# Content hash computed while file is uploaded. It is returned by
+# file enumeration API and used as ETag for downloads.
+# Supported values: sha256, sha512, sha1, md5, crc32, adler32.
+# Empty string disables hashing (default: every upload would pay for it).
+HASH_ALGORITHM = read_env('LIMBO_HASH_ALGORITHM', '')
+
+# Store uploads with the same content as hardlinks to single copy
+DEDUPLICATE_STORAGE = bool(int(read_env('LIMBO_DEDUPLICATE_STORAGE', '0')))
+
+# Bounds of upload chunk size in bytes. Chunk size grows while data
+# arrives faster than it is processed and shrinks on short reads.
+UPLOAD_MIN_CHUNK_SIZE = int(read_env('LIMBO_UPLOAD_MIN_CHUNK_SIZE',
+                                     str(64 * 1024)))
+UPLOAD_MAX_CHUNK_SIZE = int(read_env('LIMBO_UPLOAD_MAX_CHUNK_SIZE',
+                                     str(1024 * 1024)))
+
+# Number of received upload chunks buffered for dedicated
+# disk writer thread. So network reading and disk writing are done
+# concurrently. 0 means data is written by request thread.
+UPLOAD_PIPELINE_CHUNKS = int(read_env('LIMBO_UPLOAD_PIPELINE_CHUNKS', '0'))
+
+# Reserve disk space for uploaded file when its size is known
+# (posix_fallocate), so file is stored in fewer extents
+PREALLOCATE_FILES = bool(int(read_env('LIMBO_PREALLOCATE_FILES', '1')))
+
+# Buffer size of files being uploaded. -1 means default buffering.
+WRITE_BUFFER_SIZE = int(read_env('LIMBO_WRITE_BUFFER_SIZE', '-1'))
+
+# What is flushed to disk before upload is completed:
+# none, file (fsync file data), dir (fsync file data and directory)
+DURABILITY = read_env('LIMBO_DURABILITY', 'none')
+
 MAX_STORAGE_SECONDS = int(read_env('LIMBO_MAX_STORAGE_SECONDS', str(24*3600)))
 
+# Quota of stored files size in bytes. 0 means no quota.
+MAX_STORAGE_BYTES = int(read_env('LIMBO_MAX_STORAGE_BYTES', '0'))
+
+# Free disk space in bytes to be kept in storage file system.
+# 0 means no limit.
+MIN_FREE_DISK_BYTES = int(read_env('LIMBO_MIN_FREE_DISK_BYTES', '0'))
+
+# Watch storage directory with inotify (Linux only) to notice files added
+# or removed by other programs
+WATCH_STORAGE = bool(int(read_env('LIMBO_WATCH_STORAGE', '0')))
+
+# Log records of lower level are skipped: debug, info, warning, error
+LOG_LEVEL = read_env('LIMBO_LOG_LEVEL', 'info')
+
+# Log records are written as text lines or JSON objects: text, json
+LOG_FORMAT = read_env('LIMBO_LOG_FORMAT', 'text')
+
+# Limit of request log records per second (the rest are counted only).
+# 0 means no limit.
+LOG_REQUESTS_PER_SECOND = float(read_env('LIMBO_LOG_REQUESTS_PER_SECOND',
+                                         '50'))
+
+# Profiling of requests: fraction of requests profiled at random,
+# token of X-Limbo-Profile request header to profile the request and to
+# read results from /cgi/profile/ (empty disables both), comma separated
+# modes: cpu (cProfile), memory (tracemalloc)
+PROFILE_SAMPLE_RATE = float(read_env('LIMBO_PROFILE_SAMPLE_RATE', '0'))
+PROFILE_TOKEN = read_env('LIMBO_PROFILE_TOKEN', '')
+PROFILE_MODES = read_env('LIMBO_PROFILE_MODES', 'cpu')
+
 IS_DEBUG = bool(int(read_env('LIMBO_IS_DEBUG', '0')))
 
 DISABLE_STORAGE = bool(int(read_env('LIMBO_DISABLE_STORAGE', '0')))
@@ -0,0 +1,447 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+from lib_common import log
+from lib_http import FileRange, http_date, IncompleteBodyError
+from lib_log import INFO, logger
+from lib_server import MAX_DRAIN_BYTES
+
+import asyncio
+import bottle
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.client import parse_headers as http_parse_headers
+from io import BytesIO
+import re
+import sys
+from time import monotonic as time_monotonic, time as time_time
+from traceback import format_exc as traceback_format_exc
+from urllib.parse import parse_qs as urllib_parse_qs, \
+                         unquote as urllib_unquote
+
+
+# Size of connection receive buffer. Socket reading is paused when twice
+# as much is buffered. Request headers must fit in it.
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+# Time to receive request headers of new connection
+HEADERS_TIMEOUT_SECONDS = 30
+
+# Body of requests passed to WSGI application is received to memory
+MAX_BUFFERED_BODY_SIZE = 16 * 1024 * 1024
+
+FILE_BLOCK_SIZE = 1024 * 1024
+
+SERVER_SOFTWARE = 'Limbo asyncio'
+
+
+def status_line(status):
+    if isinstance(status, int):
+        status = str(status) + ' ' + HTTPStatus(status).phrase
+    return status
+
+
+# wsgi.file_wrapper. File ranges are transmitted by event loop
+# with sendfile(), other file-like objects are read in thread pool.
+class AsyncFileWrapper:
+    def __init__(self, filelike, block_size=FILE_BLOCK_SIZE):
+        self.filelike = filelike
+        self._block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self._block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+# Request passed to native route handlers. Body is received by handler.
+# Client waiting for "100 Continue" gets it when handler starts to read
+# body, so request rejected before that (e.g. storage is full) is not
+# sent at all.
+class AsyncRequest:
+    def __init__(self, server, reader, writer, method, path, query_string,
+                 version, headers, content_length):
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.query = urllib_parse_qs(query_string)
+        self.version = version
+        self.headers = headers
+        self.content_length = content_length
+        self._remaining = content_length
+        # connection is closed by client before the end of body
+        self._incomplete = False
+        self._continue_pending = content_length > 0 and \
+            headers.get('Expect', '').lower() == '100-continue'
+        self.start_time = time_monotonic()
+
+    # Size of body which is not received yet
+    @property
+    def remaining(self):
+        return self._remaining
+
+    # Returns first value of query parameter
+    def get_query(self, name, default=''):
+        return self.query.get(name, [default])[0]
+
+    # Receives next body chunk of at least min_size bytes (except the last
+    # one) and at most max_size bytes. Returns b'' at the end of body.
+    # Raises IncompleteBodyError if client closes connection before it.
+    async def read_chunk(self, min_size, max_size):
+        if self._continue_pending:
+            self._continue_pending = False
+            self._writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        parts = []
+        size = 0
+        while self._remaining > 0 and size < min_size:
+            data = await self._reader.read(
+                min(max_size - size, self._remaining))
+            if not data:
+                self._incomplete = True
+                raise IncompleteBodyError('Request body is incomplete',
+                                          self._remaining)
+            self._remaining -= len(data)
+            size += len(data)
+            parts.append(data)
+        return b''.join(parts)
+
+    # Receives and drops the rest of body. Returns False if it is longer
+    # than limit.
+    async def drain(self, limit):
+        if self._continue_pending:
+            return False  # client doesn't send body
+        while not self._incomplete and 0 < self._remaining <= limit:
+            if not await self.read_chunk(1, FILE_BLOCK_SIZE):
+                break
+        return self._remaining == 0
+
+    # Runs blocking function in thread pool. Returns future.
+    def run(self, function, *args):
+        return self._server.run_in_executor(function, *args)
+
+
+# HTTP/1.1 server running on asyncio event loop. Thousands of idle or slow
+# connections cost no threads. Requests matching routes are handled by
+# native coroutines which receive request body themselves. Other requests
+# are passed to WSGI application called in thread pool. Their body is
+# received to memory before the call.
+# routes is list of [method, path regular expression, handler].
+# handler(request, *path_groups) is coroutine returning
+# [status, headers, body bytes] or [status, headers, stream] where
+# stream(writer) is coroutine writing body of unknown length.
+# reuse_port allows several worker processes to listen on the same port.
+class AsyncWSGIServer:
+    def __init__(self, app, host, port, threads=16, backlog=1024,
+                 keepalive_timeout=5, routes=(), reuse_port=False):
+        self._app = app
+        self._host = host
+        self._port = port
+        self._threads = threads
+        self._backlog = backlog
+        self._keepalive_timeout = keepalive_timeout
+        self._reuse_port = reuse_port
+        self._routes = [[method, re.compile(pattern), handler]
+                        for method, pattern, handler in routes]
+        self._loop = None
+        self._executor = None
+
+    def serve_forever(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._executor = ThreadPoolExecutor(self._threads)
+        server = self._loop.run_until_complete(asyncio.start_server(
+            self._handle_connection, self._host, self._port,
+            limit=STREAM_BUFFER_SIZE, backlog=self._backlog,
+            reuse_port=self._reuse_port or None))
+        log('AsyncWSGIServer: Listening on ' + self._host + ':' +
+            str(self._port))
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+
+    def run_in_executor(self, function, *args):
+        return self._loop.run_in_executor(self._executor, function, *args)
+
+    async def _handle_connection(self, reader, writer):
+        timeout = HEADERS_TIMEOUT_SECONDS
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, 431)
+                    break
+                keep_alive = await self._handle_request(
+                    reader, writer, head)
+                if not keep_alive:
+                    break
+                timeout = self._keepalive_timeout
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.error('AsyncWSGIServer: Error: ' + traceback_format_exc())
+        finally:
+            writer.close()
+
+    # Returns True if connection may be kept alive
+    async def _handle_request(self, reader, writer, head):
+        requestline, _, header_lines = head.partition(b'\r\n')
+        words = requestline.decode('latin-1').split(' ')
+        if len(words) != 3 or not words[2].startswith('HTTP/1.'):
+            await self._send_error(writer, 400)
+            return False
+        method, target, version = words
+        headers = http_parse_headers(BytesIO(header_lines))
+
+        connection = headers.get('Connection', '').lower()
+        keep_alive = self._keepalive_timeout > 0 and (
+            (version == 'HTTP/1.1' and connection != 'close') or
+            (version == 'HTTP/1.0' and connection == 'keep-alive'))
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            await self._send_error(writer, 411)
+            return False
+        try:
+            content_length = int(headers.get('Content-Length') or 0)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            await self._send_error(writer, 400)
+            return False
+
+        raw_path, _, query_string = target.partition('?')
+        path = urllib_unquote(raw_path, 'latin-1')
+        request = AsyncRequest(self, reader, writer, method, path,
+                               query_string, version, headers,
+                               content_length)
+
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match is not None:
+                try:
+                    status, response_headers, body = \
+                        await handler(request, *match.groups())
+                except ConnectionError:
+                    raise
+                except IncompleteBodyError:
+                    # client may still receive response after it has
+                    # closed its side of connection
+                    status = 400
+                    response_headers = [('Content-Type', 'text/plain')]
+                    body = status_line(status).encode('latin-1')
+                except Exception:
+                    logger.error('AsyncWSGIServer: Error: ' +
+                                 traceback_format_exc())
+                    status = 500
+                    response_headers = [('Content-Type', 'text/plain')]
+                    body = status_line(status).encode('latin-1')
+                # response may be sent before the whole body is received
+                keep_alive = keep_alive and \
+                    request.remaining <= MAX_DRAIN_BYTES
+                if callable(body):
+                    return await self._write_stream(
+                        writer, request, requestline, status,
+                        response_headers, body)
+                response_headers = list(response_headers)
+                response_headers.append(('Content-Length', str(len(body))))
+                self._write_headers(writer, request, status,
+                                    response_headers, keep_alive)
+                size = 0
+                if method != 'HEAD':
+                    writer.write(body)
+                    size = len(body)
+                await writer.drain()
+                self._log_request(writer, request, requestline, status, size)
+                # client may not read response until body is sent
+                return await request.drain(MAX_DRAIN_BYTES) and keep_alive
+
+        return (await self._call_wsgi(request, writer, requestline,
+                                      keep_alive))
+
+    # Body of streamed response is written by coroutine body(writer).
+    # Its end is marked by connection close.
+    async def _write_stream(self, writer, request, requestline, status,
+                            headers, body):
+        self._write_headers(writer, request, status, headers, False)
+        self._log_request(writer, request, requestline, status)
+        if request.method != 'HEAD':
+            await body(writer)
+        await writer.drain()
+        return False
+
+    async def _call_wsgi(self, request, writer, requestline, keep_alive):
+        if request.content_length > MAX_BUFFERED_BODY_SIZE:
+            await self._send_error(writer, 413)
+            return False
+        try:
+            body = await request.read_chunk(request.content_length,
+                                            request.content_length)
+        except IncompleteBodyError:
+            await self._send_error(writer, 400)
+            return False
+        environ = self._make_environ(request, writer, body)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return response.setdefault('written', []).append
+
+        result = await self.run_in_executor(self._app, environ,
+                                            start_response)
+        try:
+            headers = list(response['headers'])
+            has_length = any(name.lower() == 'content-length'
+                             for name, value in headers)
+            # otherwise response end is marked by connection close
+            keep_alive = keep_alive and has_length
+            self._write_headers(writer, request, response['status'],
+                                headers, keep_alive)
+            size = 0
+            if request.method != 'HEAD':
+                for data in response.get('written', []):
+                    writer.write(data)
+                    size += len(data)
+                size += await self._write_body(writer, result)
+            await writer.drain()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        self._log_request(writer, request, requestline, response['status'],
+                          size)
+        return keep_alive
+
+    # Returns body size
+    async def _write_body(self, writer, result):
+        if isinstance(result, AsyncFileWrapper) and \
+                isinstance(result.filelike, FileRange):
+            await self._sendfile(writer, result.filelike)
+            return result.filelike.length
+        size = 0
+        if isinstance(result, (list, tuple)):
+            for data in result:
+                writer.write(data)
+                size += len(data)
+                await writer.drain()
+        else:
+            iterator = iter(result)
+            while True:
+                data = await self.run_in_executor(next, iterator, None)
+                if data is None:
+                    break
+                writer.write(data)
+                size += len(data)
+                await writer.drain()
+        return size
+
+    async def _sendfile(self, writer, filerange):
+        await writer.drain()
+        if filerange.length == 0:
+            return  # loop.sendfile() rejects empty range
+        # loop.sendfile() is available since Python 3.7
+        if hasattr(self._loop, 'sendfile'):
+            await self._loop.sendfile(writer.transport, filerange.file,
+                                      filerange.offset, filerange.length)
+            return
+        while True:
+            data = await self.run_in_executor(filerange.read,
+                                              FILE_BLOCK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+
+    def _make_environ(self, request, writer, body):
+        peer = writer.get_extra_info('peername') or ['']
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path,
+            'QUERY_STRING': request.query_string,
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': request.headers.get('Content-Length', ''),
+            'SERVER_NAME': self._host,
+            'SERVER_PORT': str(self._port),
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': peer[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': AsyncFileWrapper,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in ['HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH']:
+                continue
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+        return environ
+
+    def _write_headers(self, writer, request, status, headers, keep_alive):
+        lines = ['HTTP/1.1 ' + status_line(status)]
+        names = set(name.lower() for name, value in headers)
+        if 'date' not in names:
+            lines.append('Date: ' + http_date(time_time()))
+        if 'server' not in names:
+            lines.append('Server: ' + SERVER_SOFTWARE)
+        for name, value in headers:
+            lines.append(name + ': ' + value)
+        if not keep_alive:
+            lines.append('Connection: close')
+        elif request.version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def _send_error(self, writer, status):
+        body = status_line(status).encode('latin-1')
+        writer.write(('HTTP/1.1 ' + status_line(status) + '\r\n' +
+                      'Content-Type: text/plain\r\n' +
+                      'Content-Length: ' + str(len(body)) + '\r\n' +
+                      'Connection: close\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    # size is None if body size is not counted
+    def _log_request(self, writer, request, requestline, status, size=None):
+        if not logger.is_enabled(INFO):
+            return
+        peer = writer.get_extra_info('peername') or ['']
+        fields = {} if size is None else {'bytes': size}
+        logger.request('Request', client=peer[0],
+                       request=requestline.decode('latin-1'),
+                       status=status_line(status).split(' ')[0],
+                       duration=time_monotonic() - request.start_time,
+                       **fields)
+
+
+# bottle adapter: bottle.run(server=AsyncioServer(host=..., port=...,
+# threads=..., backlog=..., keepalive_timeout=..., routes=...,
+# reuse_port=...))
+class AsyncioServer(bottle.ServerAdapter):
+    def run(self, app):
+        AsyncWSGIServer(app, self.host, self.port,
+                        **self.options).serve_forever()
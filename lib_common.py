@@ -2,13 +2,15 @@
 # Copyright 2018 Sergey Kolomenkin
 # Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
 
+from lib_log import INFO, logger
+
 from os import stat as os_stat
 from stat import ST_MTIME as stat_ST_MTIME
-from time import strftime as time_strftime
 
 
+# Info record written by background thread (see lib_log.logger)
 def log(*args):
-    print('DBG>', time_strftime('%Y-%m-%d %H:%M:%S:'), *args)
+    logger.log(INFO, *args)
 
 
 def get_file_modified_unixtime(pathname):
@@ -3,19 +3,98 @@
 # Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
 
 from lib_common import log, get_file_modified_unixtime
+from lib_log import logger
+from lib_metrics import metrics
 
+from bisect import bisect_right
+import ctypes
+from ctypes.util import find_library as ctypes_find_library
+from hashlib import md5, sha1, sha256, sha512
+from heapq import heapify, heappop, heappush
 from io import open as io_open
-from logging import error as logging_error
-from os import listdir as os_listdir, \
+from json import dumps as json_dumps, loads as json_loads
+from os import close as os_close, \
+               fsdecode as os_fsdecode, \
+               fsencode as os_fsencode, \
+               fstat as os_fstat, \
+               fsync as os_fsync, \
+               getpid as os_getpid, \
+               link as os_link, \
+               lseek as os_lseek, \
                makedirs as os_makedirs, \
+               name as os_name, \
+               open as os_open, \
                path as os_path, \
+               read as os_read, \
                remove as os_remove, \
-               rename as os_rename
+               rmdir as os_rmdir, \
+               rename as os_rename, \
+               replace as os_replace, \
+               scandir as os_scandir, \
+               stat as os_stat, \
+               truncate as os_truncate, \
+               utime as os_utime, \
+               write as os_write, \
+               O_APPEND as os_O_APPEND, \
+               O_CREAT as os_O_CREAT, \
+               O_RDONLY as os_O_RDONLY, \
+               O_WRONLY as os_O_WRONLY, \
+               SEEK_CUR as os_SEEK_CUR, \
+               SEEK_SET as os_SEEK_SET
 import re
+from select import select as select_select
+from shutil import disk_usage as shutil_disk_usage
+import struct
+from sys import platform as sys_platform
 import threading
-from time import time as time_time, sleep as time_sleep
+from time import time as time_time
 from traceback import format_exc as traceback_format_exc
 from uuid import uuid4
+from zlib import adler32 as zlib_adler32, crc32 as zlib_crc32
+
+# not available on Windows:
+try:
+    from os import pwrite as os_pwrite
+except ImportError:
+    os_pwrite = None
+
+# not available on Windows and macOS:
+try:
+    from os import posix_fallocate as os_posix_fallocate
+except ImportError:
+    os_posix_fallocate = None
+
+# available on Windows only:
+try:
+    from os import O_BINARY as os_O_BINARY
+except ImportError:
+    os_O_BINARY = 0
+
+# not available on Windows:
+try:
+    from fcntl import flock as fcntl_flock, \
+                      LOCK_EX as fcntl_LOCK_EX, \
+                      LOCK_SH as fcntl_LOCK_SH
+except ImportError:
+    fcntl_flock = None
+
+
+# inotify is Linux only. It is called through ctypes.
+def _load_inotify_library():
+    if not sys_platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes_find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+inotify_library = _load_inotify_library()
 
 
 # ==========================================
@@ -44,115 +123,1004 @@ def clean_filename(filename):
     return s
 
 
+def make_file_record(fullname, stat_result):
+    return {
+        'disk_filename': os_path.basename(fullname),
+        'full_disk_filename': fullname,
+        'original_filename': None,
+        'size': stat_result.st_size,
+        'modified': int(stat_result.st_mtime),
+        'expires': None,
+        'hash': None,
+        'hash_algorithm': None,
+    }
+
+
+# Single pass directory scanner returning metadata records of regular files.
+# DirEntry.is_file() uses file type returned by readdir() and
+# DirEntry.stat() result is cached, so there is at most one stat call
+# per file (none at all on Windows).
+def scan_directory(directory):
+    records = []
+    if not os_path.isdir(directory):
+        return records
+    for entry in os_scandir(directory):
+        if entry.is_file():
+            records.append(make_file_record(entry.path, entry.stat()))
+    return records
+
+
+# inotify event masks and flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without name: wd, mask, cookie, len
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+# How often watcher thread checks stop signal
+WATCHER_POLL_SECONDS = 1
+
+
+def is_inotify_available():
+    return inotify_library is not None
+
+
+# Watches directories (not recursively) with Linux inotify.
+class InotifyWatcher:
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+        IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self):
+        if inotify_library is None:
+            raise Exception('inotify is not available')
+        self._fd = inotify_library.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory
+        self._directories = {}
+
+    def add_watch(self, directory):
+        wd = inotify_library.inotify_add_watch(
+            self._fd, os_fsencode(directory), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                          directory)
+        self._directories[wd] = directory
+
+    # Waits for events up to timeout seconds and calls
+    # callback(directory, name, mask, cookie) for each of them.
+    # directory and name are None if mask is IN_Q_OVERFLOW
+    # (events are lost).
+    def read_events(self, callback, timeout):
+        if not select_select([self._fd], [], [], timeout)[0]:
+            return
+        try:
+            data = os_read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = \
+                INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = os_fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                callback(None, None, mask, cookie)
+                continue
+            if mask & IN_IGNORED:
+                # directory is removed
+                self._directories.pop(wd, None)
+                continue
+            directory = self._directories.get(wd)
+            if directory is not None and name != '':
+                callback(directory, name, mask, cookie)
+
+    def close(self):
+        os_close(self._fd)
+
+
+# Shard directory name. Each shard level is named by
+# 2 hex digits of file name hash.
+SHARD_NAME_RE = re.compile('^[0-9a-f]{2}$')
+MAX_SHARD_LEVELS = 4
+
+
+# hashlib-like wrapper for fast non-cryptographic zlib checksums
+class ZlibChecksum:
+    def __init__(self, function):
+        self._function = function
+        self._value = function(b'')
+
+    def update(self, data):
+        self._value = self._function(data, self._value)
+
+    def hexdigest(self):
+        return '%08x' % self._value
+
+
+# Content hash algorithms supported for uploaded files
+HASH_ALGORITHMS = {
+    'md5': md5,
+    'sha1': sha1,
+    'sha256': sha256,
+    'sha512': sha512,
+    'crc32': lambda: ZlibChecksum(zlib_crc32),
+    'adler32': lambda: ZlibChecksum(zlib_adler32),
+}
+
+# Hash algorithms collision resistant enough to deduplicate files
+DEDUPLICATION_HASH_ALGORITHMS = ['sha256', 'sha512']
+
+# What is flushed to disk before file is shown as stored:
+# none - nothing, operating system writes data when it wants
+# file - file data (fsync)
+# dir - file data and directory entry of stored file
+DURABILITY_POLICIES = ['none', 'file', 'dir']
+
+
+# Incomplete upload is removed if its temp file is not modified for this time
+TEMP_FILE_MAX_IDLE_SECONDS = 15 * 60
+
+# Metadata journal: append-only log of stored files index changes, one
+# JSON object per line. The first line is header. Index is loaded from it
+# on start instead of storage directory scan. It is compacted to single
+# 'add' line per file on start and when it has too many changes.
+# Storage instances of worker processes share it.
+JOURNAL_FILENAME = 'journal.jsonl'
+JOURNAL_VERSION = 1
+
+# Fields of file record kept in journal. Other fields are derived.
+JOURNAL_RECORD_FIELDS = ['disk_filename', 'original_filename', 'size',
+                         'modified', 'expires', 'hash', 'hash_algorithm']
+
+# Journal is compacted when it has more changes than stored files
+# and at least this number of changes
+JOURNAL_COMPACT_MIN_CHANGES = 10000
+
+# Expiry queue is rebuilt without entries of removed files when it has
+# more entries than twice stored files count and at least this number
+EXPIRY_QUEUE_MIN_REBUILD_SIZE = 1000
+
+# How often storage owning retension thread reads journal
+JOURNAL_POLL_SECONDS = 1
+
+# How often temp directory is scanned for abandoned uploads when storage
+# is shared (temp files of other processes can't be scheduled)
+TEMP_SWEEP_SECONDS = 60
+
+retention_pass_duration = metrics.histogram(
+    'limbo_retention_pass_duration_seconds',
+    'Duration of retention passes removing expired files')
+expired_files_total = metrics.counter(
+    'limbo_expired_files_total', 'Files removed at expiry time')
+evicted_files_total = metrics.counter(
+    'limbo_evicted_files_total',
+    'Files removed before expiry to free storage space')
+swept_temp_files_total = metrics.counter(
+    'limbo_temp_files_swept_total', 'Temp files of abandoned uploads removed')
+
+# Number of recent index changes kept for delta listing. Clients asking
+# for changes since older version get full listing.
+MAX_LISTING_CHANGES = 10000
+
+
+# Reserves disk space for file, so it is stored in fewer extents.
+# Returns False if it is not supported by OS or file system.
+def preallocate_file(fd, size):
+    if os_posix_fallocate is None or size <= 0:
+        return False
+    try:
+        os_posix_fallocate(fd, 0, size)
+    except OSError:
+        return False
+    return True
+
+
+def sync_file(fullname):
+    fd = os_open(fullname, os_O_WRONLY | os_O_BINARY)
+    try:
+        os_fsync(fd)
+    finally:
+        os_close(fd)
+
+
+# Makes directory entries (e.g. renamed file) durable.
+# Directories can't be opened on Windows, NTFS journals them anyway.
+def sync_directory(directory):
+    if os_name == 'nt':
+        return
+    fd = os_open(directory, os_O_RDONLY)
+    try:
+        os_fsync(fd)
+    finally:
+        os_close(fd)
+
+
 class AtomicFile:
-    def __init__(self, temp_filename, final_filename):
+    # on_commit(atomic_file) is called instead of plain rename on commit.
+    # It is expected to move temp file to its final name.
+    # hasher is hashlib-like object to compute content hash while writing.
+    # size is expected file size (or its upper bound), None means unknown
+    # size.
+    # buffer_size is passed to io.open(), -1 means default.
+    # sync enables fsync before commit.
+    # on_abort(atomic_file) is called when incomplete file is removed.
+    # preallocate enables disk space preallocation for expected size.
+    # on_grow(atomic_file, size) is called before file grows beyond
+    # expected size. It raises if file can't be that large.
+    def __init__(self, temp_filename, final_filename, on_commit=None,
+                 hasher=None, size=None, buffer_size=-1, sync=False,
+                 on_abort=None, preallocate=True, on_grow=None):
         if os_path.isfile(final_filename):
             raise Exception('Destination file already exists')
         self._temp_filename = temp_filename
         self._final_filename = final_filename
-        self._fd = io_open(self._temp_filename, 'wb')
+        self._on_commit = on_commit
+        self._on_abort = on_abort
+        self._hasher = hasher
+        self._sync = sync
+        self._on_grow = on_grow
+        self._written = 0
+        self._expected_size = size or 0
+        self._fd = io_open(self._temp_filename, 'wb', buffering=buffer_size)
+        try:
+            self._preallocated = preallocate and size is not None and \
+                preallocate_file(self._fd.fileno(), size)
+        except BaseException:
+            self._fd.close()
+            os_remove(self._temp_filename)
+            raise
+
+    @property
+    def temp_filename(self):
+        return self._temp_filename
+
+    @property
+    def final_filename(self):
+        return self._final_filename
+
+    @property
+    def hexdigest(self):
+        return None if self._hasher is None else self._hasher.hexdigest()
 
     def write(self, data):
+        size = self._written + len(data)
+        if self._on_grow is not None and size > self._expected_size:
+            self._on_grow(self, size)
+            self._expected_size = size
         self._fd.write(data)
+        self._written = size
+        if self._hasher is not None:
+            self._hasher.update(data)
 
+    # Commits file. File is aborted if it can't be committed.
     def close(self):
+        try:
+            self._finish_file()
+            self._commit()
+        except BaseException:
+            self.abort()
+            raise
+
+    # Closes and removes incomplete file
+    def abort(self):
         self._fd.close()
-        os_rename(self._temp_filename, self._final_filename)
+        try:
+            os_remove(self._temp_filename)
+        except FileNotFoundError:
+            pass
+        if self._on_abort is not None:
+            self._on_abort(self)
+
+    def _finish_file(self):
+        if self._preallocated:
+            # Free space reserved beyond written data
+            self._fd.truncate(self._written)
+        if self._sync:
+            self._fd.flush()
+            os_fsync(self._fd.fileno())
+        self._fd.close()
+
+    def _commit(self):
+        if self._on_commit is None:
+            os_rename(self._temp_filename, self._final_filename)
+        else:
+            self._on_commit(self)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._fd.close()
         if exc_tb is None:
             # No exception, so rename
-            os_rename(self._temp_filename, self._final_filename)
+            self.close()
+        else:
+            self.abort()
+
+
+# Id of resumable upload session. It is used in temp file names.
+UPLOAD_SESSION_ID_RE = re.compile('^[0-9a-f]{32}$')
+
+UPLOAD_SESSION_STATE_SUFFIX = '.session'
+
+
+class StorageFullError(Exception):
+    pass
+
+
+class UploadOffsetError(Exception):
+    def __init__(self, offset):
+        super().__init__('Upload offset is out of file bounds: ' +
+                         str(offset))
+        self.offset = offset
+
+
+class UploadChecksumError(Exception):
+    pass
+
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if os_pwrite is not None:
+            written = os_pwrite(fd, view, offset)
+        else:
+            os_lseek(fd, offset, os_SEEK_SET)
+            written = os_write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+# Resumable upload. Data is written at explicit offsets into temp file in
+# incomplete directory. Parts of file may be uploaded concurrently in any
+# order by several connections. Received ranges are appended to state file
+# next to it, so upload may be resumed after connection loss or server
+# restart. State file: first line is JSON header, others are
+# "<begin> <end>" ranges.
+class UploadSession:
+    # sync enables fsync of file data before commit.
+    # on_grow(session, size) is called before data is written beyond
+    # declared size (if size is unknown). It raises if file can't be that
+    # large.
+    def __init__(self, session_id, temp_filename, final_filename,
+                 state_filename, header, ranges, on_commit, hash_factory,
+                 sync=False, on_grow=None):
+        self._session_id = session_id
+        self._temp_filename = temp_filename
+        self._final_filename = final_filename
+        self._state_filename = state_filename
+        self._original_filename = header['filename']
+        self._size = header['size']
+        self._on_commit = on_commit
+        self._hash_factory = hash_factory
+        self._sync = sync
+        self._on_grow = on_grow
+        # Space for data up to this offset is reserved
+        self._reserved_end = self._size or 0
+        self._hasher = None if hash_factory is None else hash_factory()
+        # Data before this offset is already hashed
+        self._hashed_offset = 0
+        self._active_writes = 0
+        self._closed = False
+        # Protects ranges, hasher and state file
+        self._lock = threading.Lock()
+        # sorted list of non-overlapping [begin, end] received ranges
+        self._ranges = []
+        for begin, end in ranges:
+            self._add_range(begin, end)
+
+    @property
+    def session_id(self):
+        return self._session_id
+
+    @property
+    def original_filename(self):
+        return self._original_filename
+
+    @property
+    def temp_filename(self):
+        return self._temp_filename
+
+    @property
+    def final_filename(self):
+        return self._final_filename
+
+    @property
+    def state_filename(self):
+        return self._state_filename
+
+    # Declared file size or None if it is unknown
+    @property
+    def size(self):
+        return self._size
+
+    # Size of data received contiguously from the beginning of file
+    @property
+    def offset(self):
+        with self._lock:
+            return self._get_offset()
+
+    # Copy of received ranges: list of [begin, end]
+    @property
+    def ranges(self):
+        with self._lock:
+            return [list(item) for item in self._ranges]
+
+    @property
+    def is_complete(self):
+        with self._lock:
+            return self._is_complete()
+
+    @property
+    def hexdigest(self):
+        if self._hash_factory is None:
+            return None
+        with self._lock:
+            self._update_hash()
+            return self._hasher.hexdigest()
+
+    # Writes chunks (iterable of bytes) starting at offset. Data may
+    # overlap already received ranges (e.g. when failed part is retried).
+    # Data received before an error is kept. Returns new offset.
+    # length is expected data size (e.g. request Content-Length) to
+    # reserve space for before data is received, None means unknown.
+    def write(self, offset, chunks, length=None):
+        with self.open_writer(offset, length) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        return self.offset
+
+    # Returns UploadSessionWriter of data starting at offset. It is used
+    # when chunks are not available as iterable (e.g. they are received
+    # by event loop).
+    def open_writer(self, offset, length=None):
+        if offset < 0 or (self._size is not None and offset > self._size):
+            raise UploadOffsetError(offset)
+        if length is not None:
+            self._reserve(offset + length)
+        with self._lock:
+            if self._closed:
+                raise Exception('Upload session is closed')
+            self._active_writes += 1
+        try:
+            fd = os_open(self._temp_filename, os_O_WRONLY | os_O_BINARY)
+        except BaseException:
+            with self._lock:
+                self._active_writes -= 1
+            raise
+        return UploadSessionWriter(self, fd, offset)
+
+    # expected_hash is optional hex digest of the whole file
+    # calculated with storage hash algorithm
+    def commit(self, expected_hash=None):
+        with self._lock:
+            if not self._is_complete():
+                raise Exception('Upload is incomplete')
+            if expected_hash is not None:
+                if self._hash_factory is None:
+                    raise UploadChecksumError('Content hashing is disabled')
+                self._update_hash()
+                if self._hasher.hexdigest() != expected_hash.lower():
+                    raise UploadChecksumError('Content hash mismatch')
+            if os_path.isfile(self._final_filename):
+                raise Exception('Destination file already exists')
+            # Drop preallocated space and data which was not recorded
+            os_truncate(self._temp_filename, self._get_offset())
+            if self._sync:
+                sync_file(self._temp_filename)
+            self._closed = True
+        try:
+            self._on_commit(self)
+        except BaseException:
+            with self._lock:
+                self._closed = False
+            raise
+        os_remove(self._state_filename)
+
+    # Adds ranges received by other processes
+    def merge_ranges(self, ranges):
+        with self._lock:
+            for begin, end in ranges:
+                self._add_range(begin, end)
+
+    def abort(self):
+        with self._lock:
+            self._closed = True
+            for fullname in [self._temp_filename, self._state_filename]:
+                try:
+                    os_remove(fullname)
+                except FileNotFoundError:
+                    pass
+
+    def _get_offset(self):
+        if self._ranges and self._ranges[0][0] == 0:
+            return self._ranges[0][1]
+        return 0
+
+    # Complete file has no gaps: single range from the beginning (or no
+    # ranges if file is empty) up to declared size if it is known
+    def _is_complete(self):
+        if self._active_writes > 0 or len(self._ranges) > 1:
+            return False
+        if self._ranges and self._ranges[0][0] != 0:
+            return False
+        return self._size is None or self._get_offset() == self._size
+
+    # Sequentially received data is hashed on the fly
+    def _hash_chunk(self, chunk, position):
+        if self._hasher is None:
+            return
+        with self._lock:
+            if self._hashed_offset == position:
+                self._hasher.update(chunk)
+                self._hashed_offset += len(chunk)
+
+    # Hashes data received after already hashed part
+    def _update_hash(self):
+        offset = self._get_offset()
+        if self._hashed_offset >= offset:
+            return
+        with io_open(self._temp_filename, 'rb') as fp:
+            fp.seek(self._hashed_offset)
+            while self._hashed_offset < offset:
+                chunk = fp.read(min(offset - self._hashed_offset,
+                                    1024 * 1024))
+                if not chunk:
+                    raise Exception('Upload temp file is truncated')
+                self._hasher.update(chunk)
+                self._hashed_offset += len(chunk)
+
+    # Called by UploadSessionWriter
+    def _write_chunk(self, fd, chunk, position):
+        if self._size is not None and position + len(chunk) > self._size:
+            # data end is out of file bounds
+            raise UploadOffsetError(position + len(chunk))
+        self._reserve(position + len(chunk))
+        write_at(fd, chunk, position)
+        self._hash_chunk(chunk, position)
+
+    # Called by UploadSessionWriter
+    def _finish_write(self, fd, begin, end):
+        try:
+            os_close(fd)
+        finally:
+            with self._lock:
+                self._active_writes -= 1
+                if end > begin and not self._closed:
+                    self._record_range(begin, end)
+
+    # Reserves storage space for data up to end offset
+    def _reserve(self, end):
+        if self._on_grow is None:
+            return
+        with self._lock:
+            if end <= self._reserved_end:
+                return
+        self._on_grow(self, end)
+        with self._lock:
+            self._reserved_end = max(self._reserved_end, end)
+
+    def _record_range(self, begin, end):
+        with io_open(self._state_filename, 'a', encoding='utf-8') as fp:
+            fp.write(str(begin) + ' ' + str(end) + '\n')
+        self._add_range(begin, end)
+
+    def _add_range(self, begin, end):
+        ranges = []
+        for range_begin, range_end in self._ranges:
+            if range_end < begin or end < range_begin:
+                ranges.append([range_begin, range_end])
+            else:
+                begin = min(begin, range_begin)
+                end = max(end, range_end)
+        ranges.append([begin, end])
+        self._ranges = sorted(ranges)
+
+
+# Writes sequential data to upload session. Received range is recorded
+# in session state once when writer is closed, not per chunk.
+class UploadSessionWriter:
+    def __init__(self, session, fd, offset):
+        self._session = session
+        self._fd = fd
+        self._offset = offset
+        self._position = offset
+
+    def write(self, data):
+        self._session._write_chunk(self._fd, data, self._position)
+        self._position += len(data)
+
+    # Records data written so far, also after an error
+    def close(self):
+        if self._fd is not None:
+            fd = self._fd
+            self._fd = None
+            self._session._finish_write(fd, self._offset, self._position)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class FileStorage:
-    def __init__(self, storage_directory, max_store_time_seconds):
+    # shard_levels > 0 enables sharded layout: files are stored in
+    # <storage>/ab/cd/<disk file name> where ab, cd... are file name hash
+    # prefixes. Zero means flat layout.
+    # hash_algorithm is a key of HASH_ALGORITHMS to compute content hash
+    # of uploaded files. Empty string disables hashing.
+    # deduplicate enables storing uploads with the same content as
+    # hardlinks to single blob. It requires cryptographic hash algorithm.
+    # write_buffer_size is buffer size of uploaded files, -1 means default
+    # durability is one of DURABILITY_POLICIES
+    # max_storage_bytes is quota of stored files size, 0 means no quota
+    # min_free_bytes is free disk space to be kept, 0 means no limit
+    # Oldest files are evicted before their expiry to meet both limits.
+    # shared enables coordination of storage instances of several
+    # processes (see _sync_journal). Instance is created before worker
+    # processes are forked. Only one process calls start().
+    # Index is loaded from metadata journal and reconciled with storage
+    # directory content by retension thread after start().
+    # watch enables inotify watcher (Linux only) which updates index when
+    # files are added or removed by other programs. It is started by
+    # start().
+    def __init__(self, storage_directory, max_store_time_seconds,
+                 shard_levels=0, hash_algorithm='', deduplicate=False,
+                 preallocate=True, write_buffer_size=-1, durability='none',
+                 max_storage_bytes=0, min_free_bytes=0, shared=False,
+                 watch=False):
         log('FileStorage: create(' + storage_directory + ', max ' +
-            str(max_store_time_seconds) + ' sec)')
+            str(max_store_time_seconds) + ' sec, shard levels ' +
+            str(shard_levels) + ', hash "' + hash_algorithm +
+            '", deduplicate ' + str(deduplicate) + ', preallocate ' +
+            str(preallocate) + ', write buffer ' + str(write_buffer_size) +
+            ', durability "' + durability + '", max ' +
+            str(max_storage_bytes) + ' bytes, min free ' +
+            str(min_free_bytes) + ' bytes, shared ' + str(shared) +
+            ', watch ' + str(watch) + ')')
         self._storage_directory = os_path.abspath(storage_directory)
         self._temp_directory = \
             os_path.join(self._storage_directory, 'incomplete')
+        self._metadata_directory = \
+            os_path.join(self._storage_directory, 'metadata')
         self._max_store_time_seconds = max_store_time_seconds
+        if not 0 <= shard_levels <= MAX_SHARD_LEVELS:
+            raise Exception('Unsupported shard levels count', shard_levels)
+        self._shard_levels = shard_levels
+        if hash_algorithm != '' and hash_algorithm not in HASH_ALGORITHMS:
+            raise Exception('Unsupported hash algorithm', hash_algorithm)
+        if deduplicate and \
+                hash_algorithm not in DEDUPLICATION_HASH_ALGORITHMS:
+            raise Exception('Hash algorithm is not suitable for '
+                            'deduplication', hash_algorithm)
+        self._hash_algorithm = hash_algorithm
+        self._deduplicate = deduplicate
+        if durability not in DURABILITY_POLICIES:
+            raise Exception('Unsupported durability policy', durability)
+        self._preallocate = preallocate
+        self._write_buffer_size = write_buffer_size
+        self._durability = durability
+        self._max_storage_bytes = max_storage_bytes
+        self._min_free_bytes = min_free_bytes
         self._retension_thread = None
-        self._protect_stop = threading.Lock()
-        self._condition_stop = threading.Condition(self._protect_stop)
+        self._watch = watch
+        self._watcher = None
+        self._watcher_thread = None
+        # watched storage directory -> shard level
+        self._watched_levels = {}
+        # Cookies of renames from temp directory. Uploads committed with
+        # rename are indexed by _commit_file().
+        self._commit_cookies = set()
+
+        # In-memory index of stored files: disk file name -> file record.
+        # It is the only source for enumerate_files() so listing
+        # doesn't touch file system at all.
+        self._files = {}
+        self._protect_files = threading.Lock()
+        # Resumable upload sessions: session id -> UploadSession
+        self._upload_sessions = {}
+
+        # (hash algorithm, content hash) -> set of disk file names
+        # sharing the same blob
+        # (hardlinks to the same data). Files without known hash
+        # are not listed here.
+        self._blobs = {}
+
+        # Total size of stored files. Blob shared by deduplicated files
+        # is counted once.
+        self._total_size = 0
+        # Space reserved for uploads in progress:
+        # temp file name -> declared size
+        self._reservations = {}
+        self._reserved_size = 0
+
+        # Expiry schedule. Heaps of (deadline, name) tuples.
+        # Entries are never removed from the middle of a heap: when a file
+        # is removed its entry stays and is just skipped when it is due.
+        # Instances not running retension (worker processes) never pop
+        # them, so stale entries are dropped by rebuild of the whole heap
+        # (see _push_expiry()).
+        self._expiry_queue = []
+        self._temp_expiry_queue = []
+        # Retension thread sleeps on this condition until the nearest
+        # deadline, new earlier deadline or stop() call:
+        self._condition_schedule = threading.Condition(self._protect_files)
         self._stopping = False
 
+        # Metadata journal. Each instance appends its own changes. Shared
+        # instance also applies changes of other instances (processes).
+        self._shared = shared
+        self._journal_fullname = os_path.join(self._metadata_directory,
+                                              JOURNAL_FILENAME)
+        # Size of journal part which is already applied and its inode
+        # (inode is changed by compaction)
+        self._journal_offset = 0
+        self._journal_inode = None
+        # Journal epoch is changed by compaction. Listing version is
+        # epoch and journal offset of the last applied change, so it is
+        # the same in all processes sharing the journal.
+        self._journal_epoch = ''
+        # Recent changes sorted by version for delta listing: versions
+        # and disk file names. Changes up to horizon version are unknown.
+        self._change_versions = []
+        self._change_names = []
+        self._changes_horizon = 0
+        # Number of changes after the last compaction
+        self._journal_changes = 0
+        self._instance_id = uuid4().hex
+        self._next_temp_sweep = 0
+        self._reconcile_pending = False
+        self._protect_journal = threading.Lock()
+
         self._create_dirs()
+        self._load_index()
+        self._compact_journal()
 
     def start(self):
         log('FileStorage: start')
+        self._schedule_existing_temp_files()
+        if self._watch:
+            self._start_watcher()
         self._retension_thread = \
             threading.Thread(target=self._retension_thread_procedure)
         self._retension_thread.start()
 
     def stop(self):
         log('FileStorage: stop')
-        with self._condition_stop:
+        with self._condition_schedule:
             self._stopping = True
-            self._condition_stop.notify()
-        self._retension_thread.join()
+            self._condition_schedule.notify()
+        if self._retension_thread is not None:
+            self._retension_thread.join()
+        if self._watcher_thread is not None:
+            self._watcher_thread.join()
 
     def enumerate_files(self):
-        if not os_path.isdir(self._storage_directory):
-            return []
-        files = []
-        for disk_filename in os_listdir(self._storage_directory):
-            fullname = os_path.join(self._storage_directory, disk_filename)
-            if os_path.isfile(fullname):
-                url_filename = FileStorage._fname_disk_to_url(disk_filename)
-                display_filename = \
-                    FileStorage._fname_disk_to_display(disk_filename)
-                files.append(
-                    {
-                        'full_disk_filename': fullname,
-                        'url_filename': url_filename,
-                        'display_filename': display_filename,
-                    })
-        return files
-
-    def open_file_writer(self, original_filename):
+        self._sync_journal()
+        with self._protect_files:
+            return [dict(record) for record in self._files.values()]
+
+    # Returns opaque string changed by any change of stored files index
+    def get_listing_version(self):
+        self._sync_journal()
+        with self._protect_files:
+            return self._make_listing_version()
+
+    # Returns [version, records, removed url file names] with files
+    # added, replaced or removed after specified listing version. Cost
+    # depends on number of changes only. Returns None if changes are
+    # unknown (version is too old or made before compaction).
+    def enumerate_changes(self, since_version):
+        epoch, _, offset = since_version.rpartition(':')
+        try:
+            offset = int(offset)
+        except ValueError:
+            return None
+        self._sync_journal()
+        with self._protect_files:
+            if epoch != self._journal_epoch or \
+                    offset < self._changes_horizon:
+                return None
+            start = bisect_right(self._change_versions, offset)
+            records = []
+            removed = []
+            for disk_filename in set(self._change_names[start:]):
+                record = self._files.get(disk_filename)
+                if record is not None:
+                    records.append(dict(record))
+                else:
+                    removed.append(
+                        FileStorage._fname_disk_to_url(disk_filename))
+            return [self._make_listing_version(), records, removed]
+
+    # size is expected file size (or its upper bound), None means unknown
+    def open_file_writer(self, original_filename, size=None):
         self._create_dirs()
         disk_filename = FileStorage._fname_original_to_disk(original_filename)
         temp_disk_filename = uuid4().hex + '.' + disk_filename
         temp_fullname = os_path.join(self._temp_directory, temp_disk_filename)
-        fullname = os_path.join(self._storage_directory, disk_filename)
+        fullname = self._get_disk_fullname(disk_filename)
+        self._create_shard_dir(fullname)
         log('FileStorage: Upload file: ' + disk_filename)
-        return AtomicFile(temp_fullname, fullname)
+        hasher = HASH_ALGORITHMS[self._hash_algorithm]() \
+            if self._hash_algorithm != '' else None
+        self._reserve_space(temp_fullname, size)
+        try:
+            atomic_file = AtomicFile(temp_fullname, fullname,
+                                     lambda atomic_file: self._commit_file(
+                                         atomic_file, original_filename),
+                                     hasher, size, self._write_buffer_size,
+                                     self._durability != 'none',
+                                     self._abort_file, self._preallocate,
+                                     self._grow_file)
+        except BaseException:
+            self._release_space(temp_fullname)
+            raise
+        with self._protect_files:
+            self._schedule_temp_file(temp_fullname,
+                                     time_time() + TEMP_FILE_MAX_IDLE_SECONDS)
+        return atomic_file
+
+    # size is declared file size, None means unknown size
+    def create_upload_session(self, original_filename, size=None):
+        self._create_dirs()
+        disk_filename = FileStorage._fname_original_to_disk(original_filename)
+        fullname = self._get_disk_fullname(disk_filename)
+        if os_path.isfile(fullname):
+            raise Exception('Destination file already exists')
+        self._create_shard_dir(fullname)
+        session_id = uuid4().hex
+        temp_fullname, state_fullname = \
+            self._get_upload_session_files(session_id, disk_filename)
+        header = {'filename': original_filename, 'size': size}
+        self._reserve_space(temp_fullname, size)
+        try:
+            with io_open(temp_fullname, 'wb') as fp:
+                if self._preallocate and size is not None:
+                    preallocate_file(fp.fileno(), size)
+            with io_open(state_fullname, 'w', encoding='utf-8') as fp:
+                fp.write(json_dumps(header) + '\n')
+        except BaseException:
+            for fullname in [temp_fullname, state_fullname]:
+                try:
+                    os_remove(fullname)
+                except FileNotFoundError:
+                    pass
+            self._release_space(temp_fullname)
+            raise
+        log('FileStorage: Upload session ' + session_id + ': ' +
+            disk_filename + '; size: ' + str(size))
+        session = self._make_upload_session(session_id, header, [])
+        deadline = time_time() + TEMP_FILE_MAX_IDLE_SECONDS
+        with self._protect_files:
+            self._upload_sessions[session_id] = session
+            self._schedule_temp_file(temp_fullname, deadline)
+            self._schedule_temp_file(state_fullname, deadline)
+        return session
+
+    # Returns None if session does not exist
+    def get_upload_session(self, session_id):
+        if not UPLOAD_SESSION_ID_RE.match(session_id):
+            return None
+        with self._protect_files:
+            session = self._upload_sessions.get(session_id)
+        if session is not None and not self._shared:
+            return session
+
+        # Session created before restart or by other process.
+        # Other processes may receive parts of shared session, so its
+        # ranges are reloaded from state file.
+        state_fullname = os_path.join(
+            self._temp_directory, session_id + UPLOAD_SESSION_STATE_SUFFIX)
+        try:
+            with io_open(state_fullname, 'r', encoding='utf-8') as fp:
+                lines = fp.read().splitlines()
+        except FileNotFoundError:
+            with self._protect_files:
+                self._upload_sessions.pop(session_id, None)
+            return None
+        header = json_loads(lines[0])
+        # the last line may be incomplete:
+        ranges = [[int(value) for value in line.split(' ')]
+                  for line in lines[1:] if len(line.split(' ')) == 2]
+        if session is not None:
+            session.merge_ranges(ranges)
+            return session
+        session = self._make_upload_session(session_id, header, ranges)
+        with self._protect_files:
+            return self._upload_sessions.setdefault(session_id, session)
+
+    def commit_upload_session(self, session, expected_hash=None):
+        session.commit(expected_hash)
+        log('FileStorage: Upload session ' + session.session_id +
+            ' is committed')
+        with self._protect_files:
+            self._upload_sessions.pop(session.session_id, None)
+
+    def abort_upload_session(self, session):
+        session.abort()
+        log('FileStorage: Upload session ' + session.session_id +
+            ' is aborted')
+        with self._protect_files:
+            self._upload_sessions.pop(session.session_id, None)
+        self._release_space(session.temp_filename)
+
+    # Raises StorageFullError if file of specified size can't be stored
+    # even after eviction of old files. It doesn't reserve space.
+    def check_space(self, size):
+        if not self._make_room(size):
+            raise StorageFullError('Not enough storage space', size)
+
+    def get_file_count(self):
+        self._sync_journal()
+        with self._protect_files:
+            return len(self._files)
+
+    # Returns [stored files size, reserved size, quota]
+    def get_usage(self):
+        self._sync_journal()
+        with self._protect_files:
+            return [self._total_size, self._reserved_size,
+                    self._max_storage_bytes]
+
+    # Returns copy of file record or None if file is not stored
+    def get_file_record(self, url_filename):
+        disk_filename = FileStorage._fname_url_to_disk(url_filename)
+        self._sync_journal()
+        with self._protect_files:
+            record = self._files.get(disk_filename)
+            return None if record is None else dict(record)
 
     def get_file_info_to_read(self, url_filename):
         disk_filename = FileStorage._fname_url_to_disk(url_filename)
-        display_filename = FileStorage._fname_disk_to_display(disk_filename)
-        return [self._storage_directory, disk_filename, display_filename]
+        record = self.get_file_record(url_filename)
+        display_filename = FileStorage._fname_disk_to_display(
+            disk_filename, None if record is None else
+            record['original_filename'])
+        return [self._get_disk_directory(disk_filename),
+                disk_filename, display_filename]
 
     def remove_file(self, url_filename):
         disk_filename = FileStorage._fname_url_to_disk(url_filename)
-        fullname = os_path.join(self._storage_directory, disk_filename)
+        self._sync_journal()
+        with self._protect_files:
+            record = self._index_remove(disk_filename)
+        if record is None:
+            raise Exception('File not found', url_filename)
         log('FileStorage: Remove file: "' + disk_filename +
-            '"; size: ' + str(os_path.getsize(fullname)))
-        os_remove(fullname)
+            '"; size: ' + str(record['size']))
+        os_remove(record['full_disk_filename'])
 
     def remove_all_files(self):
-        if not os_path.isdir(self._storage_directory):
-            return
-        for disk_filename in os_listdir(self._storage_directory):
-            fullname = os_path.join(self._storage_directory, disk_filename)
-            if os_path.isfile(fullname):
-                log('FileStorage: Remove file: "' + disk_filename +
-                    '"; size: ' + str(os_path.getsize(fullname)))
-                os_remove(fullname)
-        if not os_path.isdir(self._temp_directory):
-            return
-        for disk_filename in os_listdir(self._temp_directory):
-            fullname = os_path.join(self._temp_directory, disk_filename)
-            if os_path.isfile(fullname):
-                log('FileStorage: Remove temp file: "' + disk_filename +
-                    '"; size: ' + str(os_path.getsize(fullname)))
-                os_remove(fullname)
+        self._sync_journal()
+        with self._protect_files:
+            records = list(self._files.values())
+            self._index_clear()
+        for record in records:
+            log('FileStorage: Remove file: "' + record['disk_filename'] +
+                '"; size: ' + str(record['size']))
+            try:
+                os_remove(record['full_disk_filename'])
+            except FileNotFoundError:
+                pass
+        for record in scan_directory(self._temp_directory):
+            log('FileStorage: Remove temp file: "' + record['disk_filename'] +
+                '"; size: ' + str(record['size']))
+            try:
+                os_remove(record['full_disk_filename'])
+            except FileNotFoundError:
+                pass
 
     def _fname_original_to_disk(original_filename):
         return FileStorage._canonize_file(original_filename)
@@ -163,8 +1131,9 @@ class FileStorage:
     def _fname_disk_to_url(disk_filename):
         return disk_filename
 
-    def _fname_disk_to_display(disk_filename):
-        return disk_filename
+    # Original file name is known for files uploaded with metadata journal
+    def _fname_disk_to_display(disk_filename, original_filename=None):
+        return original_filename or disk_filename
 
     def _canonize_file(filename):
         canonizeed = clean_filename(filename)
@@ -173,6 +1142,652 @@ class FileStorage:
                             filename)
         return canonizeed
 
+    # Adds fields derived from journal fields of record
+    def _complete_record(self, record):
+        disk_filename = record['disk_filename']
+        if record['expires'] is None:
+            record['expires'] = \
+                record['modified'] + self._max_store_time_seconds
+        record['full_disk_filename'] = self._get_disk_fullname(disk_filename)
+        record['url_filename'] = FileStorage._fname_disk_to_url(disk_filename)
+        record['display_filename'] = FileStorage._fname_disk_to_display(
+            disk_filename, record['original_filename'])
+        # path relative to storage directory (uses '/' as separator):
+        record['relative_disk_filename'] = '/'.join(
+            self._get_shard_names(disk_filename) + [disk_filename])
+        return record
+
+    def _get_shard_names(self, disk_filename):
+        if self._shard_levels == 0:
+            return []
+        digest = sha1(disk_filename.encode('utf-8')).hexdigest()
+        return [digest[2 * level:2 * level + 2]
+                for level in range(self._shard_levels)]
+
+    def _get_disk_directory(self, disk_filename):
+        return os_path.join(self._storage_directory,
+                            *self._get_shard_names(disk_filename))
+
+    def _get_disk_fullname(self, disk_filename):
+        return os_path.join(self._get_disk_directory(disk_filename),
+                            disk_filename)
+
+    def _create_shard_dir(self, fullname):
+        if self._shard_levels != 0:
+            os_makedirs(os_path.dirname(fullname), 0o755, exist_ok=True)
+
+    # Returns lists of shard directories found on disk for each level
+    def _find_shard_dirs(self):
+        levels = []
+        directories = [self._storage_directory]
+        for level in range(MAX_SHARD_LEVELS):
+            directories = [entry.path
+                           for directory in directories
+                           for entry in os_scandir(directory)
+                           if entry.is_dir() and
+                           SHARD_NAME_RE.match(entry.name)]
+            if not directories:
+                break
+            levels.append(directories)
+        return levels
+
+    # Returns records of all stored files. Files stored with other layout
+    # (flat or other shard levels) are moved to locations required by
+    # current layout. This is how flat storage is migrated to sharded one.
+    def _scan_storage(self):
+        shard_dirs = self._find_shard_dirs()
+        records = scan_directory(self._storage_directory)
+        for directories in shard_dirs:
+            for directory in directories:
+                records.extend(scan_directory(directory))
+
+        misplaced = [record for record in records
+                     if record['full_disk_filename'] !=
+                     self._get_disk_fullname(record['disk_filename'])]
+        if not misplaced:
+            return records
+        log('FileStorage: Migrate ' + str(len(misplaced)) +
+            ' files to layout with ' + str(self._shard_levels) +
+            ' shard levels')
+
+        # Files named like shard directories are moved through
+        # temp directory since their names may clash with directories
+        staged = []
+        for record in misplaced:
+            if SHARD_NAME_RE.match(record['disk_filename']):
+                staged_fullname = os_path.join(
+                    self._temp_directory,
+                    uuid4().hex + '.' + record['disk_filename'])
+                os_rename(record['full_disk_filename'], staged_fullname)
+                record['full_disk_filename'] = staged_fullname
+                staged.append(record)
+            else:
+                self._move_to_layout(record)
+
+        # Remove shard directories left empty (deepest first)
+        for directories in reversed(shard_dirs):
+            for directory in directories:
+                try:
+                    os_rmdir(directory)
+                except OSError:
+                    pass
+
+        for record in staged:
+            self._move_to_layout(record)
+
+        return [record for record in records
+                if record['full_disk_filename'] ==
+                self._get_disk_fullname(record['disk_filename'])]
+
+    def _move_to_layout(self, record):
+        fullname = self._get_disk_fullname(record['disk_filename'])
+        self._create_shard_dir(fullname)
+        if os_path.exists(fullname):
+            logger.warning('FileStorage: Cannot migrate "' +
+                           record['full_disk_filename'] +
+                           '": destination file already exists')
+            return
+        os_rename(record['full_disk_filename'], fullname)
+        record['full_disk_filename'] = fullname
+
+    def _get_upload_session_files(self, session_id, disk_filename):
+        temp_fullname = os_path.join(self._temp_directory,
+                                     session_id + '.' + disk_filename)
+        state_fullname = os_path.join(
+            self._temp_directory, session_id + UPLOAD_SESSION_STATE_SUFFIX)
+        return [temp_fullname, state_fullname]
+
+    def _make_upload_session(self, session_id, header, ranges):
+        disk_filename = FileStorage._fname_original_to_disk(header['filename'])
+        temp_fullname, state_fullname = \
+            self._get_upload_session_files(session_id, disk_filename)
+        hash_factory = HASH_ALGORITHMS[self._hash_algorithm] \
+            if self._hash_algorithm != '' else None
+        return UploadSession(session_id, temp_fullname,
+                             self._get_disk_fullname(disk_filename),
+                             state_fullname, header, ranges,
+                             lambda session: self._commit_file(
+                                 session, header['filename']),
+                             hash_factory, self._durability != 'none',
+                             self._grow_file)
+
+    def _load_index(self):
+        records = self._read_journal_records()
+        if records is None:
+            # Hash and original name of files stored without journal
+            # are unknown. Hardlinks without known hash are counted
+            # separately until they are replaced.
+            records = self._scan_storage()
+            source = 'storage directory'
+        else:
+            # Journal may be outdated after crash or manual changes
+            self._reconcile_pending = True
+            source = 'journal'
+        with self._protect_files:
+            self._index_clear(False)
+            for record in records:
+                self._complete_record(record)
+                self._index_add(record, False)
+        log('FileStorage: Index loaded from ' + source + ': ' +
+            str(len(records)) + ' files')
+
+    # Returns list of records or None if journal is missing or it was
+    # written for other storage layout
+    def _read_journal_records(self):
+        try:
+            with io_open(self._journal_fullname, 'rb') as fp:
+                lines = fp.read().splitlines()
+        except FileNotFoundError:
+            return None
+        if not lines:
+            return None
+        try:
+            header = json_loads(lines[0].decode('utf-8'))
+        except ValueError:
+            return None
+        if header.get('op') != 'header' or \
+                header.get('version') != JOURNAL_VERSION or \
+                header.get('shard_levels') != self._shard_levels:
+            return None
+        records = {}
+        for line in lines[1:]:
+            try:
+                change = json_loads(line.decode('utf-8'))
+            except ValueError:
+                # the last line may be incomplete after crash
+                logger.warning('FileStorage: Journal is damaged')
+                break
+            if change['op'] == 'add':
+                record = change['record']
+                records[record['disk_filename']] = record
+            elif change['op'] == 'remove':
+                records.pop(change['name'], None)
+            elif change['op'] == 'clear':
+                records.clear()
+        return list(records.values())
+
+    # Makes index consistent with storage directory content:
+    # adds files missing in index and removes records of missing files
+    def _reconcile_index(self):
+        self._reconcile_pending = False
+        records = {record['disk_filename']: record
+                   for record in self._scan_storage()}
+        added = 0
+        removed = 0
+        with self._protect_files:
+            for disk_filename, record in list(self._files.items()):
+                disk_record = records.pop(disk_filename, None)
+                if disk_record is None:
+                    # file may be stored after scan
+                    if not os_path.isfile(record['full_disk_filename']):
+                        self._index_remove(disk_filename)
+                        removed += 1
+                elif disk_record['size'] != record['size']:
+                    disk_record['original_filename'] = \
+                        record['original_filename']
+                    self._complete_record(disk_record)
+                    self._index_add(disk_record)
+                    added += 1
+            for disk_filename, record in records.items():
+                # file may be removed after scan
+                if os_path.isfile(record['full_disk_filename']):
+                    self._complete_record(record)
+                    self._index_add(record)
+                    added += 1
+        log('FileStorage: Index reconciled: ' + str(added) + ' added, ' +
+            str(removed) + ' removed')
+
+    def _commit_file(self, atomic_file, original_filename):
+        self._sync_journal()
+        fullname = atomic_file.final_filename
+        digest = atomic_file.hexdigest
+        if not (self._deduplicate and digest is not None and
+                self._link_duplicate(atomic_file.temp_filename, fullname,
+                                     digest)):
+            os_rename(atomic_file.temp_filename, fullname)
+        if self._durability == 'dir':
+            sync_directory(os_path.dirname(fullname))
+        record = make_file_record(fullname, os_stat(fullname))
+        record['original_filename'] = original_filename
+        if digest is not None:
+            record['hash'] = digest
+            record['hash_algorithm'] = self._hash_algorithm
+        self._complete_record(record)
+        with self._protect_files:
+            self._index_add(record)
+            self._release_reservation(atomic_file.temp_filename)
+
+    def _abort_file(self, atomic_file):
+        self._release_space(atomic_file.temp_filename)
+
+    # Reserves space for file (AtomicFile or UploadSession) growing to
+    # size bytes beyond its declared size, so quota is not exceeded by
+    # uploads of unknown size. Raises StorageFullError if there is not
+    # enough space anyway.
+    def _grow_file(self, file, size):
+        with self._protect_files:
+            reserved = self._reservations.get(file.temp_filename, 0)
+        if size > reserved:
+            self._reserve_space(file.temp_filename, size - reserved)
+
+    def _reserve_space(self, temp_fullname, size):
+        if size is None:
+            size = 0
+        if not self._make_room(size, temp_fullname):
+            raise StorageFullError('Not enough storage space', size)
+
+    def _release_space(self, temp_fullname):
+        with self._protect_files:
+            self._release_reservation(temp_fullname)
+
+    # Must be called under self._protect_files lock
+    def _release_reservation(self, temp_fullname):
+        self._reserved_size -= self._reservations.pop(temp_fullname, 0)
+
+    # Evicts oldest files until size bytes fit into quota and free space
+    # watermark. On success size is added to space reserved for temp file
+    # if it is specified. Returns False if there is not enough space
+    # anyway.
+    def _make_room(self, size, temp_fullname=None):
+        if 0 < self._max_storage_bytes < size:
+            return False
+        self._sync_journal()
+        while True:
+            with self._protect_files:
+                if self._has_room(size):
+                    if temp_fullname is not None and size > 0:
+                        self._reservations[temp_fullname] = \
+                            self._reservations.get(temp_fullname, 0) + size
+                        self._reserved_size += size
+                    return True
+                # don't evict files if it doesn't help anyway
+                record = self._pop_oldest_file() \
+                    if self._can_make_room(size) else None
+            if record is None:
+                log('FileStorage: Not enough space for ' + str(size) +
+                    ' bytes')
+                return False
+            evicted_files_total.inc()
+            log('FileStorage: Evict file: "' + record['disk_filename'] +
+                '"; size: ' + str(record['size']))
+            try:
+                os_remove(record['full_disk_filename'])
+            except FileNotFoundError:
+                pass
+
+    # Must be called under self._protect_files lock
+    def _has_room(self, size):
+        if self._max_storage_bytes > 0 and self._max_storage_bytes < \
+                self._total_size + self._reserved_size + size:
+            return False
+        if self._min_free_bytes > 0 and self._min_free_bytes > \
+                shutil_disk_usage(self._storage_directory).free - size:
+            return False
+        return True
+
+    # Returns False if size bytes don't fit even if all stored files are
+    # evicted. Must be called under self._protect_files lock.
+    def _can_make_room(self, size):
+        if self._max_storage_bytes > 0 and self._max_storage_bytes < \
+                self._reserved_size + size:
+            return False
+        if self._min_free_bytes > 0 and self._min_free_bytes > \
+                shutil_disk_usage(self._storage_directory).free + \
+                self._total_size - size:
+            return False
+        return True
+
+    # Must be called under self._protect_files lock
+    def _pop_oldest_file(self):
+        while self._expiry_queue:
+            deadline, disk_filename = heappop(self._expiry_queue)
+            record = self._files.get(disk_filename)
+            # Skip entries of removed or replaced files:
+            if record is not None and \
+                    self._get_deadline(record) == deadline:
+                return self._index_remove(disk_filename)
+        return None
+
+    # Replaces temp file with hardlink to already stored file
+    # with the same content. Returns False if there is no such file.
+    def _link_duplicate(self, temp_fullname, fullname, digest):
+        with self._protect_files:
+            references = self._blobs.get((self._hash_algorithm, digest), [])
+            candidates = [self._files[disk_filename]
+                          for disk_filename in references]
+        size = os_path.getsize(temp_fullname)
+        for candidate in candidates:
+            if candidate['size'] != size:
+                continue
+            try:
+                os_link(candidate['full_disk_filename'], fullname)
+            except OSError:
+                # file is removed meanwhile or hardlinks are not supported
+                continue
+            os_remove(temp_fullname)
+            # Hardlinks share modification time. Update it, so after restart
+            # the blob is not treated as older than its latest upload.
+            # Files already in index keep their own upload time.
+            os_utime(fullname)
+            log('FileStorage: Deduplicated "' +
+                os_path.basename(fullname) + '" with "' +
+                candidate['disk_filename'] + '"; size: ' + str(size))
+            return True
+        return False
+
+    # Must be called under self._protect_files lock.
+    # publish is False for changes read from journal, version is their
+    # journal offset then.
+    def _index_add(self, record, publish=True, version=0):
+        disk_filename = record['disk_filename']
+        if disk_filename in self._files:
+            # file is replaced
+            self._index_remove(disk_filename, False)
+        if publish:
+            version = self._append_journal(
+                {'op': 'add', 'record': self._journal_record(record)})
+        self._add_listing_change(version, disk_filename)
+        self._files[disk_filename] = record
+        is_new_blob = True
+        if record['hash'] is not None:
+            blob_key = (record['hash_algorithm'], record['hash'])
+            references = self._blobs.setdefault(blob_key, set())
+            is_new_blob = not (self._deduplicate and references)
+            references.add(disk_filename)
+        if is_new_blob:
+            self._total_size += record['size']
+        self._push_expiry(self._get_deadline(record), disk_filename)
+
+    # Must be called under self._protect_files lock
+    def _push_expiry(self, deadline, disk_filename):
+        heappush(self._expiry_queue, (deadline, disk_filename))
+        if len(self._expiry_queue) > max(2 * len(self._files),
+                                         EXPIRY_QUEUE_MIN_REBUILD_SIZE):
+            self._expiry_queue = [
+                (self._get_deadline(record), name)
+                for name, record in self._files.items()]
+            heapify(self._expiry_queue)
+        if self._expiry_queue[0][1] == disk_filename:
+            self._condition_schedule.notify()
+
+    # Must be called under self._protect_files lock.
+    # Blob data is freed by file system when its last hardlink is removed,
+    # so the index only tracks references.
+    def _index_remove(self, disk_filename, publish=True, version=0):
+        record = self._files.pop(disk_filename, None)
+        if record is None:
+            return record
+        if publish:
+            version = self._append_journal({'op': 'remove',
+                                            'name': disk_filename})
+        self._add_listing_change(version, disk_filename)
+        if record['hash'] is None:
+            self._total_size -= record['size']
+            return record
+        blob_key = (record['hash_algorithm'], record['hash'])
+        references = self._blobs.get(blob_key)
+        if references is not None:
+            references.discard(disk_filename)
+            if not references:
+                del self._blobs[blob_key]
+                if self._deduplicate:
+                    log('FileStorage: Last reference to blob ' +
+                        record['hash'] + ' is removed')
+        if not (self._deduplicate and references):
+            self._total_size -= record['size']
+        return record
+
+    # Must be called under self._protect_files lock
+    def _index_clear(self, publish=True, version=0):
+        if publish:
+            version = self._append_journal({'op': 'clear'})
+        self._reset_listing_changes(version)
+        self._files.clear()
+        self._blobs.clear()
+        self._expiry_queue = []
+        self._total_size = 0
+
+    # Must be called under self._protect_files lock
+    def _make_listing_version(self):
+        return self._journal_epoch + ':' + str(self._journal_offset)
+
+    # Must be called under self._protect_files lock
+    def _add_listing_change(self, version, disk_filename):
+        if version <= self._changes_horizon:
+            return
+        # Changes of other processes may be applied after own later ones
+        index = bisect_right(self._change_versions, version)
+        self._change_versions.insert(index, version)
+        self._change_names.insert(index, disk_filename)
+        if len(self._change_versions) > 2 * MAX_LISTING_CHANGES:
+            count = len(self._change_versions) - MAX_LISTING_CHANGES
+            self._changes_horizon = self._change_versions[count - 1]
+            del self._change_versions[:count]
+            del self._change_names[:count]
+
+    # Must be called under self._protect_files lock
+    def _reset_listing_changes(self, horizon):
+        self._change_versions = []
+        self._change_names = []
+        self._changes_horizon = horizon
+
+    def _journal_record(self, record):
+        return {field: record[field] for field in JOURNAL_RECORD_FIELDS}
+
+    # Must be called under self._protect_files lock.
+    # Returns journal offset after the change.
+    def _append_journal(self, change):
+        change['writer'] = self._get_journal_writer_id()
+        data = (json_dumps(change) + '\n').encode('utf-8')
+        while True:
+            fd = os_open(self._journal_fullname,
+                         os_O_WRONLY | os_O_APPEND | os_O_CREAT | os_O_BINARY,
+                         0o644)
+            try:
+                if self._shared and fcntl_flock is not None:
+                    # Shared lock: appends of different processes don't
+                    # block each other but compaction waits for them
+                    fcntl_flock(fd, fcntl_LOCK_SH)
+                    if os_fstat(fd).st_ino != \
+                            os_stat(self._journal_fullname).st_ino:
+                        continue  # journal is just replaced by compaction
+                # Appending single write() call is atomic, so lines of
+                # different processes are not mixed
+                os_write(fd, data)
+                version = os_lseek(fd, 0, os_SEEK_CUR)
+                if self._durability != 'none':
+                    os_fsync(fd)
+            finally:
+                os_close(fd)
+            break
+        if not self._shared:
+            # the only writer: journal is applied up to its end
+            self._journal_offset = version
+        self._journal_changes += 1
+        if self._is_compaction_due():
+            self._condition_schedule.notify()
+        return version
+
+    # Instance copies in forked processes are different writers
+    def _get_journal_writer_id(self):
+        return self._instance_id + '.' + str(os_getpid())
+
+    # Must be called under self._protect_files lock
+    def _is_compaction_due(self):
+        return self._journal_changes > \
+            max(JOURNAL_COMPACT_MIN_CHANGES, len(self._files))
+
+    # Applies index changes made by other processes. It is called before
+    # index is used, so listing is consistent whichever process serves it.
+    # Stat call is the only overhead when there are no changes.
+    def _sync_journal(self):
+        if not self._shared:
+            return
+        with self._protect_journal:
+            try:
+                stat_result = os_stat(self._journal_fullname)
+            except FileNotFoundError:
+                return
+            if stat_result.st_ino == self._journal_inode and \
+                    stat_result.st_size <= self._journal_offset:
+                return
+            with self._protect_files:
+                self._read_journal_changes()
+
+    # Must be called under self._protect_journal and self._protect_files
+    # locks
+    def _read_journal_changes(self):
+        writer_id = self._get_journal_writer_id()
+        with io_open(self._journal_fullname, 'rb') as fp:
+            inode = os_fstat(fp.fileno()).st_ino
+            if inode != self._journal_inode:
+                # Journal is compacted by other process. Index is rebuilt
+                # including own changes.
+                self._index_clear(False)
+                self._journal_offset = 0
+                self._journal_inode = inode
+                writer_id = None
+            fp.seek(self._journal_offset)
+            data = fp.read()
+        # the last line may be incomplete:
+        data = data[:data.rfind(b'\n') + 1]
+        version = self._journal_offset
+        self._journal_offset += len(data)
+        for line in data.splitlines(True):
+            version += len(line)
+            change = json_loads(line.decode('utf-8'))
+            if change['op'] == 'header':
+                self._journal_epoch = change.get('epoch', '')
+                self._reset_listing_changes(version)
+                continue
+            self._journal_changes += 1
+            if change.get('writer') == writer_id:
+                continue
+            if change['op'] == 'add':
+                record = change['record']
+                self._complete_record(record)
+                self._index_add(record, False, version)
+            elif change['op'] == 'remove':
+                self._index_remove(change['name'], False, version)
+            elif change['op'] == 'clear':
+                self._index_clear(False, version)
+
+    # Rewrites journal with single 'add' change per stored file. Index
+    # snapshot is written and flushed to disk without index lock, so
+    # uploads and listing are not blocked meanwhile. Changes appended to
+    # old journal after the snapshot are copied to the new one before it
+    # replaces the old journal.
+    def _compact_journal(self):
+        with self._protect_journal, self._protect_files:
+            if self._shared and self._journal_inode is not None:
+                self._read_journal_changes()
+            # Index is snapshot of journal up to this offset. Inode is None
+            # before journal is read: index is loaded from the whole one.
+            offset = self._journal_offset
+            inode = self._journal_inode
+            records = [self._journal_record(record)
+                       for record in self._files.values()]
+        epoch = uuid4().hex[:8]
+        lines = [json_dumps({'op': 'header',
+                             'version': JOURNAL_VERSION,
+                             'shard_levels': self._shard_levels,
+                             'epoch': epoch})]
+        writer_id = self._get_journal_writer_id()
+        for record in records:
+            lines.append(json_dumps({
+                'op': 'add',
+                'record': record,
+                'writer': writer_id,
+                }))
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        temp_fullname = self._journal_fullname + '.tmp'
+        self._write_journal_file(temp_fullname, data, 'wb')
+
+        with self._protect_journal, self._protect_files:
+            lock_fd = None
+            if self._shared and fcntl_flock is not None and \
+                    os_path.isfile(self._journal_fullname):
+                # waits until appends of other processes are finished
+                lock_fd = os_open(self._journal_fullname,
+                                  os_O_RDONLY | os_O_BINARY)
+                fcntl_flock(lock_fd, fcntl_LOCK_EX)
+            try:
+                if lock_fd is not None and inode is not None:
+                    self._read_journal_changes()
+                if self._journal_inode != inode:
+                    # journal is compacted by other process meanwhile
+                    os_remove(temp_fullname)
+                    return
+                tail = b''
+                if inode is not None and self._journal_offset > offset:
+                    with io_open(self._journal_fullname, 'rb') as fp:
+                        fp.seek(offset)
+                        tail = fp.read(self._journal_offset - offset)
+                    self._write_journal_file(temp_fullname, tail, 'ab')
+                os_replace(temp_fullname, self._journal_fullname)
+                if self._durability == 'dir':
+                    sync_directory(self._metadata_directory)
+                size = len(data) + len(tail)
+                self._journal_offset = size
+                self._journal_inode = os_stat(self._journal_fullname).st_ino
+                changes = self._journal_changes = tail.count(b'\n')
+                # listing versions of previous epoch become unknown
+                self._journal_epoch = epoch
+                self._reset_listing_changes(size)
+            finally:
+                if lock_fd is not None:
+                    os_close(lock_fd)
+        log('FileStorage: Journal is compacted: ' + str(len(records)) +
+            ' files, ' + str(changes) + ' changes appended')
+
+    def _write_journal_file(self, fullname, data, mode):
+        with io_open(fullname, mode) as fp:
+            fp.write(data)
+            if self._durability != 'none':
+                fp.flush()
+                os_fsync(fp.fileno())
+
+    # Must be called under self._protect_files lock
+    def _schedule_temp_file(self, temp_fullname, deadline):
+        if self._shared:
+            return  # see _sweep_temp_files()
+        heappush(self._temp_expiry_queue, (deadline, temp_fullname))
+        if self._temp_expiry_queue[0][1] == temp_fullname:
+            self._condition_schedule.notify()
+
+    def _get_deadline(self, record):
+        return record['expires']
+
+    def _schedule_existing_temp_files(self):
+        # Temp files left from previous run are swept
+        # after usual idle timeout.
+        records = scan_directory(self._temp_directory)
+        with self._protect_files:
+            for record in records:
+                self._schedule_temp_file(
+                    record['full_disk_filename'],
+                    record['modified'] + TEMP_FILE_MAX_IDLE_SECONDS)
+
     def _create_dirs(self):
         if not os_path.isdir(self._storage_directory):
             os_makedirs(self._storage_directory, 0o755)
@@ -180,49 +1795,231 @@ class FileStorage:
         if not os_path.isdir(self._temp_directory):
             os_makedirs(self._temp_directory, 0o755)
 
+        if not os_path.isdir(self._metadata_directory):
+            os_makedirs(self._metadata_directory, 0o755)
+
     def _retension_thread_procedure(self):
         log('FileStorage: Retension thread started')
-        previous_check_time = 0
+        if self._reconcile_pending:
+            try:
+                self._reconcile_index()
+            except Exception:
+                logger.error(traceback_format_exc())
         while True:
             try:
-                now = time_time()
-                if now - previous_check_time > 10 * 60:  # every 10 minutes
-                    log('FileStorage: Check for outdated files')
-                    previous_check_time = time_time()
-                    self._check_retention()
-
-                # Wait for 60 seconds with a possibility
-                # to be interrupted through stop() call:
-                with self._condition_stop:
-                    if not self._stopping:
-                        self._condition_stop.wait(60)
+                with self._condition_schedule:
                     if self._stopping:
                         log('Retension thread found stop signal')
                         break
+                    # Sleep exactly until the nearest deadline with
+                    # a possibility to be interrupted through stop() call
+                    # or by earlier deadline:
+                    timeout = self._get_time_to_next_deadline()
+                    if self._shared and (timeout is None or
+                                         timeout > JOURNAL_POLL_SECONDS):
+                        # new files may be stored by other processes
+                        timeout = JOURNAL_POLL_SECONDS
+                    compact = self._is_compaction_due()
+                    if not compact and (timeout is None or timeout > 0):
+                        self._condition_schedule.wait(timeout)
+                        if not self._shared:
+                            continue
+                # Journal of shared storage is polled often, it is not
+                # a retention pass itself
+                self._sync_journal()
+                with self._condition_schedule:
+                    due = self._is_retention_due()
+                if due:
+                    with retention_pass_duration.time():
+                        self._remove_expired_files()
+                        self._sweep_temp_files()
+                if compact:
+                    self._compact_journal()
             except Exception:
-                logging_error(traceback_format_exc())
-                time_sleep(60)  # prevent from flooding
+                logger.error(traceback_format_exc())
+                # prevent from flooding:
+                with self._condition_schedule:
+                    if not self._stopping:
+                        self._condition_schedule.wait(60)
+
+    # Returns True if some file is expired or temp directory sweep is
+    # due. Must be called under self._protect_files lock.
+    def _is_retention_due(self):
+        timeout = self._get_time_to_next_deadline()
+        return (timeout is not None and timeout <= 0) or \
+            (self._shared and time_time() >= self._next_temp_sweep)
 
-    def _check_retention(self):
+    # Must be called under self._protect_files lock
+    def _get_time_to_next_deadline(self):
+        deadlines = [queue[0][0]
+                     for queue in [self._expiry_queue, self._temp_expiry_queue]
+                     if queue]
+        if not deadlines:
+            return None
+        return min(deadlines) - time_time()
+
+    def _remove_expired_files(self):
         now = time_time()
-        if not os_path.isdir(self._storage_directory):
+        outdated = []
+        outdated_temp = []
+        with self._protect_files:
+            while self._expiry_queue and self._expiry_queue[0][0] <= now:
+                deadline, disk_filename = heappop(self._expiry_queue)
+                record = self._files.get(disk_filename)
+                # Skip entries of removed or replaced files:
+                if record is not None and \
+                        self._get_deadline(record) == deadline:
+                    self._index_remove(disk_filename)
+                    outdated.append(record)
+            while self._temp_expiry_queue and \
+                    self._temp_expiry_queue[0][0] <= now:
+                deadline, fullname = heappop(self._temp_expiry_queue)
+                outdated_temp.append(fullname)
+
+        expired_files_total.inc(len(outdated))
+        for record in outdated:
+            log('FileStorage: Remove outdated file: ' +
+                record['full_disk_filename'] +
+                '"; size: ' + str(record['size']))
+            try:
+                os_remove(record['full_disk_filename'])
+            except FileNotFoundError:
+                pass
+
+        for fullname in outdated_temp:
+            self._check_temp_file(fullname, now)
+
+    # Watches are added before index is reconciled, so no change is missed
+    def _start_watcher(self):
+        if not is_inotify_available():
+            logger.warning('FileStorage: inotify is not available, '
+                           'storage directory is not watched')
             return
-        for file in os_listdir(self._storage_directory):
-            fullname = os_path.join(self._storage_directory, file)
-            if os_path.isfile(fullname):
-                modified_unixtime = get_file_modified_unixtime(fullname)
-                if now - modified_unixtime > self._max_store_time_seconds:
-                    log('FileStorage: Remove outdated file: ' + fullname +
-                        '"; size: ' + str(os_path.getsize(fullname)))
-                    os_remove(fullname)
+        self._watcher = InotifyWatcher()
+        self._watcher.add_watch(self._temp_directory)
+        self._watch_directory(self._storage_directory, 0, False)
+        self._watcher_thread = \
+            threading.Thread(target=self._watcher_thread_procedure)
+        self._watcher_thread.start()
 
-        if not os_path.isdir(self._temp_directory):
+    # Watches directory and its shard subdirectories. If index_files is
+    # True files found in them are added to index (they could be created
+    # before watch was added).
+    def _watch_directory(self, directory, level, index_files):
+        self._watcher.add_watch(directory)
+        self._watched_levels[directory] = level
+        for entry in os_scandir(directory):
+            if level < self._shard_levels and entry.is_dir() and \
+                    SHARD_NAME_RE.match(entry.name):
+                self._watch_directory(entry.path, level + 1, index_files)
+            elif index_files and entry.is_file():
+                self._on_file_added(entry.path)
+
+    def _watcher_thread_procedure(self):
+        log('FileStorage: Watcher thread started')
+        while not self._stopping:
+            try:
+                self._watcher.read_events(self._on_storage_event,
+                                          WATCHER_POLL_SECONDS)
+            except Exception:
+                logger.error(traceback_format_exc())
+                # prevent from flooding:
+                with self._condition_schedule:
+                    if not self._stopping:
+                        self._condition_schedule.wait(60)
+        self._watcher.close()
+        log('FileStorage: Watcher thread stopped')
+
+    def _on_storage_event(self, directory, name, mask, cookie):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('FileStorage: Watcher events are lost')
+            self._reconcile_index()
             return
-        for file in os_listdir(self._temp_directory):
-            fullname = os_path.join(self._temp_directory, file)
-            if os_path.isfile(fullname):
-                modified_unixtime = get_file_modified_unixtime(fullname)
-                if now - modified_unixtime > 15 * 60:  # every 15 minutes
-                    log('FileStorage: Remove outdated temp file: ' + fullname +
-                        '"; size: ' + str(os_path.getsize(fullname)))
-                    os_remove(fullname)
+        fullname = os_path.join(directory, name)
+        if directory == self._temp_directory:
+            if mask & IN_MOVED_FROM:
+                if len(self._commit_cookies) > 1000:
+                    self._commit_cookies.clear()
+                self._commit_cookies.add(cookie)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self._on_temp_file_removed(fullname)
+            return
+        level = self._watched_levels.get(directory)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and level is not None and \
+                    level < self._shard_levels and SHARD_NAME_RE.match(name):
+                self._watch_directory(fullname, level + 1, True)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            if mask & IN_MOVED_TO and cookie in self._commit_cookies:
+                self._commit_cookies.discard(cookie)
+                return
+            self._on_file_added(fullname)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._on_file_removed(fullname)
+
+    def _on_file_added(self, fullname):
+        disk_filename = os_path.basename(fullname)
+        if clean_filename(disk_filename) != disk_filename or \
+                self._get_disk_fullname(disk_filename) != fullname:
+            return  # file can't be served by its name
+        try:
+            stat_result = os_stat(fullname)
+        except FileNotFoundError:
+            return
+        with self._protect_files:
+            record = self._files.get(disk_filename)
+            if record is not None and record['size'] == stat_result.st_size:
+                return
+            record = make_file_record(fullname, stat_result)
+            self._complete_record(record)
+            self._index_add(record)
+        log('FileStorage: File is added externally: "' + disk_filename +
+            '"; size: ' + str(record['size']))
+
+    def _on_file_removed(self, fullname):
+        if os_path.exists(fullname):
+            return  # file is replaced meanwhile
+        disk_filename = os_path.basename(fullname)
+        with self._protect_files:
+            record = self._files.get(disk_filename)
+            if record is None or record['full_disk_filename'] != fullname:
+                return
+            self._index_remove(disk_filename)
+        log('FileStorage: File is removed externally: "' + disk_filename +
+            '"')
+
+    def _on_temp_file_removed(self, fullname):
+        self._release_space(fullname)
+        if fullname.endswith(UPLOAD_SESSION_STATE_SUFFIX):
+            session_id = os_path.basename(fullname).split('.')[0]
+            with self._protect_files:
+                self._upload_sessions.pop(session_id, None)
+
+    def _sweep_temp_files(self):
+        now = time_time()
+        if not self._shared or now < self._next_temp_sweep:
+            return
+        self._next_temp_sweep = now + TEMP_SWEEP_SECONDS
+        for record in scan_directory(self._temp_directory):
+            self._check_temp_file(record['full_disk_filename'], now)
+
+    def _check_temp_file(self, fullname, now):
+        try:
+            modified_unixtime = get_file_modified_unixtime(fullname)
+        except FileNotFoundError:
+            return  # upload is already committed or removed
+        deadline = modified_unixtime + TEMP_FILE_MAX_IDLE_SECONDS
+        if deadline > now:
+            # upload is still in progress
+            with self._protect_files:
+                self._schedule_temp_file(fullname, deadline)
+            return
+        log('FileStorage: Remove outdated temp file: ' + fullname +
+            '"; size: ' + str(os_path.getsize(fullname)))
+        os_remove(fullname)
+        swept_temp_files_total.inc()
+        self._release_space(fullname)
+        if fullname.endswith(UPLOAD_SESSION_STATE_SUFFIX):
+            session_id = os_path.basename(fullname).split('.')[0]
+            with self._protect_files:
+                self._upload_sessions.pop(session_id, None)
@@ -0,0 +1,245 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+from email.utils import formatdate as email_formatdate, \
+                        mktime_tz as email_mktime_tz, \
+                        parsedate_tz as email_parsedate_tz
+from uuid import uuid4
+
+
+# Requests with more ranges are served as whole file
+MAX_RANGES_COUNT = 16
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Default bounds of adaptive request body chunk size
+UPLOAD_MIN_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_CHUNK_SIZE = 1024 * 1024
+
+
+def http_date(unixtime):
+    return email_formatdate(unixtime, usegmt=True)
+
+
+def parse_http_date(value):
+    try:
+        return email_mktime_tz(email_parsedate_tz(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _parse_etags(value):
+    return [etag.strip() for etag in value.split(',')]
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+# Conditional GET check (RFC 7232). If-None-Match takes precedence
+# over If-Modified-Since.
+def is_not_modified(environ, etag, modified_unixtime):
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        etags = _parse_etags(if_none_match)
+        # weak comparison:
+        return '*' in etags or _strip_weak(etag) in map(_strip_weak, etags)
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        since = parse_http_date(if_modified_since)
+        return since is not None and int(modified_unixtime) <= since
+    return False
+
+
+# Returns True if Range header should be applied according to If-Range
+def if_range_matches(environ, etag, modified_unixtime):
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # strong comparison:
+        return etag is not None and not etag.startswith('W/') and \
+            if_range == etag
+    return parse_http_date(if_range) == int(modified_unixtime)
+
+
+# Parses Range header value. Returns list of [offset, length] pairs of
+# satisfiable ranges (empty list means nothing is satisfiable)
+# or None if header is missing, malformed or should be ignored.
+def parse_range_header(value, size):
+    if value is None:
+        return None
+    unit, _, ranges_spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = ranges_spec.split(',')
+    if len(specs) > MAX_RANGES_COUNT:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        if dash != '-':
+            return None
+        try:
+            if first == '':
+                # suffix range: last N bytes
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                start = max(0, size - suffix)
+                end = size
+            else:
+                start = int(first)
+                end = size if last == '' else int(last) + 1
+                if start < 0 or (last != '' and end <= start):
+                    return None
+        except ValueError:
+            return None
+        end = min(end, size)
+        if start < end:
+            ranges.append([start, end - start])
+    return ranges
+
+
+def content_range(offset, length, size):
+    return 'bytes %d-%d/%d' % (offset, offset + length - 1, size)
+
+
+def iter_file_range(fp, offset, length):
+    fp.seek(offset)
+    while length > 0:
+        chunk = fp.read(min(DOWNLOAD_BLOCK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+# Read-only file-like object limited to single range of a file.
+# WSGI servers supporting wsgi.file_wrapper may transmit it with sendfile()
+# using fileno(), offset and length. Other servers just read() it.
+class FileRange:
+    # on_close() is called when server closes response body
+    def __init__(self, fp, offset, length, on_close=None):
+        self._fp = fp
+        self._offset = offset
+        self._length = length
+        self._remaining = length
+        self._on_close = on_close
+        fp.seek(offset)
+
+    @property
+    def file(self):
+        return self._fp
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def length(self):
+        return self._length
+
+    def fileno(self):
+        return self._fp.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fp.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._fp.close()
+        if self._on_close is not None:
+            on_close = self._on_close
+            self._on_close = None
+            on_close()
+
+
+# Request body is shorter than Content-Length (e.g. client disconnected)
+class IncompleteBodyError(Exception):
+    pass
+
+
+# Reads request body by chunks. Body is limited by Content-Length since
+# some WSGI servers (e.g. wsgiref) do not signal end of body to application.
+# Without Content-Length body is read till the end of stream.
+# IncompleteBodyError is raised if stream ends before Content-Length.
+# Chunk size is adaptive: it grows while reads return full chunks (data
+# arrives faster than it is processed) and shrinks on short reads.
+# If reuse_buffer is True and server supports readinto() chunks are
+# memoryview slices of single preallocated buffer. Such chunk is valid
+# only until the next one is requested. Otherwise chunks are bytes.
+def iter_request_body(environ, reuse_buffer=False,
+                      min_chunk_size=UPLOAD_MIN_CHUNK_SIZE,
+                      max_chunk_size=UPLOAD_MAX_CHUNK_SIZE):
+    content_length = environ.get('CONTENT_LENGTH')
+    remaining = int(content_length) if content_length else None
+    stream = environ['wsgi.input']
+    readinto = getattr(stream, 'readinto', None) if reuse_buffer else None
+    if readinto is not None:
+        buffer = memoryview(bytearray(max_chunk_size))
+    chunk_size = min(min_chunk_size, max_chunk_size)
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        if readinto is not None:
+            length = readinto(buffer[:size]) or 0
+            chunk = buffer[:length]
+        else:
+            chunk = stream.read(size)
+            length = len(chunk)
+        if length == 0:
+            if remaining is not None:
+                raise IncompleteBodyError('Request body is incomplete',
+                                          remaining)
+            break
+        if remaining is not None:
+            remaining -= length
+        yield chunk
+        if length == size:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+        elif length < size // 2:
+            chunk_size = max(chunk_size // 2, min_chunk_size)
+
+
+# File is closed when WSGI server closes response iterable
+def iter_and_close(fp, iterable):
+    try:
+        for chunk in iterable:
+            yield chunk
+    finally:
+        fp.close()
+
+
+# Builds multipart/byteranges body. Returns
+# [content type, content length, body iterator]
+def multipart_byteranges(fp, ranges, size, content_type):
+    boundary = uuid4().hex
+    part_headers = []
+    for offset, length in ranges:
+        part_headers.append(
+            ('--' + boundary + '\r\n' +
+             'Content-Type: ' + content_type + '\r\n' +
+             'Content-Range: ' + content_range(offset, length, size) +
+             '\r\n\r\n').encode('latin-1'))
+    ending = ('--' + boundary + '--\r\n').encode('latin-1')
+    content_length = len(ending) + sum(
+        len(headers) + length + 2
+        for headers, (offset, length) in zip(part_headers, ranges))
+
+    def body():
+        for headers, (offset, length) in zip(part_headers, ranges):
+            yield headers
+            for chunk in iter_file_range(fp, offset, length):
+                yield chunk
+            yield b'\r\n'
+        yield ending
+
+    return ['multipart/byteranges; boundary=' + boundary,
+            content_length, iter_and_close(fp, body())]
@@ -0,0 +1,238 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+import atexit
+from collections import deque
+from json import dumps as json_dumps
+import sys
+import threading
+from time import localtime as time_localtime, \
+                 monotonic as time_monotonic, \
+                 strftime as time_strftime, \
+                 time as time_time
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+_LEVEL_TITLES = {level: name for name, level in LEVEL_NAMES.items()}
+
+_LEVEL_PREFIXES = {
+    DEBUG: 'DBG>',
+    INFO: 'INF>',
+    WARNING: 'WRN>',
+    ERROR: 'ERR>',
+}
+
+# Records are written by background thread with this period.
+# Errors are written at once.
+FLUSH_INTERVAL_SECONDS = 0.1
+
+# Records logged while output is slower than that are dropped (and
+# counted) instead of blocking the caller
+MAX_QUEUED_RECORDS = 10000
+
+
+def _format_field(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    value = str(value)
+    if not value or any(c in value for c in ' "=\n'):
+        return json_dumps(value)
+    return value
+
+
+# Token bucket: allows rate events per second on average and bursts of up
+# to rate events. Not locked: concurrent callers may pass a few extra
+# events, which is fine for logging.
+class RateLimiter:
+    def __init__(self, rate):
+        self._rate = rate
+        self._burst = max(rate, 1)
+        self._tokens = self._burst
+        self._last = time_monotonic()
+
+    def allow(self):
+        now = time_monotonic()
+        tokens = min(self._burst,
+                     self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if tokens < 1:
+            self._tokens = tokens
+            return False
+        self._tokens = tokens - 1
+        return True
+
+
+# Logger writing records by background thread. Caller only appends
+# record (time, level, message arguments and key/value fields) to queue,
+# so slow output doesn't delay requests. Records are formatted as text
+# lines:
+#   INF> 2018-06-15 12:00:00: message key=value ...
+# or as JSON objects (one per line).
+class Logger:
+    def __init__(self, stream=None, level=INFO, json_output=False,
+                 requests_per_second=0,
+                 flush_interval=FLUSH_INTERVAL_SECONDS,
+                 max_queued=MAX_QUEUED_RECORDS):
+        # None means current sys.stdout
+        self._stream = stream
+        self._flush_interval = flush_interval
+        self._max_queued = max_queued
+        self._records = deque()
+        self._dropped = 0
+        self._suppressed_requests = 0
+        self.configure(level, json_output, requests_per_second)
+        self._time_second = None
+        self._time_text = ''
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._protect_thread = threading.Lock()
+        self._protect_write = threading.Lock()
+
+    # level is level number or name ('debug', 'info', 'warning', 'error').
+    # requests_per_second limits request() records, 0 means no limit.
+    def configure(self, level=None, json_output=None,
+                  requests_per_second=None):
+        if level is not None:
+            if not isinstance(level, int):
+                if level.lower() not in LEVEL_NAMES:
+                    raise Exception('Unsupported log level: ' + level)
+                level = LEVEL_NAMES[level.lower()]
+            self._level = level
+        if json_output is not None:
+            self._json_output = json_output
+        if requests_per_second is not None:
+            self._request_limiter = RateLimiter(requests_per_second) \
+                if requests_per_second > 0 else None
+
+    def is_enabled(self, level):
+        return level >= self._level
+
+    # Message arguments are joined by spaces like print() does
+    def log(self, level, *args, **fields):
+        if level < self._level:
+            return
+        if len(self._records) >= self._max_queued:
+            # not locked, may be a bit off
+            self._dropped += 1
+            return
+        self._records.append((time_time(), level, args, fields))
+        if self._thread is None:
+            self._start_thread()
+        if level >= ERROR:
+            self._wakeup.set()
+
+    def debug(self, *args, **fields):
+        self.log(DEBUG, *args, **fields)
+
+    def info(self, *args, **fields):
+        self.log(INFO, *args, **fields)
+
+    def warning(self, *args, **fields):
+        self.log(WARNING, *args, **fields)
+
+    def error(self, *args, **fields):
+        self.log(ERROR, *args, **fields)
+
+    # Per-request record. Records over rate limit are not logged, the
+    # next logged one has number of skipped records in 'suppressed'
+    # field.
+    def request(self, *args, **fields):
+        if INFO < self._level:
+            return
+        limiter = self._request_limiter
+        if limiter is not None and not limiter.allow():
+            self._suppressed_requests += 1
+            return
+        if self._suppressed_requests:
+            fields['suppressed'] = self._suppressed_requests
+            self._suppressed_requests = 0
+        self.log(INFO, *args, **fields)
+
+    # Writes queued records now
+    def flush(self):
+        with self._protect_write:
+            lines = []
+            while self._records:
+                lines.append(self._format(self._records.popleft()))
+            if self._dropped:
+                dropped = self._dropped
+                self._dropped = 0
+                lines.append(self._format([
+                    time_time(), WARNING, ['Log records are dropped'],
+                    {'dropped': dropped}]))
+            if not lines:
+                return
+            stream = self._stream or sys.stdout
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+    # Writes queued records and stops background thread. It is started
+    # again by the next record. Process must have no threads when it is
+    # forked, so this is called before fork.
+    def stop(self):
+        with self._protect_thread:
+            thread = self._thread
+            if thread is not None:
+                self._stopping = True
+                self._wakeup.set()
+                thread.join()
+                self._thread = None
+                self._stopping = False
+        self.flush()
+
+    def _start_thread(self):
+        with self._protect_thread:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._flush_procedure, name='Logger',
+                    daemon=True)
+                self._thread.start()
+
+    def _flush_procedure(self):
+        while not self._stopping:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # nowhere to report
+
+    def _format(self, record):
+        unixtime, level, args, fields = record
+        message = ' '.join(str(arg) for arg in args)
+        if self._json_output:
+            data = {
+                'time': round(unixtime, 3),
+                'level': _LEVEL_TITLES[level],
+                'message': message,
+            }
+            for name, value in fields.items():
+                data[name] = round(value, 6) \
+                    if isinstance(value, float) else value
+            return json_dumps(data, ensure_ascii=False, default=str)
+        second = int(unixtime)
+        if second != self._time_second:
+            self._time_second = second
+            self._time_text = time_strftime('%Y-%m-%d %H:%M:%S:',
+                                            time_localtime(second))
+        return _LEVEL_PREFIXES[level] + ' ' + self._time_text + ' ' + \
+            message + ''.join(' ' + name + '=' + _format_field(value)
+                              for name, value in fields.items())
+
+
+# Logger of the process
+logger = Logger()
+atexit.register(logger.stop)
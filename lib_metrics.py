@@ -0,0 +1,283 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+from bisect import bisect_left
+import threading
+from time import monotonic as time_monotonic
+
+
+# Bucket bounds of duration histograms in seconds
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                    10, 30, 60]
+
+# Bucket bounds of throughput histograms in bytes per second
+THROUGHPUT_BUCKETS = [64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2,
+                      16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2,
+                      1024 ** 3]
+
+
+# Values updated by many threads. Each thread updates its own cell
+# (list of numbers), so updates take no lock and don't contend.
+# Cells of finished threads are kept, so totals are not lost.
+class _ThreadCells:
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._cells = []
+        self._protect_cells = threading.Lock()
+
+    # Returns cell of current thread
+    def get(self):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = [0] * self._size
+            with self._protect_cells:
+                self._cells.append(cell)
+            self._local.cell = cell
+        return cell
+
+    # Returns sums of all cells. Values updated meanwhile may be missed.
+    def sum(self):
+        with self._protect_cells:
+            cells = list(self._cells)
+        return [sum(values) for values in zip(*cells)] or [0] * self._size
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        name + '="' + str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels) + '}'
+
+
+# Base class of metric. Metric with label names has child per label
+# values: metric.labels(value1, ...). Metric without labels is updated
+# directly.
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self._labelnames = tuple(labelnames)
+        self._children = {}
+        self._protect_children = threading.Lock()
+        if not self._labelnames:
+            self._cells = self._make_cells()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self._labelnames):
+                raise Exception('Wrong number of labels', self.name, values)
+            with self._protect_children:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._make_child()
+                    self._children[values] = child
+        return child
+
+    def _make_child(self):
+        child = type(self).__new__(type(self))
+        child.__dict__.update(self.__dict__)
+        child._labelnames = ()
+        child._children = {}
+        child._cells = child._make_cells()
+        return child
+
+    def _make_cells(self):
+        return _ThreadCells(1)
+
+    # Returns list of [labels, child] where labels is list of
+    # [name, value]
+    def _collect_children(self):
+        if not self._labelnames:
+            return [[[], self]]
+        return [[list(zip(self._labelnames, values)), child]
+                for values, child in sorted(self._children.items())]
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description,
+                 '# TYPE ' + self.name + ' ' + self.metric_type]
+        for labels, child in self._collect_children():
+            lines.extend(child._render_samples(labels))
+        return lines
+
+    def _render_samples(self, labels):
+        return [self.name + _format_labels(labels) + ' ' +
+                _format_value(self._cells.sum()[0])]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, value=1):
+        self._cells.get()[0] += value
+
+
+# Gauge is either changed with inc() and dec() or its value is returned
+# by function called on collection
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, description, labelnames=(), function=None):
+        super().__init__(name, description, labelnames)
+        self._function = function
+
+    def inc(self, value=1):
+        self._cells.get()[0] += value
+
+    def dec(self, value=1):
+        self._cells.get()[0] -= value
+
+    def _render_samples(self, labels):
+        if self._function is None:
+            return super()._render_samples(labels)
+        return [self.name + _format_labels(labels) + ' ' +
+                _format_value(self._function())]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, buckets, labelnames=()):
+        # +Inf bucket is implicit
+        self._buckets = list(buckets)
+        super().__init__(name, description, labelnames)
+
+    # cell: non-cumulative bucket counts (the last is +Inf) and sum
+    def _make_cells(self):
+        return _ThreadCells(len(self._buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cells.get()
+        cell[bisect_left(self._buckets, value)] += 1
+        cell[-1] += value
+
+    # Measures duration of with block
+    def time(self):
+        return _Timer(self)
+
+    def _render_samples(self, labels):
+        values = self._cells.sum()
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self._buckets + [float('inf')],
+                                       values):
+            count += bucket_count
+            lines.append(self.name + '_bucket' +
+                         _format_labels(labels + [
+                             ['le', _format_value(float(bound))]]) +
+                         ' ' + str(count))
+        lines.append(self.name + '_sum' + _format_labels(labels) + ' ' +
+                     _format_value(values[-1]))
+        lines.append(self.name + '_count' + _format_labels(labels) + ' ' +
+                     str(count))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        self._start = time_monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time_monotonic() - self._start)
+
+
+# Single upload or download. Bytes are counted as they are transferred,
+# throughput is observed when transfer is finished.
+class Transfer:
+    def __init__(self, metrics):
+        self._metrics = metrics
+        self._start = time_monotonic()
+        self._size = 0
+        self._finished = False
+        metrics.in_progress.inc()
+
+    def add(self, size):
+        self._size += size
+        self._metrics.bytes.inc(size)
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._metrics.in_progress.dec()
+        duration = time_monotonic() - self._start
+        if self._size > 0 and duration > 0:
+            self._metrics.throughput.observe(self._size / duration)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+
+# Metrics of one transfer direction: 'upload' or 'download'
+class TransferMetrics:
+    def __init__(self, registry, direction):
+        prefix = 'limbo_' + direction
+        self.bytes = registry.counter(
+            prefix + '_bytes_total', 'Bytes of ' + direction + 's')
+        self.in_progress = registry.gauge(
+            prefix + 's_in_progress', direction.capitalize() +
+            's in progress')
+        self.throughput = registry.histogram(
+            prefix + '_throughput_bytes_per_second',
+            'Throughput of finished ' + direction + 's', THROUGHPUT_BUCKETS)
+
+    def start(self):
+        return Transfer(self)
+
+
+# Set of metrics rendered in Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._protect_metrics = threading.Lock()
+
+    def counter(self, name, description, labelnames=()):
+        return self._register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=(), function=None):
+        return self._register(Gauge(name, description, labelnames,
+                                    function))
+
+    def histogram(self, name, description, buckets=DURATION_BUCKETS,
+                  labelnames=()):
+        return self._register(Histogram(name, description, buckets,
+                                        labelnames))
+
+    def _register(self, metric):
+        with self._protect_metrics:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._protect_metrics:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the process
+metrics = MetricsRegistry()
@@ -0,0 +1,107 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+from lib_log import logger
+
+from queue import Queue
+import threading
+from time import perf_counter as time_perf_counter
+
+
+# Writes data to underlying writer in dedicated thread, so network reading
+# and disk writing are done concurrently. Not more than max_queued_chunks
+# chunks are buffered: write() blocks when queue is full (backpressure).
+# Writer error is raised by the next write() or close() call.
+# writer is object with write(data), close() and abort() methods.
+# Data passed to write() must not be modified after the call.
+class PipelinedWriter:
+    def __init__(self, writer, max_queued_chunks, name='writer'):
+        self._writer = writer
+        self._name = name
+        self._queue = Queue(max_queued_chunks)
+        self._error = None
+        self._finished = False
+        self._stats = {
+            'bytes': 0,
+            'chunks': 0,
+            # max number of chunks waiting in queue
+            'max_queued_chunks': 0,
+            # time request thread was blocked by full queue
+            'read_wait_seconds': 0.0,
+            # time writer thread was busy writing
+            'write_seconds': 0.0,
+        }
+        self._thread = threading.Thread(target=self._thread_procedure,
+                                        name='PipelinedWriter: ' + name,
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    # Closes writer, or aborts it if block is left by exception
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_tb is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def write(self, data):
+        self._raise_error()
+        started = time_perf_counter()
+        self._queue.put(data)
+        stats = self._stats
+        stats['read_wait_seconds'] += time_perf_counter() - started
+        stats['bytes'] += len(data)
+        stats['chunks'] += 1
+        stats['max_queued_chunks'] = max(stats['max_queued_chunks'],
+                                         self._queue.qsize())
+
+    # Waits for all data to be written and closes writer
+    def close(self):
+        self._finish()
+        if self._error is not None:
+            self._writer.abort()
+            self._raise_error()
+        self._writer.close()
+        stats = self._stats
+        logger.info('PipelinedWriter: ' + self._name, **stats)
+
+    # Drops queued data and aborts writer
+    def abort(self):
+        if self._error is None:
+            self._error = Exception('Upload is aborted')
+        self._finish()
+        self._writer.abort()
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _thread_procedure(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is not None:
+                # drain queue, so write() is not blocked
+                continue
+            started = time_perf_counter()
+            try:
+                self._writer.write(data)
+            except Exception as e:
+                logger.error('PipelinedWriter: ' + self._name +
+                             ': write error: ' + str(e))
+                self._error = e
+            self._stats['write_seconds'] += time_perf_counter() - started
@@ -0,0 +1,81 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+from lib_common import log
+from lib_log import logger
+
+from os import _exit as os__exit, \
+               kill as os_kill, \
+               waitpid as os_waitpid
+import signal
+from traceback import format_exc as traceback_format_exc
+
+# not available on Windows:
+try:
+    from os import fork as os_fork
+except ImportError:
+    os_fork = None
+
+
+# Pre-fork multi-process mode. Workers must be forked before any thread
+# is started, so they don't inherit locks held by other threads.
+# worker_procedure(index) is run in each worker process.
+# Returns list of worker process ids.
+def fork_workers(count, worker_procedure):
+    if os_fork is None:
+        raise Exception('Worker processes are not supported on this platform')
+    pids = []
+    for index in range(count):
+        # logger thread is started again in both processes
+        logger.stop()
+        pid = os_fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                worker_procedure(index)
+                exit_code = 0
+            except KeyboardInterrupt:
+                exit_code = 0
+            except BaseException:
+                logger.error('Worker process error: ' +
+                             traceback_format_exc())
+            finally:
+                # don't run parent's cleanup code in worker process
+                logger.stop()
+                os__exit(exit_code)
+        log('Worker process ' + str(index) + ' started: pid ' + str(pid))
+        pids.append(pid)
+    return pids
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(0)
+
+
+# Waits until all workers exit. On SIGTERM or Ctrl+C the rest of workers
+# are terminated.
+def wait_workers(pids):
+    remaining = set(pids)
+    previous_handler = signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        while remaining:
+            pid, status = os_waitpid(-1, 0)
+            if pid in remaining:
+                remaining.discard(pid)
+                log('Worker process ' + str(pid) + ' exited with status ' +
+                    str(status))
+    except (KeyboardInterrupt, SystemExit):
+        log('Stop worker processes...')
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        for pid in remaining:
+            try:
+                os_kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in remaining:
+            try:
+                os_waitpid(pid, 0)
+            except ChildProcessError:
+                pass
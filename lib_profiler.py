@@ -0,0 +1,176 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+import cProfile
+from hmac import compare_digest as hmac_compare_digest
+from io import StringIO
+from marshal import dumps as marshal_dumps
+from os import getpid as os_getpid
+import pstats
+from random import random
+import threading
+from time import monotonic as time_monotonic
+import tracemalloc
+
+
+# Profiling modes: cProfile of request thread and memory allocated by
+# request (tracemalloc)
+PROFILE_MODES = ['cpu', 'memory']
+
+# Request header with token to profile the request
+PROFILE_HEADER = 'X-Limbo-Profile'
+
+_PROFILE_ENVIRON_KEY = 'HTTP_' + PROFILE_HEADER.upper().replace('-', '_')
+
+
+# Results of profiled requests of one route
+class _RouteProfile:
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0
+        self.stats = None  # pstats.Stats
+        self.allocations = {}  # 'file:line' -> [size, count]
+
+
+# WSGI middleware profiling sampled requests. sample_rate is fraction of
+# requests profiled at random, requests with PROFILE_HEADER equal to
+# token are profiled too. Only one request at a time is profiled, the
+# others pass as usual meanwhile. Results are aggregated by bottle route.
+# Memory mode traces all allocations of the process, which makes it
+# several times slower, so it is started only when enabled.
+class ProfilingMiddleware:
+    def __init__(self, app, sample_rate=0, token='', modes=('cpu',),
+                 skip_paths=()):
+        for mode in modes:
+            if mode not in PROFILE_MODES:
+                raise Exception('Unsupported profile mode', mode)
+        self._app = app
+        self._sample_rate = sample_rate
+        self._token = token
+        self._cpu = 'cpu' in modes
+        self._memory = 'memory' in modes
+        self._skip_paths = tuple(skip_paths)
+        self._routes = {}
+        self._protect_routes = threading.Lock()
+        self._protect_profiling = threading.Lock()
+        if self._memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def is_token_valid(self, token):
+        return bool(self._token) and \
+            hmac_compare_digest(token.encode('utf-8'),
+                                self._token.encode('utf-8'))
+
+    def __call__(self, environ, start_response):
+        if not self._is_sampled(environ) or \
+                not self._protect_profiling.acquire(blocking=False):
+            return self._app(environ, start_response)
+        try:
+            return self._call_profiled(environ, start_response)
+        finally:
+            self._protect_profiling.release()
+
+    def _is_sampled(self, environ):
+        if environ.get('PATH_INFO', '').startswith(self._skip_paths):
+            return False
+        token = environ.get(_PROFILE_ENVIRON_KEY)
+        if token is not None and self.is_token_valid(token):
+            return True
+        return self._sample_rate > 0 and random() < self._sample_rate
+
+    # Response body is returned by bottle after handler has finished,
+    # so its iteration (e.g. file download) is not profiled
+    def _call_profiled(self, environ, start_response):
+        profiler = cProfile.Profile() if self._cpu else None
+        snapshot = self._take_snapshot() if self._memory else None
+        start = time_monotonic()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return self._app(environ, start_response)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time_monotonic() - start
+            allocations = None
+            if snapshot is not None:
+                allocations = self._take_snapshot().compare_to(snapshot,
+                                                               'lineno')
+            self._add_results(self._get_route(environ), seconds, profiler,
+                              allocations)
+
+    def _get_route(self, environ):
+        route = environ.get('bottle.route')
+        if route is None:
+            return 'unmatched'
+        return route.method + ' ' + route.rule
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+    def _add_results(self, route, seconds, profiler, allocations):
+        stats = pstats.Stats(profiler) if profiler is not None else None
+        with self._protect_routes:
+            result = self._routes.get(route)
+            if result is None:
+                result = self._routes[route] = _RouteProfile()
+            result.requests += 1
+            result.seconds += seconds
+            if stats is not None:
+                if result.stats is None:
+                    result.stats = stats
+                else:
+                    result.stats.add(stats)
+            for diff in allocations or []:
+                if diff.size_diff <= 0:
+                    continue
+                frame = diff.traceback[0]
+                site = frame.filename + ':' + str(frame.lineno)
+                total = result.allocations.setdefault(site, [0, 0])
+                total[0] += diff.size_diff
+                total[1] += diff.count_diff
+
+    def reset(self):
+        with self._protect_routes:
+            self._routes = {}
+
+    def get_routes(self):
+        with self._protect_routes:
+            return sorted(self._routes)
+
+    # Returns aggregated cProfile data of route in pstats file format
+    # (python -m pstats file) or None
+    def get_pstats_dump(self, route):
+        with self._protect_routes:
+            result = self._routes.get(route)
+            if result is None or result.stats is None:
+                return None
+            return marshal_dumps(result.stats.stats)
+
+    # Text report: top functions by cumulative time and top allocation
+    # sites (memory left allocated by request) of each route
+    def render_report(self, limit=20):
+        output = StringIO()
+        output.write('Profiled requests of process ' + str(os_getpid()) +
+                     '\n')
+        with self._protect_routes:
+            routes = sorted(self._routes.items(),
+                            key=lambda item: -item[1].seconds)
+            for route, result in routes:
+                output.write('\n== ' + route + ': ' + str(result.requests) +
+                             ' requests, ' + '%.3f' % result.seconds +
+                             ' sec\n')
+                if result.stats is not None:
+                    result.stats.stream = output
+                    result.stats.sort_stats('cumulative').print_stats(limit)
+                if self._memory:
+                    output.write('Allocation sites (bytes, blocks):\n')
+                    sites = sorted(result.allocations.items(),
+                                   key=lambda item: -item[1][0])
+                    for site, [size, count] in sites[:limit]:
+                        output.write('%12d %8d  %s\n' % (size, count, site))
+        return output.getvalue()
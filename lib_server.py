@@ -0,0 +1,290 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+from lib_http import FileRange
+from lib_log import INFO, logger
+
+from queue import Queue
+from select import select
+import socket
+from socket import timeout as socket_timeout
+import threading
+from time import monotonic as time_monotonic
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, \
+    WSGIServer
+
+
+# Unread request body left after response which is read to keep
+# connection alive. Connection is closed if there is more.
+MAX_DRAIN_BYTES = 1024 * 1024
+
+# How often idle persistent connection checks if other connections wait
+# for free worker thread
+KEEPALIVE_POLL_SECONDS = 0.1
+
+
+# wsgi.input limited by Content-Length. Raw socket stream blocks
+# if application tries to read after the end of request body.
+class LimitedInput:
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._remaining = length
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        if len(view) > self._remaining:
+            view = view[:self._remaining]
+        length = self._stream.readinto(view) or 0
+        self._remaining -= length
+        return length
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        line = self._stream.readline(size)
+        self._remaining -= len(line)
+        return line
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    # Returns False if body is longer than limit
+    def drain(self, limit):
+        while 0 < self._remaining <= limit:
+            if not self.read(64 * 1024):
+                break
+        return self._remaining == 0
+
+
+# wsgiref handler transmitting file ranges returned through
+# wsgi.file_wrapper with sendfile() (kernel to socket copy)
+class SendfileServerHandler(ServerHandler):
+    # True if connection may be kept alive after response
+    keep_alive = False
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        request_handler = getattr(self, 'request_handler', None)
+        if not isinstance(filelike, FileRange) or request_handler is None:
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        # socket.sendfile() falls back to send() where
+        # os.sendfile() is not available. It rejects empty range.
+        if filelike.length > 0:
+            self.bytes_sent += request_handler.connection.sendfile(
+                filelike.file, filelike.offset, filelike.length)
+        return True
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        if not self.keep_alive:
+            return
+        if 'Content-Length' not in self.headers:
+            # response end is marked by connection close
+            self.keep_alive = False
+            self.headers['Connection'] = 'close'
+        elif self.request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+    def handle_error(self):
+        # response may be sent partially
+        self.keep_alive = False
+        super().handle_error()
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    # Persistent connections are supported if protocol_version is HTTP/1.1.
+    # Connection idle timeout is taken from server's keepalive_timeout.
+    multithread = False
+
+    # Don't resolve client host name
+    def address_string(self):
+        return self.client_address[0]
+
+    # Request log record instead of stderr line
+    def log_request(self, code='-', size='-'):
+        if not logger.is_enabled(INFO):
+            return
+        fields = {} if size == '-' else {'bytes': size}
+        logger.request('Request', client=self.client_address[0],
+                       request=self.requestline,
+                       status=getattr(code, 'value', code),
+                       duration=time_monotonic() - self._request_start,
+                       **fields)
+
+    def log_message(self, format, *args):
+        logger.warning(self.client_address[0], format % args)
+
+    # Handles requests while connection is kept alive
+    def handle(self):
+        self.close_connection = True
+        self._handle_request(False)
+        while not self.close_connection:
+            self._handle_request(True)
+
+    # The same as WSGIRequestHandler.handle() but with other ServerHandler,
+    # request body limited by Content-Length and persistent connections
+    def _handle_request(self, is_next_request):
+        if is_next_request and not self._wait_next_request():
+            self.close_connection = True
+            return
+        try:
+            if is_next_request:
+                self.connection.settimeout(self.server.keepalive_timeout)
+            self.raw_requestline = self.rfile.readline(65537)
+            self._request_start = time_monotonic()
+            self.connection.settimeout(None)
+        except socket_timeout:
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():  # An error code has been sent, exit
+            return
+        if getattr(self.server, 'keepalive_timeout', 0) <= 0:
+            self.close_connection = True
+        environ = self.get_environ()
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            self.send_error(400, 'Bad Content-Length')
+            self.close_connection = True
+            return
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # application decodes body itself till the end of stream
+            stdin = self.rfile
+            self.close_connection = True
+        else:
+            stdin = LimitedInput(self.rfile, content_length)
+        handler = SendfileServerHandler(
+            stdin, self.wfile, self.get_stderr(), environ,
+            multithread=self.multithread)
+        handler.request_handler = self  # backpointer for logging
+        if not self.close_connection:
+            handler.http_version = '1.1'
+            handler.keep_alive = True
+        handler.run(self.server.get_app())
+        if not handler.keep_alive or not stdin.drain(MAX_DRAIN_BYTES):
+            self.close_connection = True
+
+    # Waits for next request of persistent connection. Returns False if
+    # idle timeout is expired or other connections wait for worker thread:
+    # idle connection must not hold the thread (e.g. page polling events
+    # more often than idle timeout).
+    def _wait_next_request(self):
+        # Request may be already buffered (pipelining). Non-blocking peek
+        # doesn't wait for data which is not received yet.
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        finally:
+            self.connection.setblocking(True)
+        deadline = time_monotonic() + self.server.keepalive_timeout
+        while True:
+            timeout = deadline - time_monotonic()
+            if timeout <= 0:
+                return False
+            readable, _, _ = select([self.connection], [], [],
+                                    min(timeout, KEEPALIVE_POLL_SECONDS))
+            if readable:
+                return True
+            if self.server.has_waiting_connections():
+                return False
+
+
+# HTTP/1.1 handler for ThreadPoolWSGIServer
+class ThreadedRequestHandler(SendfileRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    multithread = True
+
+
+# wsgiref server serving connections by pool of worker threads.
+# Accepted connections wait for free worker in queue. When the queue is
+# full new connections wait in listen backlog of the same size.
+# reuse_port allows several worker processes to listen on the same port
+# (SO_REUSEPORT). Kernel distributes connections between them.
+class ThreadPoolWSGIServer(WSGIServer):
+    threads = 16
+    request_queue_size = 64
+    keepalive_timeout = 5
+    reuse_port = False
+
+    def __init__(self, *args, **kwargs):
+        self._connections = Queue(self.request_queue_size)
+        super().__init__(*args, **kwargs)
+        for index in range(self.threads):
+            thread = threading.Thread(target=self._worker_procedure,
+                                      name='WSGI worker ' + str(index),
+                                      daemon=True)
+            thread.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        self._connections.put([request, client_address])
+
+    def has_waiting_connections(self):
+        return not self._connections.empty()
+
+    def server_close(self):
+        super().server_close()
+        for index in range(self.threads):
+            self._connections.put(None)
+
+    def _worker_procedure(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+# Makes ThreadPoolWSGIServer class with specified settings.
+# keepalive_timeout is idle time in seconds before connection is closed,
+# 0 disables persistent connections.
+def make_thread_pool_server_class(threads, queue_size, keepalive_timeout,
+                                  reuse_port=False):
+    class ConfiguredServer(ThreadPoolWSGIServer):
+        pass
+    ConfiguredServer.threads = threads
+    ConfiguredServer.request_queue_size = queue_size
+    ConfiguredServer.keepalive_timeout = keepalive_timeout
+    ConfiguredServer.reuse_port = reuse_port
+    return ConfiguredServer
@@ -5,16 +5,37 @@
 
 import config
 
-from lib_file_storage import FileStorage
-from lib_common import log, get_file_modified_unixtime
+from lib_async_server import AsyncioServer
+from lib_file_storage import FileStorage, StorageFullError, \
+    UploadChecksumError, UploadOffsetError
+from lib_common import log
+from lib_log import logger
+from lib_pipeline import PipelinedWriter
+from lib_prefork import fork_workers, wait_workers
+from lib_profiler import PROFILE_HEADER, ProfilingMiddleware
+from lib_metrics import metrics, TransferMetrics
+from lib_http import FileRange, content_range, http_date, \
+    if_range_matches, IncompleteBodyError, is_not_modified, \
+    iter_request_body, multipart_byteranges, parse_range_header
+from lib_server import SendfileRequestHandler, ThreadedRequestHandler, \
+    make_thread_pool_server_class
 
+from asyncio import ensure_future as asyncio_ensure_future, \
+    Event as asyncio_Event, sleep as asyncio_sleep, \
+    TimeoutError as asyncio_TimeoutError, wait as asyncio_wait, \
+    wait_for as asyncio_wait_for
 import bottle
+from base64 import b64encode
+from bisect import bisect_right
+from hashlib import sha1
+from io import open as io_open
 from json import dumps as json_dumps
 import mimetypes
 from os import path as os_path
 from streaming_form_data import StreamingFormDataParser
 from streaming_form_data.targets import BaseTarget, NullTarget
-from time import time as time_time
+from time import monotonic as time_monotonic, time as time_time
+from traceback import format_exc as traceback_format_exc
 from urllib.parse import quote as urllib_quote
 
 
@@ -31,10 +52,110 @@ bottle.TEMPLATE_PATH = [os_path.join(os_path.dirname(__file__),
                                      'static', 'templates')]
 
 STORAGE_URL_SUBDIR = '/files/'
-URLPREFIX = STORAGE_URL_SUBDIR if config.STORAGE_WEB_URL_BASE == '' \
-                               else config.STORAGE_WEB_URL_BASE
 
-storage = FileStorage(config.STORAGE_DIRECTORY, config.MAX_STORAGE_SECONDS)
+if config.LOG_FORMAT not in ['text', 'json']:
+    raise Exception('Unsupported log format', config.LOG_FORMAT)
+logger.configure(config.LOG_LEVEL, config.LOG_FORMAT == 'json',
+                 config.LOG_REQUESTS_PER_SECOND)
+if config.PROFILE_SAMPLE_RATE > 0 and not config.PROFILE_TOKEN:
+    raise Exception('Profiling results can be read with '
+                    'LIMBO_PROFILE_TOKEN only')
+
+storage = FileStorage(config.STORAGE_DIRECTORY, config.MAX_STORAGE_SECONDS,
+                      config.STORAGE_SHARD_LEVELS,
+                      config.HASH_ALGORITHM,
+                      config.DEDUPLICATE_STORAGE,
+                      config.PREALLOCATE_FILES,
+                      config.WRITE_BUFFER_SIZE,
+                      config.DURABILITY,
+                      config.MAX_STORAGE_BYTES,
+                      config.MIN_FREE_DISK_BYTES,
+                      config.WORKER_PROCESSES > 1,
+                      config.WATCH_STORAGE)
+
+
+# ==========================================
+# Metrics (/cgi/metrics). Values are per process.
+# ==========================================
+
+request_duration = metrics.histogram(
+    'limbo_http_request_duration_seconds',
+    'Request handler time by route (file download body is sent later)',
+    labelnames=['method', 'route'])
+requests_in_progress = metrics.gauge('limbo_http_requests_in_progress',
+                                     'Requests being handled')
+upload_metrics = TransferMetrics(metrics, 'upload')
+download_metrics = TransferMetrics(metrics, 'download')
+metrics.gauge('limbo_stored_files', 'Number of stored files',
+              function=lambda: storage.get_file_count())
+metrics.gauge('limbo_stored_bytes', 'Size of stored files',
+              function=lambda: storage.get_usage()[0])
+
+
+# Measures handler time of all bottle routes
+class MetricsPlugin:
+    name = 'metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        histogram = request_duration.labels(route.method, route.rule)
+
+        def wrapper(*args, **kwargs):
+            requests_in_progress.inc()
+            try:
+                with histogram.time():
+                    return callback(*args, **kwargs)
+            finally:
+                requests_in_progress.dec()
+
+        return wrapper
+
+
+bottle.install(MetricsPlugin())
+
+
+# Download is counted when server closes response body
+def start_download(length):
+    transfer = download_metrics.start()
+
+    def on_close():
+        transfer.add(length)
+        transfer.finish()
+
+    return on_close
+
+
+def iter_and_call(iterable, on_close):
+    try:
+        for chunk in iterable:
+            yield chunk
+    finally:
+        on_close()
+
+
+def count_upload_chunks(chunks, transfer):
+    for chunk in chunks:
+        transfer.add(len(chunk))
+        yield chunk
+
+
+# Hash algorithm names for Digest HTTP header (RFC 3230, RFC 5843)
+# with flags whether value is base64 encoded (otherwise hex is used).
+DIGEST_ALGORITHMS = {
+    'md5': ['MD5', True],
+    'sha1': ['SHA', True],
+    'sha256': ['SHA-256', True],
+    'sha512': ['SHA-512', True],
+    'adler32': ['ADLER32', False],
+}
+
+
+def get_file_url(item):
+    if config.STORAGE_WEB_URL_BASE == '':
+        return STORAGE_URL_SUBDIR + urllib_quote(item['url_filename'])
+    # standalone web server serves storage directory as is:
+    return config.STORAGE_WEB_URL_BASE + \
+        urllib_quote(item['relative_disk_filename'])
 
 
 def format_size(b):
@@ -61,108 +182,364 @@ def format_age(a):
     return '%ih %im' % (a / 60, a % 60)
 
 
+PAGE_TITLE = 'Limbo: the file sharing lightweight service'
+PAGE_H1 = 'Limbo. The file sharing lightweight service'
+
+# Page shell of client rendered mode (body and ETag). It doesn't depend
+# on stored files, so it is rendered once and browsers revalidate it.
+page_shell = None
+
+
+def page_shell_response():
+    global page_shell
+    if page_shell is None:
+        body = bottle.template('root.html', title=PAGE_TITLE, h1=PAGE_H1,
+                               files=[], client_rendered=True)
+        body = body.encode('utf-8')
+        page_shell = [body, '"' + sha1(body).hexdigest() + '"']
+    body, etag = page_shell
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if is_not_modified(bottle.request.environ, etag, time_time()):
+        return bottle.HTTPResponse(status=304, headers=headers)
+    headers['Content-Type'] = 'text/html; charset=UTF-8'
+    return bottle.HTTPResponse(body, status=200, headers=headers)
+
+
+# Page rendered by browser from /cgi/events/ (see static/filelist.js)
+@bottle.route('/list/')
+def list_page():
+    logger.debug('List page is requested')
+    return page_shell_response()
+
+
 @bottle.route('/')
 @bottle.view('root.html')
 def root_page():
-    log('Root page is requested')
+    if config.CLIENT_RENDERED_PAGE:
+        return list_page()
+    logger.debug('Root page is requested')
     files = []
+    # page gets later changes from /cgi/events/
+    version = storage.get_listing_version()
     items = storage.enumerate_files()
     now = time_time()
     for item in items:
-        full_disk_filename = item['full_disk_filename']
         url_filename = item['url_filename']
         display_filename = item['display_filename']
-        modified_unixtime = get_file_modified_unixtime(full_disk_filename)
+        modified_unixtime = item['modified']
         files.append(
             {
                 'display_filename': display_filename,
-                'url': URLPREFIX + urllib_quote(url_filename),
+                'url': get_file_url(item),
                 'url_filename': url_filename,
-                'size': format_size(os_path.getsize(full_disk_filename)),
+                'size': format_size(item['size']),
                 'age': format_age(now - modified_unixtime),
                 'sortBy': now - modified_unixtime,
             })
     files = sorted(files, key=lambda item: item['sortBy'])
     return {
-            'title': 'Limbo: the file sharing lightweight service',
-            'h1': 'Limbo. The file sharing lightweight service',
+            'title': PAGE_TITLE,
+            'h1': PAGE_H1,
             'files': files,
+            'version': version,
+            'client_rendered': False,
         }
 
 
-# JSON API for auto tests and automation
+# Listing sorted by modification time (and name), keys used by cursors
+# and index version of the listing. Pages of the same listing version
+# don't sort all files again.
+sorted_listing = [None, [], []]
+
+
+def make_listing_item(item):
+    return {
+        'display_filename': item['display_filename'],
+        'url': get_file_url(item),
+        'url_filename': item['url_filename'],
+        'size': item['size'],
+        'modified': item['modified'],
+        'hash': item['hash'],
+        'hash_algorithm': item['hash_algorithm'],
+    }
+
+
+def get_listing_key(item):
+    return (item['modified'], item['url_filename'])
+
+
+# Cursor points after the file with specified key
+def make_listing_cursor(key):
+    return repr(key[0]) + ':' + key[1]
+
+
+def parse_listing_cursor(cursor):
+    modified, _, url_filename = cursor.partition(':')
+    try:
+        return (float(modified), url_filename)
+    except ValueError:
+        raise bottle.HTTPError(400, 'Bad cursor.')
+
+
+def get_sorted_listing(version):
+    global sorted_listing
+    listing = sorted_listing
+    if listing[0] != version:
+        files = sorted(map(make_listing_item, storage.enumerate_files()),
+                       key=get_listing_key)
+        listing = [version, files, list(map(get_listing_key, files))]
+        sorted_listing = listing
+    return listing
+
+
+# JSON API for auto tests and automation.
+# Without parameters returns list of all files. Parameters:
+# limit - maximum number of files, cursor - next_cursor value of previous
+# page, since - version of previous listing to get only changed files.
+# Then object with version, files and next_cursor or removed files is
+# returned. ETag is listing version, so unchanged listing is not sent.
 @bottle.get('/cgi/enumerate/')
 def cgi_enumerate():
-    log('Enumerate files')
-    bottle.response.content_type = 'application/json'
-    files = []
-    items = storage.enumerate_files()
-    for item in items:
-        full_disk_filename = item['full_disk_filename']
-        url_filename = item['url_filename']
-        display_filename = item['display_filename']
-        modified_unixtime = get_file_modified_unixtime(full_disk_filename)
-        files.append(
-            {
-                'display_filename': display_filename,
-                'url': URLPREFIX + urllib_quote(url_filename),
-                'url_filename': url_filename,
-                'size': os_path.getsize(full_disk_filename),
-                'modified': modified_unixtime,
-            })
-    files = sorted(files, key=lambda item: item['modified'])
-    return json_dumps(files, indent=4)
+    logger.debug('Enumerate files')
+    query = bottle.request.query
+    try:
+        limit = int(query.get('limit') or 0)
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        raise bottle.HTTPError(400, 'Bad limit.')
+    cursor = query.get('cursor')
+    since = query.get('since')
+    indent = 4 if query.get('pretty') == '1' else None
+    version = storage.get_listing_version()
+    etag = '"' + version + '"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if is_not_modified(bottle.request.environ, etag, time_time()):
+        return bottle.HTTPResponse(status=304, headers=headers)
+    headers['Content-Type'] = 'application/json'
+
+    result = {'version': version}
+    changes = storage.enumerate_changes(since) \
+        if since is not None and cursor is None else None
+    if changes is not None:
+        result['version'], items, result['removed'] = changes
+        result['files'] = sorted(map(make_listing_item, items),
+                                 key=get_listing_key)
+        result['reset'] = False
+    else:
+        _, files, keys = get_sorted_listing(version)
+        if cursor is not None or limit > 0:
+            start = 0 if cursor is None else \
+                bisect_right(keys, parse_listing_cursor(cursor))
+            end = len(files) if limit == 0 else start + limit
+            result['next_cursor'] = make_listing_cursor(keys[end - 1]) \
+                if end < len(files) else None
+            files = files[start:end]
+        result['files'] = files
+        if since is not None:
+            # client must forget all files it knows
+            result['removed'] = []
+            result['reset'] = True
+        elif cursor is None and limit == 0:
+            # compatible listing: just list of files
+            result = files
+    return bottle.HTTPResponse(
+        json_dumps(result, indent=indent,
+                   separators=None if indent else (',', ':')),
+        status=200, headers=headers)
+
+
+def make_event_message(version, files, removed, reset):
+    data = {'files': files, 'removed': removed, 'reset': reset}
+    message = 'id: ' + version + '\nevent: changes\ndata: ' + \
+        json_dumps(data, separators=(',', ':')) + '\n\n'
+    return message.encode('utf-8')
+
+
+# Message with all files and its listing version. New pages of the same
+# listing version get it without serializing all files again.
+full_listing_event = [None, b'']
+
+
+# Server-Sent Events message with changes of stored files since specified
+# listing version (all files if changes are unknown). Message id is new
+# listing version, browser sends it back as Last-Event-ID on reconnect.
+# Returns [message or empty bytes if there are no changes, version].
+def make_listing_event(since):
+    global full_listing_event
+    changes = storage.enumerate_changes(since) if since else None
+    if changes is None:
+        version = storage.get_listing_version()
+        cached = full_listing_event
+        if cached[0] != version:
+            files = get_sorted_listing(version)[1]
+            cached = [version, make_event_message(version, files, [], True)]
+            full_listing_event = cached
+        return [cached[1], version]
+    version, items, removed = changes
+    if not items and not removed:
+        return [b'', version]
+    files = sorted(map(make_listing_item, items), key=get_listing_key)
+    return [make_event_message(version, files, removed, False), version]
+
+
+def get_events_retry_field():
+    return ('retry: ' + str(int(config.EVENTS_POLL_SECONDS * 1000)) +
+            '\n\n').encode('utf-8')
+
+
+EVENTS_HEADERS = {
+    'Content-Type': 'text/event-stream; charset=UTF-8',
+    'Cache-Control': 'no-cache',
+}
+
+
+# Change feed of web page. Response is sent at once, so open pages don't
+# occupy worker threads: browser reconnects after retry delay. asyncio
+# server keeps the stream open instead (see async_cgi_events()).
+@bottle.get('/cgi/events/')
+def cgi_events():
+    since = bottle.request.get_header('Last-Event-ID') or \
+        bottle.request.query.get('since')
+    message, _ = make_listing_event(since)
+    return bottle.HTTPResponse(get_events_retry_field() + message,
+                               status=200, headers=EVENTS_HEADERS)
 
 
 @bottle.post('/cgi/addtext/')
 def cgi_addtext():
     text_title = bottle.request.forms.title
-    log('Share text begin: ' + text_title)
+    logger.debug('Share text begin', title=text_title)
     original_filename = text_title + '.txt'
     body = bytearray(bottle.request.forms.body, encoding='utf-8')
 
-    with storage.open_file_writer(original_filename) as writer:
-        writer.write(body)
+    try:
+        with storage.open_file_writer(original_filename,
+                                      len(body)) as writer:
+            writer.write(body)
+    except StorageFullError:
+        return insufficient_storage_error()
 
-    log('Shared text size: ' + str(len(body)))
+    upload_metrics.bytes.inc(len(body))
+    logger.info('Text is shared', title=text_title, bytes=len(body))
     return 'OK'
 
 
+def insufficient_storage_error():
+    return bottle.HTTPError(507, 'Not enough storage space.')
+
+
 class StorageFileTarget(BaseTarget):
-    def __init__(self):
+    # size is upper bound of file size (e.g. request Content-Length)
+    def __init__(self, size=None):
         super().__init__()
+        self._size = size
         self._writer = None
 
+    def __enter__(self):
+        return self
+
+    # File which is not finished when block is left (request is failed or
+    # body is incomplete) is aborted
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.abort()
+
     def start(self):
-        self._writer = storage.open_file_writer(self.multipart_filename)
+        writer = storage.open_file_writer(self.multipart_filename,
+                                          self._size)
+        if config.UPLOAD_PIPELINE_CHUNKS > 0:
+            try:
+                writer = PipelinedWriter(writer,
+                                         config.UPLOAD_PIPELINE_CHUNKS,
+                                         self.multipart_filename)
+            except BaseException:
+                writer.abort()
+                raise
+        self._writer = writer
 
     def data_received(self, chunk):
         self._writer.write(chunk)
 
     def finish(self):
-        self._writer.close()
+        writer = self._writer
+        self._writer = None
+        writer.close()
+
+    # True if file part is started but its end is not received
+    @property
+    def is_incomplete(self):
+        return self._writer is not None
+
+    # Called if request is failed
+    def abort(self):
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            writer.abort()
+
+
+# Upload target used if storage is disabled
+class NullFileTarget(NullTarget):
+    is_incomplete = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def make_upload_target(size):
+    if config.DISABLE_STORAGE:
+        return NullFileTarget()
+    return StorageFileTarget(size)
+
+
+# Raises IncompleteBodyError if body ends inside multipart file part
+def check_upload_finished(file):
+    if file.is_incomplete:
+        raise IncompleteBodyError('Multipart body is incomplete')
 
 
 @bottle.post('/cgi/upload/')
 def cgi_upload():
-    log('Upload file begin')
+    logger.debug('Upload file begin')
 
     use_async_implementation = True
 
     if use_async_implementation:
         size = 0
-        file = NullTarget() if config.DISABLE_STORAGE else StorageFileTarget()
+        content_length = bottle.request.content_length
+        if content_length < 0:
+            content_length = None
+        if not config.DISABLE_STORAGE:
+            # reject upload before its data is received
+            try:
+                storage.check_space(content_length or 0)
+            except StorageFullError:
+                return insufficient_storage_error()
+        file = make_upload_target(content_length)
         parser = StreamingFormDataParser(headers=bottle.request.headers)
         parser.register('file', file)
 
-        while True:
-            chunk = bottle.request.environ['wsgi.input'].read(64 * 1024)
-            if not chunk:
-                break
-            parser.data_received(chunk)
-            size += len(chunk)
+        # multipart parser accepts bytes only, so buffer is not reused
+        chunks = iter_request_body(bottle.request.environ, False,
+                                   config.UPLOAD_MIN_CHUNK_SIZE,
+                                   config.UPLOAD_MAX_CHUNK_SIZE)
+        try:
+            # unfinished file is aborted on any error
+            with file, upload_metrics.start() as transfer:
+                for chunk in chunks:
+                    parser.data_received(chunk)
+                    size += len(chunk)
+                    transfer.add(len(chunk))
+                check_upload_finished(file)
+        except StorageFullError:
+            return insufficient_storage_error()
+        except IncompleteBodyError:
+            return bottle.HTTPError(400, 'Incomplete request body.')
 
-        log('Uploaded request size: ' + str(size))
+        logger.info('Upload finished', bytes=size)
     else:
         size = 0
         upload = bottle.request.files.get('file')
@@ -180,13 +557,388 @@ def cgi_upload():
                     writer.write(chunk)
                 size += len(chunk)
 
-        log('Uploaded file size: ' + str(size))
+        logger.info('Upload finished', bytes=size)
     return 'OK'
 
 
+# Resumable upload protocol:
+# 1) POST /cgi/upload/session/ with fileName and size (optional) fields
+#    creates session.
+# 2) PUT /cgi/upload/session/<id>?offset=N with raw data writes data at
+#    offset. Parts may be sent concurrently in any order and may overlap.
+#    If offset or data end is out of file bounds 409 is returned. If
+#    there is not enough storage space for data 507 is returned.
+# 3) GET /cgi/upload/session/<id> returns received ranges to resume upload.
+# 4) POST /cgi/upload/session/<id>/commit stores file. Optional hash field
+#    is verified against content hash (see LIMBO_HASH_ALGORITHM).
+#    If some data is missing 409 is returned.
+#    DELETE /cgi/upload/session/<id> cancels upload.
+# All responses except DELETE are JSON: {"session_id": ..., "offset": ...,
+# "size": ..., "ranges": [[begin, end], ...]}. Offset is size of data
+# received contiguously from file beginning.
+def upload_session_json(session):
+    return json_dumps({
+        'session_id': session.session_id,
+        'offset': session.offset,
+        'size': session.size,
+        'ranges': session.ranges,
+        })
+
+
+def upload_session_response(session, status=200):
+    return bottle.HTTPResponse(
+        upload_session_json(session),
+        status=status, headers={'Content-Type': 'application/json'})
+
+
+def get_upload_session_or_404(session_id):
+    session = storage.get_upload_session(session_id)
+    if session is None:
+        raise bottle.HTTPError(404, 'Upload session does not exist.')
+    return session
+
+
+@bottle.post('/cgi/upload/session/')
+def cgi_upload_session_create():
+    original_filename = bottle.request.forms.fileName
+    size = bottle.request.forms.size
+    logger.info('Upload session begin', name=original_filename, size=size)
+    if original_filename == '':
+        return bottle.HTTPError(400, 'fileName is required.')
+    try:
+        size = int(size) if size != '' else None
+    except ValueError:
+        return bottle.HTTPError(400, 'Invalid size.')
+    try:
+        session = storage.create_upload_session(original_filename, size)
+    except StorageFullError:
+        return insufficient_storage_error()
+    return upload_session_response(session, 201)
+
+
+@bottle.get('/cgi/upload/session/<session_id>')
+def cgi_upload_session_status(session_id):
+    return upload_session_response(get_upload_session_or_404(session_id))
+
+
+@bottle.put('/cgi/upload/session/<session_id>')
+def cgi_upload_session_write(session_id):
+    session = get_upload_session_or_404(session_id)
+    try:
+        offset = int(bottle.request.query.offset)
+    except ValueError:
+        return bottle.HTTPError(400, 'Invalid offset.')
+    try:
+        chunks = iter_request_body(bottle.request.environ, True,
+                                   config.UPLOAD_MIN_CHUNK_SIZE,
+                                   config.UPLOAD_MAX_CHUNK_SIZE)
+        with upload_metrics.start() as transfer:
+            chunks = count_upload_chunks(chunks, transfer)
+            if config.DISABLE_STORAGE:
+                for chunk in chunks:
+                    pass
+            else:
+                content_length = bottle.request.content_length
+                session.write(offset, chunks,
+                              content_length if content_length >= 0
+                              else None)
+    except UploadOffsetError:
+        return upload_session_response(session, 409)
+    except StorageFullError:
+        return upload_session_response(session, 507)
+    except IncompleteBodyError:
+        # received data is kept, upload may be resumed
+        return upload_session_response(session, 400)
+    return upload_session_response(session)
+
+
+@bottle.post('/cgi/upload/session/<session_id>/commit')
+def cgi_upload_session_commit(session_id):
+    session = get_upload_session_or_404(session_id)
+    logger.info('Upload session commit', session=session_id,
+                bytes=session.offset)
+    if not session.is_complete:
+        return upload_session_response(session, 409)
+    expected_hash = bottle.request.forms.hash
+    try:
+        storage.commit_upload_session(session, expected_hash or None)
+    except UploadChecksumError as e:
+        return bottle.HTTPError(400, str(e))
+    return upload_session_response(session)
+
+
+@bottle.delete('/cgi/upload/session/<session_id>')
+def cgi_upload_session_abort(session_id):
+    session = get_upload_session_or_404(session_id)
+    storage.abort_upload_session(session)
+    return 'OK'
+
+
+# ==========================================
+# Native handlers of asyncio web server (LIMBO_WEB_SERVER=asyncio).
+# Request body is received by event loop while previous chunk is parsed
+# and written to disk in thread pool. Other requests are served by
+# bottle handlers above.
+# ==========================================
+
+
+def async_text_response(status, text):
+    return [status, [('Content-Type', 'text/plain; charset=UTF-8')],
+            text.encode('utf-8')]
+
+
+def async_upload_session_response(session, status=200):
+    return [status, [('Content-Type', 'application/json')],
+            upload_session_json(session).encode('utf-8')]
+
+
+# Receives request body and passes chunks to blocking consumer(chunk)
+# in thread pool. Next chunk is received while previous one is consumed.
+# Returns body size.
+async def async_consume_body(request, consumer):
+    size = 0
+    pending = None
+    transfer = upload_metrics.start()
+    try:
+        while True:
+            chunk = await request.read_chunk(config.UPLOAD_MIN_CHUNK_SIZE,
+                                             config.UPLOAD_MAX_CHUNK_SIZE)
+            if pending is not None:
+                await pending
+                pending = None
+            if not chunk:
+                break
+            pending = request.run(consumer, chunk)
+            size += len(chunk)
+            transfer.add(len(chunk))
+    finally:
+        transfer.finish()
+        if pending is not None and not pending.done():
+            # consumer must not be used concurrently with error handling
+            await asyncio_wait([pending])
+    return size
+
+
+async def async_cgi_upload(request):
+    logger.debug('Upload file begin')
+    content_length = request.content_length or None
+    if not config.DISABLE_STORAGE:
+        try:
+            await request.run(storage.check_space, content_length or 0)
+        except StorageFullError:
+            return async_text_response(507, 'Not enough storage space.')
+    file = make_upload_target(content_length)
+    parser = StreamingFormDataParser(headers=request.headers)
+    parser.register('file', file)
+    try:
+        # unfinished file is aborted on any error
+        with file:
+            size = await async_consume_body(request, parser.data_received)
+            check_upload_finished(file)
+    except StorageFullError:
+        return async_text_response(507, 'Not enough storage space.')
+    except IncompleteBodyError:
+        return async_text_response(400, 'Incomplete request body.')
+
+    logger.info('Upload finished', bytes=size)
+    return async_text_response(200, 'OK')
+
+
+async def async_cgi_upload_session_write(request, session_id):
+    session = await request.run(storage.get_upload_session, session_id)
+    if session is None:
+        return async_text_response(404, 'Upload session does not exist.')
+    try:
+        offset = int(request.get_query('offset'))
+    except ValueError:
+        return async_text_response(400, 'Invalid offset.')
+    writer = None
+    if not config.DISABLE_STORAGE:
+        try:
+            # single writer records received range once per request
+            writer = await request.run(session.open_writer, offset,
+                                       request.content_length or None)
+        except UploadOffsetError:
+            return async_upload_session_response(session, 409)
+        except StorageFullError:
+            return async_upload_session_response(session, 507)
+
+    def write(chunk):
+        if writer is not None:
+            writer.write(chunk)
+
+    status = 200
+    try:
+        await async_consume_body(request, write)
+    except UploadOffsetError:
+        # data received before is kept
+        status = 409
+    except StorageFullError:
+        status = 507
+    except IncompleteBodyError:
+        # received data is kept, upload may be resumed
+        status = 400
+    finally:
+        if writer is not None:
+            await request.run(writer.close)
+    return async_upload_session_response(session, status)
+
+
+# Listing version watched by single task for all open event streams,
+# so storage is checked once per poll period whatever number of pages
+# is open.
+class AsyncListingWatcher:
+    def __init__(self):
+        self._version = None
+        self._changed = None
+        self._streams = 0
+        self._task = None
+
+    # Waits until listing version differs from specified one or timeout.
+    # Returns current version.
+    async def wait(self, request, version, timeout):
+        if self._task is None:
+            self._changed = asyncio_Event()
+            self._task = asyncio_ensure_future(self._watch(request))
+        self._streams += 1
+        try:
+            await asyncio_wait_for(self._wait_change(version), timeout)
+        except asyncio_TimeoutError:
+            pass
+        finally:
+            self._streams -= 1
+        return self._version
+
+    async def _wait_change(self, version):
+        while self._version is None or self._version == version:
+            await self._changed.wait()
+
+    async def _watch(self, request):
+        while self._streams > 0:
+            try:
+                version = await request.run(storage.get_listing_version)
+            except Exception:
+                logger.error('Listing watcher error: ' +
+                             traceback_format_exc())
+                version = self._version
+            if version != self._version:
+                self._version = version
+                # wake all waiting streams
+                self._changed.set()
+                self._changed = asyncio_Event()
+            await asyncio_sleep(config.EVENTS_POLL_SECONDS)
+        self._version = None
+        self._task = None
+
+
+async_listing_watcher = AsyncListingWatcher()
+
+# Comment line sent to idle event stream, so proxies don't close it
+EVENTS_KEEPALIVE_SECONDS = 30
+
+
+async def async_cgi_events(request):
+    since = request.headers.get('Last-Event-ID') or \
+        request.get_query('since')
+
+    async def stream(writer):
+        version = since
+        writer.write(get_events_retry_field())
+        while not writer.transport.is_closing():
+            message, version = await request.run(make_listing_event,
+                                                 version)
+            writer.write(message)
+            await writer.drain()
+            current = version
+            while current == version and \
+                    not writer.transport.is_closing():
+                current = await async_listing_watcher.wait(
+                    request, version, EVENTS_KEEPALIVE_SECONDS)
+                if current == version:
+                    writer.write(b': keepalive\n\n')
+                    await writer.drain()
+
+    return [200, list(EVENTS_HEADERS.items()), stream]
+
+
+# Measures handler time of native route. route is the same as of bottle
+# handler, so metrics of both servers are the same.
+def measure_async_route(method, route, handler):
+    histogram = request_duration.labels(method, route)
+
+    async def wrapper(request, *args):
+        requests_in_progress.inc()
+        start = time_monotonic()
+        try:
+            return await handler(request, *args)
+        finally:
+            histogram.observe(time_monotonic() - start)
+            requests_in_progress.dec()
+
+    return wrapper
+
+
+ASYNC_ROUTES = [
+    ['POST', '^/cgi/upload/$',
+     measure_async_route('POST', '/cgi/upload/', async_cgi_upload)],
+    ['PUT', '^/cgi/upload/session/([^/]+)$',
+     measure_async_route('PUT', '/cgi/upload/session/<session_id>',
+                         async_cgi_upload_session_write)],
+    ['GET', '^/cgi/events/$',
+     measure_async_route('GET', '/cgi/events/', async_cgi_events)],
+]
+
+
+# Prometheus text format
+@bottle.get('/cgi/metrics')
+@bottle.get('/cgi/metrics/')
+def cgi_metrics():
+    return bottle.HTTPResponse(
+        metrics.render(), status=200,
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# Profiling results of requests answered by this process. Requires
+# config.PROFILE_TOKEN in X-Limbo-Profile header (not in URL, so it is
+# not logged).
+# Text report or aggregated cProfile data of route (format=pstats).
+@bottle.get('/cgi/profile/')
+def cgi_profile():
+    if profiler is None or not check_profile_token():
+        return bottle.HTTPError(404, 'Not found.')
+    query = bottle.request.query
+    if query.format == 'pstats':
+        data = profiler.get_pstats_dump(query.route)
+        if data is None:
+            return bottle.HTTPError(404, 'No profile of route.')
+        return bottle.HTTPResponse(data, status=200, headers={
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': 'attachment; filename="limbo.pstats"'})
+    try:
+        limit = int(query.limit or 20)
+    except ValueError:
+        return bottle.HTTPError(400, 'Invalid limit.')
+    return bottle.HTTPResponse(profiler.render_report(limit), status=200,
+                               headers={'Content-Type':
+                                        'text/plain; charset=utf-8'})
+
+
+@bottle.post('/cgi/profile/reset/')
+def cgi_profile_reset():
+    if profiler is None or not check_profile_token():
+        return bottle.HTTPError(404, 'Not found.')
+    profiler.reset()
+    return 'OK'
+
+
+def check_profile_token():
+    return profiler.is_token_valid(
+        bottle.request.get_header(PROFILE_HEADER, ''))
+
+
 @bottle.post('/cgi/remove/')
 def cgi_remove():
-    log('Remove file begin')
+    logger.debug('Remove file begin')
     urlpath = bottle.request.forms.fileName
     storage.remove_file(urlpath)
     return 'OK'
@@ -217,7 +969,10 @@ def server_favicon():
 
 @bottle.route(STORAGE_URL_SUBDIR + '<url_filename>')
 def server_storage(url_filename):
-    log('File download: ' + url_filename)
+    logger.debug('File download', file=url_filename)
+    record = storage.get_file_record(url_filename)
+    if record is None:
+        return bottle.HTTPError(404, 'File does not exist.')
     filedir, disk_filename, display_filename = \
         storage.get_file_info_to_read(url_filename)
 
@@ -232,28 +987,131 @@ def server_storage(url_filename):
     mimetype, encoding = mimetypes.guess_type(mime_filename)
     mimetype = str(mimetype)
     if mimetype.startswith('text/'):
-        mimetype = 'text/plain'
+        mimetype = 'text/plain; charset=UTF-8'
     elif not mimetype.startswith('image/'):
         mimetype = ''
     showpreview = mimetype != ''
     quoted_display_filename = urllib_quote(display_filename)
 
+    headers = {}
     if showpreview:
-        response = bottle.static_file(disk_filename,
-                                      root=filedir,
-                                      mimetype=mimetype)
-        content_disposition = 'inline; filename="%s"' % \
+        headers['Content-Disposition'] = 'inline; filename="%s"' % \
             quoted_display_filename
-        response.set_header('Content-Disposition', content_disposition)
     else:
-        response = bottle.static_file(disk_filename,
-                                      root=filedir,
-                                      download=quoted_display_filename)
+        mimetype = 'application/octet-stream'
+        headers['Content-Disposition'] = 'attachment; filename="%s"' % \
+            quoted_display_filename
+
+    # Uploaded file is never modified. But file with the same name may be
+    # uploaded again after removal, so cached copy must be revalidated.
+    # Revalidation is cheap thanks to ETag.
+    if record['hash'] is not None:
+        etag = '"' + record['hash'] + '"'
+        digest_algorithm = DIGEST_ALGORITHMS.get(record['hash_algorithm'])
+        if digest_algorithm is not None:
+            name, is_base64 = digest_algorithm
+            value = record['hash']
+            if is_base64:
+                value = b64encode(bytes.fromhex(value)).decode('ascii')
+            headers['Digest'] = name + '=' + value
+    else:
+        etag = 'W/"%x-%x"' % (record['size'], record['modified'])
+    headers['ETag'] = etag
+    headers['Last-Modified'] = http_date(record['modified'])
+    headers['Cache-Control'] = 'public, no-cache'
+    headers['Accept-Ranges'] = 'bytes'
+
+    environ = bottle.request.environ
+    if is_not_modified(environ, etag, record['modified']):
+        headers.pop('Digest', None)
+        return bottle.HTTPResponse(status=304, headers=headers)
+
+    try:
+        fp = io_open(os_path.join(filedir, disk_filename), 'rb')
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'File does not exist.')
+
+    size = record['size']
+    ranges = None
+    if if_range_matches(environ, etag, record['modified']):
+        ranges = parse_range_header(environ.get('HTTP_RANGE'), size)
+
+    if ranges is None:
+        headers['Content-Type'] = mimetype
+        headers['Content-Length'] = str(size)
+        # File-like body is passed to wsgi.file_wrapper by bottle,
+        # so server may use sendfile()
+        body = FileRange(fp, 0, size, start_download(size))
+        return bottle.HTTPResponse(body, status=200, headers=headers)
+
+    if not ranges:
+        fp.close()
+        headers['Content-Range'] = 'bytes */%d' % size
+        return bottle.HTTPResponse(status=416, headers=headers)
+
+    if len(ranges) == 1:
+        offset, length = ranges[0]
+        headers['Content-Type'] = mimetype
+        headers['Content-Range'] = content_range(offset, length, size)
+        headers['Content-Length'] = str(length)
+        body = FileRange(fp, offset, length, start_download(length))
+        return bottle.HTTPResponse(body, status=206, headers=headers)
+
+    content_type, content_length, body = \
+        multipart_byteranges(fp, ranges, size, mimetype)
+    headers['Content-Type'] = content_type
+    headers['Content-Length'] = str(content_length)
+    body = iter_and_call(body, start_download(content_length))
+    return bottle.HTTPResponse(body, status=206, headers=headers)
+
+
+# Profiles requests when enabled (see config.PROFILE_SAMPLE_RATE).
+# Made by each worker process.
+profiler = None
 
-    response.set_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-    response.set_header('Pragma', 'no-cache')
-    response.set_header('Expires', '0')
-    return response
+
+def make_profiler():
+    if config.PROFILE_SAMPLE_RATE <= 0 and not config.PROFILE_TOKEN:
+        return None
+    modes = [mode.strip() for mode in config.PROFILE_MODES.split(',')
+             if mode.strip()]
+    return ProfilingMiddleware(bottle.app(), config.PROFILE_SAMPLE_RATE,
+                               config.PROFILE_TOKEN, modes,
+                               ['/cgi/profile/'])
+
+
+# reuse_port allows several processes to listen on the same port
+def run_web_server(reuse_port=False):
+    global profiler
+    profiler = make_profiler()
+    server_name = config.WEB_SERVER
+    server_options = {}
+    if server_name == 'threaded':
+        # wsgiref with pool of worker threads and persistent connections
+        server_name = 'wsgiref'
+        server_options['server_class'] = make_thread_pool_server_class(
+            config.SERVER_THREADS, config.SERVER_QUEUE_SIZE,
+            config.SERVER_KEEPALIVE_SECONDS, reuse_port)
+        server_options['handler_class'] = ThreadedRequestHandler
+    elif server_name == 'wsgiref':
+        server_options['handler_class'] = SendfileRequestHandler
+    elif server_name == 'asyncio':
+        server_name = AsyncioServer(
+            host=config.LISTEN_HOST, port=config.LISTEN_PORT,
+            threads=config.SERVER_THREADS,
+            backlog=config.SERVER_QUEUE_SIZE,
+            keepalive_timeout=config.SERVER_KEEPALIVE_SECONDS,
+            routes=ASYNC_ROUTES, reuse_port=reuse_port)
+
+    app = bottle.app()
+    if profiler is not None:
+        app = profiler
+    bottle.run(app=app,
+               server=server_name,
+               host=config.LISTEN_HOST,
+               port=config.LISTEN_PORT,
+               debug=config.IS_DEBUG,
+               **server_options)
 
 
 if __name__ == '__main__':
@@ -276,15 +1134,21 @@ if __name__ == '__main__':
             ]:
         mimetypes.add_type('text/' + ext, '.' + ext)
 
-    storage.start()
-
-    log('Start server...')
-
-    bottle.run(app=bottle.app(),
-               server=config.WEB_SERVER,
-               host=config.LISTEN_HOST,
-               port=config.LISTEN_PORT,
-               debug=config.IS_DEBUG)
+    if config.WORKER_PROCESSES > 1:
+        if config.WEB_SERVER not in ['threaded', 'asyncio']:
+            raise Exception('Worker processes are supported by threaded and '
+                            'asyncio web servers only', config.WEB_SERVER)
+        log('Start ' + str(config.WORKER_PROCESSES) + ' worker processes...')
+        # All workers listen on the same port. Storage retension is done
+        # by this process.
+        pids = fork_workers(config.WORKER_PROCESSES,
+                            lambda index: run_web_server(True))
+        storage.start()
+        wait_workers(pids)
+    else:
+        storage.start()
+        log('Start server...')
+        run_web_server()
 
     log('Unloading...')
     storage.stop()
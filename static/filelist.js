@@ -0,0 +1,153 @@
+// Limbo file sharing (https://github.com/kolomenkin/limbo)
+// Copyright 2018 Sergey Kolomenkin
+// Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+
+var formatSize = function(b) {
+	if (b < 10000) {
+		return b + " B"
+	} else if (b < 10000000) {
+		return (b / 1000).toFixed(0) + " KB"
+	} else if (b < 10000000000) {
+		return (b / 1000000).toFixed(0) + " MB"
+	} else if (b < 10000000000000) {
+		return (b / 1000000000).toFixed(0) + " GB"
+	}
+	return (b / 1000000000000).toFixed(0) + " TB"
+}
+
+var formatAge = function(a) {
+	if (a < 120) {
+		return Math.floor(Math.max(a, 0)) + "s"
+	}
+	a = Math.floor(a / 60)
+	if (a < 60) {
+		return a + " m"
+	}
+	return Math.floor(a / 60) + "h " + (a % 60) + "m"
+}
+
+// Table of files rendered in browser. Only rows visible in scrolled
+// viewport element (and a few around) are in DOM, so page cost doesn't
+// grow with number of files. All rows have the same height.
+// onRemove(fileName) is called by row remove button.
+var VirtualFileList = function(viewport, tbody, onRemove) {
+	var self = this
+	this.viewport = viewport
+	this.tbody = $(tbody)
+	this.onRemove = onRemove
+	this.files = {} // url_filename -> file
+	this.shown = [] // filtered and sorted files
+	this.sortField = "modified"
+	this.sortDescending = true
+	this.filter = ""
+	this.topSpacer = $('<tr class="spacer"><td colspan="5"></td></tr>')
+	this.bottomSpacer = $('<tr class="spacer"><td colspan="5"></td></tr>')
+	this.tbody.empty().append(this.topSpacer, this.bottomSpacer)
+
+	var renderPending = false
+	var scheduleRender = function() {
+		if (!renderPending) {
+			renderPending = true
+			window.requestAnimationFrame(function() {
+				renderPending = false
+				self.render()
+			})
+		}
+	}
+	$(viewport).on("scroll", scheduleRender)
+	$(window).on("resize", scheduleRender)
+}
+
+VirtualFileList.ROW_HEIGHT = 37
+VirtualFileList.OVERSCAN_ROWS = 10
+
+// changes are files, removed and reset fields of /cgi/events/ message
+VirtualFileList.prototype.applyChanges = function(changes) {
+	var files = this.files
+	if (changes.reset) {
+		files = this.files = {}
+	}
+	changes.removed.forEach(function(fileName) {
+		delete files[fileName]
+	})
+	changes.files.forEach(function(file) {
+		files[file.url_filename] = file
+	})
+	this.update()
+}
+
+VirtualFileList.prototype.remove = function(fileName) {
+	delete this.files[fileName]
+	this.update()
+}
+
+VirtualFileList.prototype.setFilter = function(text) {
+	this.filter = text.toLowerCase()
+	this.update()
+}
+
+// The second click on the same column reverses order
+VirtualFileList.prototype.sortBy = function(field) {
+	if (this.sortField === field) {
+		this.sortDescending = !this.sortDescending
+	} else {
+		this.sortField = field
+		this.sortDescending = field !== "display_filename"
+	}
+	this.update()
+}
+
+VirtualFileList.prototype.update = function() {
+	var files = this.files
+	var filter = this.filter
+	var field = this.sortField
+	var order = this.sortDescending ? -1 : 1
+	var compare = function(x, y) {
+		return x < y ? -1 : (x > y ? 1 : 0)
+	}
+	this.shown = Object.keys(files).map(function(fileName) {
+		return files[fileName]
+	}).filter(function(file) {
+		return !filter || file.display_filename.toLowerCase().indexOf(filter) >= 0
+	})
+	this.shown.sort(function(a, b) {
+		var x = a[field]
+		var y = b[field]
+		if (typeof x === "string") {
+			x = x.toLowerCase()
+			y = y.toLowerCase()
+		}
+		return order * compare(x, y) || compare(a.url_filename, b.url_filename)
+	})
+	this.render()
+}
+
+VirtualFileList.prototype.render = function() {
+	var height = VirtualFileList.ROW_HEIGHT
+	var first = Math.max(0, Math.floor(this.viewport.scrollTop / height) - VirtualFileList.OVERSCAN_ROWS)
+	var last = Math.min(this.shown.length,
+		first + Math.ceil(this.viewport.clientHeight / height) + 2 * VirtualFileList.OVERSCAN_ROWS)
+	var now = Date.now() / 1000
+	var rows = []
+	for (var i = first; i < last; i++) {
+		rows.push(this.makeRow(this.shown[i], i, now))
+	}
+	this.tbody.children(".file-row").remove()
+	this.topSpacer.css("height", first * height + "px")
+	this.bottomSpacer.css("height", (this.shown.length - last) * height + "px")
+	this.topSpacer.after(rows)
+}
+
+VirtualFileList.prototype.makeRow = function(file, index, now) {
+	var onRemove = this.onRemove
+	var button = $('<button type="button" class="btn btn-danger btn-xs">&times;</button>')
+	button.on("click", function() {
+		onRemove(file.url_filename)
+	})
+	return $('<tr class="file-row">').append(
+		$('<td class="text-center">').text(index + 1),
+		$("<td>").append($("<a>").attr("href", file.url).text(file.display_filename)),
+		$('<td class="text-right" style="font-family: monospace;">').text(formatSize(file.size)),
+		$('<td style="font-family: monospace;">').text(formatAge(now - file.modified)),
+		$('<td class="text-center">').append(button))[0]
+}
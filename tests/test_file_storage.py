@@ -1,14 +1,22 @@
 from base64 import b64decode
+from hashlib import sha256
 from numpy import random
-from os import path as os_path
+from os import makedirs as os_makedirs, path as os_path, \
+    remove as os_remove, rename as os_rename
 from tempfile import TemporaryDirectory
-from unittest import TestCase
+from threading import Thread
+from time import sleep as time_sleep
+from unittest import TestCase, skipUnless
+from zlib import crc32 as zlib_crc32
 
 # add parent dir to search for imported modules
 # import os, sys
 # script_dir = os.path.dirname(os.path.abspath(__file__))
 # sys.path.insert(0, script_dir + '/../')
-from lib_file_storage import FileStorage
+from lib_file_storage import DURABILITY_POLICIES, \
+    EXPIRY_QUEUE_MIN_REBUILD_SIZE, FileStorage, HASH_ALGORITHMS, \
+    StorageFullError, UploadChecksumError, UploadOffsetError, ZlibChecksum, \
+    is_inotify_available, retention_pass_duration, scan_directory
 
 
 def get_random_bytes(size, seed):
@@ -146,8 +154,676 @@ class FileStorageTestCase(TestCase):
         storage.remove_all_files()
 
         self.assertEqual(0, len(storage.enumerate_files()))
+        self.assertEqual([], storage._expiry_queue)
 
     def test_start_stop(self):
         tmpdirname, storage = GetFileStorage()
         storage.start()
         storage.stop()
+
+    def test_index_metadata(self):
+        tmpdirname, storage = GetFileStorage()
+
+        with storage.open_file_writer('file1.txt') as writer:
+            writer.write(b'abc')
+
+        files = storage.enumerate_files()
+        self.assertEqual(1, len(files))
+        self.assertEqual(3, files[0]['size'])
+        self.assertEqual(int(os_path.getmtime(files[0]['full_disk_filename'])),
+                         files[0]['modified'])
+
+        # index is built from directory content on storage creation:
+        storage2 = FileStorage(tmpdirname.name, 24 * 3600)
+        files2 = storage2.enumerate_files()
+        self.assertEqual(files, files2)
+
+    def test_expiry(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 1)
+        storage.start()
+        try:
+            with storage.open_file_writer('file1.txt') as writer:
+                writer.write(b'abc')
+            fullname = storage.enumerate_files()[0]['full_disk_filename']
+
+            # file must be removed in about 1 second
+            for _ in range(50):
+                if not storage.enumerate_files():
+                    break
+                time_sleep(0.1)
+
+            self.assertEqual(0, len(storage.enumerate_files()))
+            self.assertFalse(os_path.exists(fullname))
+        finally:
+            storage.stop()
+
+    def test_expiry_queue_size(self):
+        tmpdirname, storage = GetFileStorage()
+        with storage.open_file_writer('kept.txt') as writer:
+            writer.write(b'abc')
+        # storage isn't started, so entries of removed files are not
+        # popped from expiry queue by retension thread
+        for index in range(EXPIRY_QUEUE_MIN_REBUILD_SIZE + 100):
+            with storage.open_file_writer('file.txt') as writer:
+                writer.write(b'abc')
+            storage.remove_file([
+                item['url_filename'] for item in storage.enumerate_files()
+                if item['display_filename'] == 'file.txt'][0])
+        self.assertEqual(1, len(storage.enumerate_files()))
+        self.assertLessEqual(len(storage._expiry_queue),
+                             EXPIRY_QUEUE_MIN_REBUILD_SIZE)
+        self.assertIn(storage.enumerate_files()[0]['disk_filename'],
+                      [name for deadline, name in storage._expiry_queue])
+
+    def test_retention_pass_metric(self):
+        def get_pass_count():
+            lines = retention_pass_duration.render()
+            return int(lines[-1].split(' ')[-1])
+
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600, shared=True)
+        storage.start()
+        try:
+            time_sleep(1.5)
+            # the first pass after the first poll sweeps temp directory
+            count = get_pass_count()
+            # journal is polled every second, it is not a retention pass
+            time_sleep(2)
+            self.assertEqual(count, get_pass_count())
+        finally:
+            storage.stop()
+
+    def test_scan_directory(self):
+        tmpdirname, storage = GetFileStorage()
+
+        with storage.open_file_writer('file1.txt') as writer:
+            writer.write(b'abcd')
+
+        # 'incomplete' subdirectory must be skipped:
+        records = scan_directory(tmpdirname.name)
+        self.assertEqual(1, len(records))
+        self.assertEqual('file1.txt', records[0]['disk_filename'])
+        self.assertEqual(4, records[0]['size'])
+        self.assertEqual([], scan_directory(
+            os_path.join(tmpdirname.name, 'not_existing')))
+
+    def test_sharded_layout(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600, 2)
+
+        with storage.open_file_writer('file1.txt') as writer:
+            writer.write(b'abc')
+
+        item = storage.enumerate_files()[0]
+        self.assertEqual('file1.txt', item['url_filename'])
+        self.assertEqual(3, item['relative_disk_filename'].count('/') + 1)
+        self.assertEqual(os_path.join(tmpdirname.name,
+                                      item['relative_disk_filename']),
+                         item['full_disk_filename'])
+
+        storage_directory, disk_filename, display_filename = \
+            storage.get_file_info_to_read('file1.txt')
+        self.assertEqual(os_path.dirname(item['full_disk_filename']),
+                         storage_directory)
+        with open(os_path.join(storage_directory, disk_filename), 'rb') as f:
+            self.assertEqual(b'abc', f.read())
+
+        storage.remove_file('file1.txt')
+        self.assertEqual(0, len(storage.enumerate_files()))
+
+    def test_sharded_layout_migration(self):
+        tmpdirname, storage = GetFileStorage()
+
+        # 'ab' file name clashes with shard directory names
+        filenames = ['ab', 'file1.txt', 'file2.txt']
+        for filename in filenames:
+            with storage.open_file_writer(filename) as writer:
+                writer.write(filename.encode('utf-8'))
+
+        def check_files(storage):
+            files = sorted(storage.enumerate_files(),
+                           key=lambda item: item['url_filename'])
+            self.assertEqual(filenames,
+                             [item['url_filename'] for item in files])
+            for item in files:
+                with open(item['full_disk_filename'], 'rb') as f:
+                    self.assertEqual(item['url_filename'].encode('utf-8'),
+                                     f.read())
+
+        # flat -> sharded
+        storage = FileStorage(tmpdirname.name, 24 * 3600, 2)
+        check_files(storage)
+        self.assertFalse(os_path.isfile(os_path.join(tmpdirname.name, 'ab')))
+
+        # sharded -> flat
+        storage = FileStorage(tmpdirname.name, 24 * 3600)
+        check_files(storage)
+        self.assertTrue(os_path.isfile(os_path.join(tmpdirname.name, 'ab')))
+
+    def test_deduplication(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              hash_algorithm='sha256', deduplicate=True)
+
+        data = get_random_bytes(12345, 42)
+        for filename in ['file1.dat', 'file2.dat']:
+            with storage.open_file_writer(filename) as writer:
+                writer.write(data)
+        with storage.open_file_writer('file3.dat') as writer:
+            writer.write(b'other data')
+
+        files = {item['url_filename']: item
+                 for item in storage.enumerate_files()}
+        self.assertEqual(3, len(files))
+        self.assertEqual(files['file1.dat']['hash'],
+                         files['file2.dat']['hash'])
+        self.assertTrue(os_path.samefile(
+            files['file1.dat']['full_disk_filename'],
+            files['file2.dat']['full_disk_filename']))
+        self.assertFalse(os_path.samefile(
+            files['file1.dat']['full_disk_filename'],
+            files['file3.dat']['full_disk_filename']))
+
+        # blob is kept while it has other names:
+        storage.remove_file('file1.dat')
+        with open(files['file2.dat']['full_disk_filename'], 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        # new upload is linked to remaining name:
+        with storage.open_file_writer('file4.dat') as writer:
+            writer.write(data)
+        self.assertTrue(os_path.samefile(
+            files['file2.dat']['full_disk_filename'],
+            os_path.join(tmpdirname.name, 'file4.dat')))
+
+    def test_hash_algorithms(self):
+        data = b'The quick brown fox jumped over the lazy dog'
+        for hash_algorithm in sorted(HASH_ALGORITHMS.keys()):
+            tmpdirname = TemporaryDirectory()
+            storage = FileStorage(tmpdirname.name, 24 * 3600,
+                                  hash_algorithm=hash_algorithm)
+            with storage.open_file_writer('file.txt') as writer:
+                writer.write(data[:10])
+                writer.write(data[10:])
+
+            hasher = HASH_ALGORITHMS[hash_algorithm]()
+            hasher.update(data)
+            record = storage.get_file_record('file.txt')
+            self.assertEqual(hash_algorithm, record['hash_algorithm'])
+            self.assertEqual(hasher.hexdigest(), record['hash'])
+
+        checksum = ZlibChecksum(zlib_crc32)
+        checksum.update(data[:10])
+        checksum.update(data[10:])
+        self.assertEqual('%08x' % zlib_crc32(data), checksum.hexdigest())
+
+    def test_upload_session(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              hash_algorithm='sha256')
+        data = get_random_bytes(100000, 42)
+
+        session = storage.create_upload_session('file.dat', len(data))
+        session_id = session.session_id
+        self.assertEqual(0, session.offset)
+        self.assertEqual(40000, session.write(0, [data[:30000],
+                                                  data[30000:40000]]))
+        with self.assertRaises(UploadOffsetError) as context:
+            session.write(100001, [b'a'])
+        self.assertEqual(100001, context.exception.offset)
+        # part after the gap:
+        self.assertEqual(40000, session.write(70000, [data[70000:]]))
+        self.assertEqual([[0, 40000], [70000, 100000]], session.ranges)
+        self.assertFalse(session.is_complete)
+        with self.assertRaises(Exception):
+            storage.commit_upload_session(session)
+
+        # upload is resumed after restart:
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              hash_algorithm='sha256')
+        self.assertIsNone(storage.get_upload_session('0' * 32))
+        self.assertIsNone(storage.get_upload_session('../file.dat'))
+        session = storage.get_upload_session(session_id)
+        self.assertEqual(40000, session.offset)
+        # overlapping part:
+        self.assertEqual(100000, session.write(30000, [data[30000:80000]]))
+        with self.assertRaises(UploadChecksumError):
+            storage.commit_upload_session(session, sha256(b'').hexdigest())
+        storage.commit_upload_session(session, sha256(data).hexdigest())
+
+        record = storage.get_file_record('file.dat')
+        self.assertEqual(len(data), record['size'])
+        self.assertEqual(sha256(data).hexdigest(), record['hash'])
+        with open(record['full_disk_filename'], 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual([], scan_directory(
+            os_path.join(tmpdirname.name, 'incomplete')))
+        self.assertIsNone(storage.get_upload_session(session_id))
+
+        # session of unknown size without the beginning of file:
+        session = storage.create_upload_session('file3.dat')
+        self.assertEqual(0, session.write(5, [b'fghij']))
+        self.assertEqual([[5, 10]], session.ranges)
+        self.assertFalse(session.is_complete)
+        with self.assertRaises(Exception):
+            storage.commit_upload_session(session)
+        self.assertIsNone(storage.get_file_record('file3.dat'))
+        self.assertEqual(10, session.write(0, [b'abcde']))
+        self.assertTrue(session.is_complete)
+        storage.commit_upload_session(session)
+        record = storage.get_file_record('file3.dat')
+        with open(record['full_disk_filename'], 'rb') as f:
+            self.assertEqual(b'abcdefghij', f.read())
+
+        # empty file:
+        session = storage.create_upload_session('file4.dat')
+        self.assertTrue(session.is_complete)
+        storage.commit_upload_session(session)
+        self.assertEqual(0, storage.get_file_record('file4.dat')['size'])
+
+        session = storage.create_upload_session('file2.dat')
+        session.write(0, [b'abc'])
+        storage.abort_upload_session(session)
+        self.assertIsNone(storage.get_upload_session(session.session_id))
+        self.assertEqual([], scan_directory(
+            os_path.join(tmpdirname.name, 'incomplete')))
+
+    def test_upload_session_writer(self):
+        tmpdirname, storage = GetFileStorage()
+        session = storage.create_upload_session('file.dat', 10)
+        with session.open_writer(2) as writer:
+            for chunk in [b'cd', b'ef', b'gh']:
+                writer.write(chunk)
+            # range is recorded when writer is closed
+            self.assertEqual([], session.ranges)
+            self.assertFalse(session.is_complete)
+        with self.assertRaises(UploadOffsetError) as context:
+            with session.open_writer(8) as writer:
+                writer.write(b'ij')
+                writer.write(b'k')  # exceeds declared size
+        self.assertEqual(11, context.exception.offset)
+        # data received before an error is kept
+        self.assertEqual([[2, 10]], session.ranges)
+        with open(session.state_filename, encoding='utf-8') as f:
+            self.assertEqual(['2 8', '8 10'], f.read().splitlines()[1:])
+        session.write(0, [b'ab'])
+        storage.commit_upload_session(session)
+        with open(storage.get_file_record('file.dat')['full_disk_filename'],
+                  'rb') as f:
+            self.assertEqual(b'abcdefghij', f.read())
+
+    def test_upload_session_parallel_parts(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              hash_algorithm='sha256')
+        data = get_random_bytes(1000000, 42)
+        part_size = 65536
+        session = storage.create_upload_session('file.dat', len(data))
+
+        def write_parts(offsets):
+            for offset in offsets:
+                session.write(offset, [data[offset:offset + part_size]])
+
+        offsets = list(reversed(range(0, len(data), part_size)))
+        threads = [Thread(target=write_parts, args=(offsets[i::4],))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(session.is_complete)
+        storage.commit_upload_session(session)
+        record = storage.get_file_record('file.dat')
+        self.assertEqual(sha256(data).hexdigest(), record['hash'])
+        with open(record['full_disk_filename'], 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_write_policies(self):
+        data = get_random_bytes(300000, 42)
+        for durability in DURABILITY_POLICIES:
+            for buffer_size in [-1, 0, 1024 * 1024]:
+                tmpdirname = TemporaryDirectory()
+                storage = FileStorage(tmpdirname.name, 24 * 3600,
+                                      write_buffer_size=buffer_size,
+                                      durability=durability)
+                # size is upper bound: preallocated space is freed
+                with storage.open_file_writer('file.dat',
+                                              len(data) + 12345) as writer:
+                    writer.write(data[:100000])
+                    writer.write(data[100000:])
+                record = storage.get_file_record('file.dat')
+                self.assertEqual(len(data), record['size'])
+                with open(record['full_disk_filename'], 'rb') as f:
+                    self.assertEqual(data, f.read())
+
+                session = storage.create_upload_session('file2.dat',
+                                                        len(data))
+                session.write(0, [data])
+                storage.commit_upload_session(session)
+                self.assertEqual(len(data), storage.get_file_record(
+                    'file2.dat')['size'])
+
+        with self.assertRaises(Exception):
+            FileStorage(tmpdirname.name, 24 * 3600, durability='always')
+
+    def test_quota(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              max_storage_bytes=1000)
+
+        def store(filename, size, declared_size):
+            with storage.open_file_writer(filename, declared_size) as writer:
+                writer.write(b'x' * size)
+
+        def stored_files():
+            return sorted(item['url_filename']
+                          for item in storage.enumerate_files())
+
+        # files of the same age are evicted in name order
+        store('a', 400, 400)
+        store('b', 400, 400)
+        store('c', 400, 400)
+        self.assertEqual(['b', 'c'], stored_files())
+        self.assertEqual([800, 0, 1000], storage.get_usage())
+
+        with self.assertRaises(StorageFullError):
+            store('big', 2000, 2000)
+        self.assertEqual(['b', 'c'], stored_files())
+
+        # space is reserved while file is uploaded:
+        writer = storage.open_file_writer('d', 500)
+        self.assertEqual(['c'], stored_files())
+        self.assertEqual([400, 500, 1000], storage.get_usage())
+        writer.abort()
+        self.assertEqual([400, 0, 1000], storage.get_usage())
+
+        # reservation is released if file can't be stored
+        with self.assertRaisesRegex(Exception, 'already exists'):
+            storage.open_file_writer('c', 100)
+        self.assertEqual([400, 0, 1000], storage.get_usage())
+
+        def fail_commit(atomic_file, original_filename):
+            raise Exception('Rename is failed')
+
+        storage._commit_file = fail_commit
+        with self.assertRaisesRegex(Exception, 'Rename is failed'):
+            store('f', 100, 100)
+        self.assertEqual([400, 0, 1000], storage.get_usage())
+        self.assertEqual([], scan_directory(
+            os_path.join(tmpdirname.name, 'incomplete')))
+        del storage._commit_file
+
+        # space for file of unknown size is reserved while it grows:
+        store('e', 700, None)
+        self.assertEqual(['e'], stored_files())
+        storage.remove_file('e')
+        self.assertEqual([0, 0, 1000], storage.get_usage())
+        with self.assertRaises(StorageFullError):
+            store('g', 1500, None)
+        self.assertEqual([], stored_files())
+        self.assertEqual([0, 0, 1000], storage.get_usage())
+
+        # upload session of unknown size
+        session = storage.create_upload_session('h')
+        with self.assertRaises(StorageFullError):
+            session.write(0, [b'x' * 1500])
+        # space for expected data size is reserved before it is received
+        with self.assertRaises(StorageFullError):
+            session.write(0, [], 1500)
+        session.write(0, [b'x' * 600])
+        self.assertEqual([0, 600, 1000], storage.get_usage())
+        session.write(600, [b'x' * 100], 100)
+        self.assertEqual([0, 700, 1000], storage.get_usage())
+        storage.commit_upload_session(session)
+        self.assertEqual(['h'], stored_files())
+        self.assertEqual([700, 0, 1000], storage.get_usage())
+        storage.remove_file('h')
+        self.assertEqual([], scan_directory(
+            os_path.join(tmpdirname.name, 'incomplete')))
+
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              min_free_bytes=2 ** 62)
+        with self.assertRaises(StorageFullError):
+            storage.check_space(0)
+
+    def test_unreachable_quota(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              max_storage_bytes=1000)
+        for filename in ['a', 'b', 'c']:
+            with storage.open_file_writer(filename, 100) as writer:
+                writer.write(b'x' * 100)
+
+        def stored_files():
+            return sorted(item['url_filename']
+                          for item in storage.enumerate_files())
+
+        # the other upload's reservation can't be evicted:
+        writer = storage.open_file_writer('d', 600)
+        with self.assertRaises(StorageFullError):
+            storage.check_space(500)
+        self.assertEqual(['a', 'b', 'c'], stored_files())
+        writer.abort()
+
+        # files are not evicted if free space watermark can't be met:
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              min_free_bytes=2 ** 62)
+        with self.assertRaises(StorageFullError):
+            storage.check_space(1)
+        self.assertEqual(['a', 'b', 'c'], stored_files())
+
+    def test_quota_deduplication(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              hash_algorithm='sha256', deduplicate=True,
+                              max_storage_bytes=1000)
+        for filename in ['a', 'b', 'c']:
+            with storage.open_file_writer(filename, 400) as writer:
+                writer.write(b'x' * 400)
+        # the same blob is counted once:
+        self.assertEqual(3, len(storage.enumerate_files()))
+        self.assertEqual([400, 0, 1000], storage.get_usage())
+        storage.remove_file('a')
+        storage.remove_file('b')
+        self.assertEqual([400, 0, 1000], storage.get_usage())
+        storage.remove_file('c')
+        self.assertEqual([0, 0, 1000], storage.get_usage())
+
+    def test_shared_storage(self):
+        tmpdirname = TemporaryDirectory()
+        # instances of different worker processes:
+        storage1 = FileStorage(tmpdirname.name, 24 * 3600, shared=True)
+        storage2 = FileStorage(tmpdirname.name, 24 * 3600, shared=True)
+
+        def stored_files(storage):
+            return sorted(record['display_filename']
+                          for record in storage.enumerate_files())
+
+        for filename in ['a', 'b']:
+            with storage1.open_file_writer(filename) as writer:
+                writer.write(b'1234')
+        self.assertEqual(['a', 'b'], stored_files(storage2))
+        self.assertEqual(4, storage2.get_file_record('b')['size'])
+        self.assertEqual([8, 0, 0], storage2.get_usage())
+
+        storage2.remove_file('a')
+        self.assertEqual(['b'], stored_files(storage1))
+        self.assertEqual([4, 0, 0], storage1.get_usage())
+        with storage2.open_file_writer('c') as writer:
+            writer.write(b'5678')
+        self.assertEqual(['b', 'c'], stored_files(storage1))
+        storage1.remove_all_files()
+        self.assertEqual([], stored_files(storage2))
+
+        # parts of upload session received by different processes
+        session = storage1.create_upload_session('d', 8)
+        storage2.get_upload_session(session.session_id).write(4, [b'5678'])
+        session.write(0, [b'1234'])
+        session = storage1.get_upload_session(session.session_id)
+        self.assertTrue(session.is_complete)
+        storage1.commit_upload_session(session)
+        self.assertEqual(['d'], stored_files(storage2))
+        self.assertIsNone(storage2.get_upload_session(session.session_id))
+
+    def test_listing_changes(self):
+        tmpdirname = TemporaryDirectory()
+        storage1 = FileStorage(tmpdirname.name, 24 * 3600, shared=True)
+        storage2 = FileStorage(tmpdirname.name, 24 * 3600, shared=True)
+        with storage1.open_file_writer('a') as writer:
+            writer.write(b'1234')
+        version = storage1.get_listing_version()
+        # the same version in all processes:
+        self.assertEqual(version, storage2.get_listing_version())
+        self.assertEqual([version, [], []],
+                         storage2.enumerate_changes(version))
+
+        with storage2.open_file_writer('b') as writer:
+            writer.write(b'1234')
+        storage2.remove_file('a')
+        for storage in [storage1, storage2]:
+            new_version, records, removed = \
+                storage.enumerate_changes(version)
+            self.assertNotEqual(version, new_version)
+            self.assertEqual(['b'], [record['display_filename']
+                                     for record in records])
+            self.assertEqual(['a'], removed)
+        self.assertIsNone(storage1.enumerate_changes('bad'))
+
+        # versions before clear or compaction are unknown
+        storage1.remove_all_files()
+        self.assertIsNone(storage2.enumerate_changes(version))
+        version = storage2.get_listing_version()
+        storage3 = FileStorage(tmpdirname.name, 24 * 3600, shared=True)
+        self.assertIsNone(storage1.enumerate_changes(version))
+        self.assertEqual(storage3.get_listing_version(),
+                         storage1.get_listing_version())
+
+    def test_metadata_journal(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 3600,
+                              hash_algorithm='sha256')
+        for filename in ['a:b.txt', 'c.txt', 'd.txt']:
+            with storage.open_file_writer(filename) as writer:
+                writer.write(b'abc')
+        storage.remove_file('c.txt')
+        files = sorted(storage.enumerate_files(),
+                       key=lambda item: item['url_filename'])
+        self.assertEqual(['a_b.txt', 'd.txt'],
+                         [item['url_filename'] for item in files])
+        # original file name is kept:
+        self.assertEqual('a:b.txt', files[0]['display_filename'])
+        self.assertEqual('a:b.txt', storage.get_file_info_to_read(
+            'a_b.txt')[2])
+        self.assertEqual(files[0]['modified'] + 3600, files[0]['expires'])
+
+        # restart: index is loaded from journal with exact metadata
+        # (expiry is not changed by new settings)
+        storage = FileStorage(tmpdirname.name, 24 * 3600,
+                              hash_algorithm='sha256')
+        files2 = sorted(storage.enumerate_files(),
+                        key=lambda item: item['url_filename'])
+        self.assertEqual(files, files2)
+        self.assertEqual(sha256(b'abc').hexdigest(), files2[0]['hash'])
+
+        # journal is compacted on start
+        journal = os_path.join(tmpdirname.name, 'metadata', 'journal.jsonl')
+        with open(journal, 'rb') as f:
+            self.assertEqual(3, len(f.read().splitlines()))
+
+    def test_metadata_journal_compaction(self):
+        for shared in [False, True]:
+            tmpdirname = TemporaryDirectory()
+            storage = FileStorage(tmpdirname.name, 24 * 3600, shared=shared)
+            for filename in ['a.txt', 'b.txt']:
+                with storage.open_file_writer(filename) as writer:
+                    writer.write(b'abc')
+            write_journal_file = storage._write_journal_file
+
+            def write_and_change_index(fullname, data, mode):
+                write_journal_file(fullname, data, mode)
+                if mode == 'wb':
+                    # index is not locked while snapshot is written
+                    with storage.open_file_writer('c.txt') as writer:
+                        writer.write(b'abc')
+                    storage.remove_file('a.txt')
+
+            storage._write_journal_file = write_and_change_index
+            storage._compact_journal()
+            # changes made meanwhile are kept in compacted journal
+            self.assertEqual(2, storage._journal_changes)
+            journal = os_path.join(tmpdirname.name, 'metadata',
+                                   'journal.jsonl')
+            with open(journal, 'rb') as f:
+                self.assertEqual(5, len(f.read().splitlines()))
+            storage2 = FileStorage(tmpdirname.name, 24 * 3600)
+            for instance in [storage, storage2]:
+                self.assertEqual(['b.txt', 'c.txt'], sorted(
+                    item['url_filename']
+                    for item in instance.enumerate_files()))
+
+    def test_metadata_journal_reconcile(self):
+        tmpdirname, storage = GetFileStorage()
+        for filename in ['a.txt', 'b.txt']:
+            with storage.open_file_writer(filename) as writer:
+                writer.write(b'abc')
+        # files changed while server is stopped:
+        os_remove(os_path.join(tmpdirname.name, 'a.txt'))
+        with open(os_path.join(tmpdirname.name, 'c.txt'), 'wb') as f:
+            f.write(b'abcd')
+
+        storage = FileStorage(tmpdirname.name, 24 * 3600)
+        storage.start()
+        try:
+            for _ in range(50):
+                names = sorted(item['url_filename']
+                               for item in storage.enumerate_files())
+                if names == ['b.txt', 'c.txt']:
+                    break
+                time_sleep(0.1)
+            self.assertEqual(['b.txt', 'c.txt'], names)
+            self.assertEqual([7, 0, 0], storage.get_usage())
+        finally:
+            storage.stop()
+
+    @skipUnless(is_inotify_available(), 'inotify is not available')
+    def test_watch(self):
+        tmpdirname = TemporaryDirectory()
+        storage = FileStorage(tmpdirname.name, 24 * 3600, 1, watch=True)
+        storage.start()
+
+        def wait_files(expected):
+            for _ in range(50):
+                names = sorted(item['url_filename']
+                               for item in storage.enumerate_files())
+                if names == expected:
+                    break
+                time_sleep(0.1)
+            self.assertEqual(expected, names)
+
+        try:
+            with storage.open_file_writer('a:b.txt') as writer:
+                writer.write(b'abc')
+            wait_files(['a_b.txt'])
+
+            # files added, moved and removed by other programs
+            shard_dir = storage.get_file_info_to_read('c.txt')[0]
+            os_makedirs(shard_dir, exist_ok=True)
+            with open(os_path.join(shard_dir, 'c.txt'), 'wb') as f:
+                f.write(b'abcd')
+            wait_files(['a_b.txt', 'c.txt'])
+            self.assertEqual(4, storage.get_file_record('c.txt')['size'])
+            d_fullname = os_path.join(
+                storage.get_file_info_to_read('d.txt')[0], 'd.txt')
+            os_makedirs(os_path.dirname(d_fullname), exist_ok=True)
+            os_rename(os_path.join(shard_dir, 'c.txt'), d_fullname)
+            wait_files(['a_b.txt', 'd.txt'])
+            os_remove(d_fullname)
+            wait_files(['a_b.txt'])
+
+            # upload committed by storage itself keeps its metadata
+            self.assertEqual('a:b.txt', storage.enumerate_files()[0][
+                'display_filename'])
+        finally:
+            storage.stop()
@@ -0,0 +1,95 @@
+from io import BytesIO
+from unittest import TestCase
+
+from lib_http import http_date, if_range_matches, IncompleteBodyError, \
+    is_not_modified, iter_request_body, parse_range_header
+
+
+class HttpTestCase(TestCase):
+
+    def test_parse_range_header(self):
+        self.assertEqual(None, parse_range_header(None, 100))
+        self.assertEqual([[0, 10]], parse_range_header('bytes=0-9', 100))
+        self.assertEqual([[90, 10]], parse_range_header('bytes=90-', 100))
+        self.assertEqual([[95, 5]], parse_range_header('bytes=-5', 100))
+        self.assertEqual([[0, 100]], parse_range_header('bytes=-500', 100))
+        self.assertEqual([[50, 50]], parse_range_header('bytes=50-500', 100))
+        self.assertEqual([[0, 1], [10, 2]],
+                         parse_range_header('bytes=0-0, 10-11', 100))
+        # unsatisfiable:
+        self.assertEqual([], parse_range_header('bytes=100-', 100))
+        self.assertEqual([], parse_range_header('bytes=200-300', 100))
+        # malformed headers are ignored:
+        self.assertEqual(None, parse_range_header('bytes=9-0', 100))
+        self.assertEqual(None, parse_range_header('bytes=a-b', 100))
+        self.assertEqual(None, parse_range_header('items=0-9', 100))
+        self.assertEqual(None, parse_range_header('bytes=0', 100))
+
+    def test_is_not_modified(self):
+        etag = '"abc"'
+        modified = 1500000000
+        self.assertFalse(is_not_modified({}, etag, modified))
+        self.assertTrue(is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '"xyz", "abc"'}, etag, modified))
+        self.assertTrue(is_not_modified(
+            {'HTTP_IF_NONE_MATCH': 'W/"abc"'}, etag, modified))
+        self.assertTrue(is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '*'}, etag, modified))
+        self.assertFalse(is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '"xyz"'}, etag, modified))
+        self.assertTrue(is_not_modified(
+            {'HTTP_IF_MODIFIED_SINCE': http_date(modified)}, etag, modified))
+        self.assertFalse(is_not_modified(
+            {'HTTP_IF_MODIFIED_SINCE': http_date(modified - 1)},
+            etag, modified))
+        # If-None-Match takes precedence:
+        self.assertFalse(is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '"xyz"',
+             'HTTP_IF_MODIFIED_SINCE': http_date(modified)}, etag, modified))
+
+    def test_if_range_matches(self):
+        etag = '"abc"'
+        modified = 1500000000
+        self.assertTrue(if_range_matches({}, etag, modified))
+        self.assertTrue(if_range_matches(
+            {'HTTP_IF_RANGE': '"abc"'}, etag, modified))
+        self.assertFalse(if_range_matches(
+            {'HTTP_IF_RANGE': '"xyz"'}, etag, modified))
+        self.assertFalse(if_range_matches(
+            {'HTTP_IF_RANGE': 'W/"abc"'}, 'W/"abc"', modified))
+        self.assertTrue(if_range_matches(
+            {'HTTP_IF_RANGE': http_date(modified)}, etag, modified))
+        self.assertFalse(if_range_matches(
+            {'HTTP_IF_RANGE': http_date(modified + 1)}, etag, modified))
+
+    def test_iter_request_body(self):
+        data = bytes(range(256)) * 1000
+        # body is limited by Content-Length:
+        environ = {'CONTENT_LENGTH': '100000',
+                   'wsgi.input': BytesIO(data)}
+        chunks = list(iter_request_body(environ, False, 1000, 16000))
+        self.assertEqual(data[:100000], b''.join(chunks))
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+        # chunk size grows while reads are full:
+        self.assertEqual([1000, 2000, 4000, 8000, 16000, 16000],
+                         [len(chunk) for chunk in chunks[:6]])
+
+        # stream ends before Content-Length:
+        environ = {'CONTENT_LENGTH': '300000',
+                   'wsgi.input': BytesIO(data)}
+        received = []
+        with self.assertRaises(IncompleteBodyError):
+            for chunk in iter_request_body(environ, False, 1000, 16000):
+                received.append(chunk)
+        self.assertEqual(data, b''.join(received))
+
+        # buffer is reused:
+        environ = {'CONTENT_LENGTH': '', 'wsgi.input': BytesIO(data)}
+        received = b''
+        buffers = set()
+        for chunk in iter_request_body(environ, True, 1000, 16000):
+            self.assertIsInstance(chunk, memoryview)
+            buffers.add(id(chunk.obj))
+            received += chunk
+        self.assertEqual(data, received)
+        self.assertEqual(1, len(buffers))
@@ -0,0 +1,79 @@
+from io import StringIO
+from json import loads as json_loads
+from threading import Event
+from unittest import TestCase
+
+from lib_log import DEBUG, ERROR, Logger, WARNING
+
+
+# Output stream blocking writes until it is released
+class BlockedStream(StringIO):
+    def __init__(self):
+        super().__init__()
+        self.released = Event()
+
+    def write(self, text):
+        self.released.wait()
+        return super().write(text)
+
+
+class LoggerTestCase(TestCase):
+
+    def test_text_output(self):
+        stream = StringIO()
+        logger = Logger(stream, level='info')
+        logger.debug('skipped')
+        logger.info('Upload', 'finished', bytes=10, name='a b.txt',
+                    duration=0.1234567)
+        logger.log(WARNING, 'Disk', 'is', 'full')
+        logger.stop()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].startswith('INF> '))
+        self.assertTrue(lines[0].endswith(
+            ': Upload finished bytes=10 name="a b.txt" duration=0.123457'))
+        self.assertTrue(lines[1].startswith('WRN> '))
+        self.assertTrue(lines[1].endswith(': Disk is full'))
+
+    def test_json_output(self):
+        stream = StringIO()
+        logger = Logger(stream, level=DEBUG, json_output=True)
+        logger.debug('Request', client='127.0.0.1', status=200)
+        logger.stop()
+        record = json_loads(stream.getvalue())
+        self.assertEqual('debug', record['level'])
+        self.assertEqual('Request', record['message'])
+        self.assertEqual('127.0.0.1', record['client'])
+        self.assertEqual(200, record['status'])
+        self.assertIsInstance(record['time'], float)
+
+    def test_unsupported_level(self):
+        with self.assertRaises(Exception):
+            Logger(level='verbose')
+
+    def test_request_rate_limit(self):
+        stream = StringIO()
+        logger = Logger(stream, requests_per_second=1)
+        for index in range(5):
+            logger.request('Request', index=index)
+        logger._request_limiter._tokens = 1  # as if a second passed
+        logger.request('Request', index=5)
+        logger.stop()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].endswith(': Request index=0'))
+        self.assertTrue(lines[1].endswith(': Request index=5 suppressed=4'))
+
+    def test_slow_output(self):
+        stream = BlockedStream()
+        logger = Logger(stream, max_queued=10)
+        # caller is not blocked by output
+        for index in range(100):
+            logger.info('Record', index=index)
+        logger.log(ERROR, 'Error')
+        stream.released.set()
+        logger.stop()
+        lines = stream.getvalue().splitlines()
+        self.assertLess(len(lines), 100)
+        self.assertTrue(lines[0].endswith(': Record index=0'))
+        self.assertIn('Log records are dropped dropped=', lines[-1])
@@ -0,0 +1,76 @@
+from threading import Thread
+from unittest import TestCase
+
+from lib_metrics import MetricsRegistry, TransferMetrics
+
+
+class MetricsTestCase(TestCase):
+
+    def test_counter(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'Test counter')
+        labeled = registry.counter('test_labeled_total', 'Test counter',
+                                   ['route'])
+
+        def procedure():
+            for index in range(1000):
+                counter.inc()
+                labeled.labels('/a"b').inc(2)
+
+        threads = [Thread(target=procedure) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        lines = registry.render().splitlines()
+        self.assertEqual(['# HELP test_total Test counter',
+                          '# TYPE test_total counter',
+                          'test_total 4000',
+                          '# HELP test_labeled_total Test counter',
+                          '# TYPE test_labeled_total counter',
+                          'test_labeled_total{route="/a\\"b"} 8000'],
+                         lines)
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge('test_in_progress', 'Test gauge')
+        registry.gauge('test_value', 'Test gauge', function=lambda: 42)
+        gauge.inc()
+        gauge.inc()
+        # may be decremented by other thread:
+        thread = Thread(target=gauge.dec)
+        thread.start()
+        thread.join()
+        lines = registry.render().splitlines()
+        self.assertIn('test_in_progress 1', lines)
+        self.assertIn('test_value 42', lines)
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('test_seconds', 'Test histogram',
+                                       [0.1, 1], ['route'])
+        child = histogram.labels('/')
+        for value in [0.05, 0.1, 0.5, 2]:
+            child.observe(value)
+        self.assertEqual(['# HELP test_seconds Test histogram',
+                          '# TYPE test_seconds histogram',
+                          'test_seconds_bucket{route="/",le="0.1"} 2',
+                          'test_seconds_bucket{route="/",le="1.0"} 3',
+                          'test_seconds_bucket{route="/",le="+Inf"} 4',
+                          'test_seconds_sum{route="/"} 2.65',
+                          'test_seconds_count{route="/"} 4'],
+                         registry.render().splitlines())
+
+    def test_transfer(self):
+        registry = MetricsRegistry()
+        uploads = TransferMetrics(registry, 'upload')
+        with uploads.start() as transfer:
+            transfer.add(100)
+            transfer.add(50)
+            self.assertIn('limbo_uploads_in_progress 1',
+                          registry.render().splitlines())
+        lines = registry.render().splitlines()
+        self.assertIn('limbo_upload_bytes_total 150', lines)
+        self.assertIn('limbo_uploads_in_progress 0', lines)
+        self.assertIn(
+            'limbo_upload_throughput_bytes_per_second_count 1', lines)
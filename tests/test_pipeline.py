@@ -0,0 +1,104 @@
+from threading import Event
+from time import sleep as time_sleep
+from unittest import TestCase
+
+from lib_pipeline import PipelinedWriter
+
+
+class MemoryWriter:
+    def __init__(self, fail_at_chunk=None, delay=0):
+        self.chunks = []
+        self.closed = False
+        self.aborted = False
+        self._fail_at_chunk = fail_at_chunk
+        self._delay = delay
+
+    def write(self, data):
+        time_sleep(self._delay)
+        if len(self.chunks) == self._fail_at_chunk:
+            raise Exception('Disk is full')
+        self.chunks.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class BlockedWriter(MemoryWriter):
+    def __init__(self):
+        super().__init__()
+        self.unblock = Event()
+
+    def write(self, data):
+        self.unblock.wait()
+        super().write(data)
+
+
+class PipelinedWriterTestCase(TestCase):
+
+    def test_write(self):
+        writer = MemoryWriter(delay=0.001)
+        pipeline = PipelinedWriter(writer, 4)
+        chunks = [bytes([i]) * 100 for i in range(50)]
+        for chunk in chunks:
+            pipeline.write(chunk)
+        pipeline.close()
+        self.assertEqual(chunks, writer.chunks)
+        self.assertTrue(writer.closed)
+        self.assertFalse(writer.aborted)
+        stats = pipeline.stats
+        self.assertEqual(5000, stats['bytes'])
+        self.assertEqual(50, stats['chunks'])
+        self.assertLessEqual(stats['max_queued_chunks'], 4)
+
+    def test_backpressure(self):
+        writer = BlockedWriter()
+        pipeline = PipelinedWriter(writer, 2)
+        # one chunk is taken by writer thread, two are queued:
+        for i in range(3):
+            pipeline.write(b'a')
+        time_sleep(0.1)
+        self.assertEqual(2, pipeline.stats['max_queued_chunks'])
+        writer.unblock.set()
+        pipeline.write(b'a')
+        pipeline.close()
+        self.assertEqual(4, len(writer.chunks))
+
+    def test_error(self):
+        writer = MemoryWriter(fail_at_chunk=3)
+        pipeline = PipelinedWriter(writer, 2)
+        with self.assertRaisesRegex(Exception, 'Disk is full'):
+            for i in range(100):
+                pipeline.write(b'a')
+                time_sleep(0.001)
+        with self.assertRaisesRegex(Exception, 'Disk is full'):
+            pipeline.close()
+        self.assertTrue(writer.aborted)
+        self.assertFalse(writer.closed)
+
+    def test_abort(self):
+        writer = MemoryWriter()
+        pipeline = PipelinedWriter(writer, 2)
+        pipeline.write(b'a')
+        pipeline.abort()
+        self.assertTrue(writer.aborted)
+        self.assertFalse(writer.closed)
+
+    def test_context_manager(self):
+        writer = MemoryWriter()
+        with PipelinedWriter(writer, 4) as pipeline:
+            pipeline.write(b'abc')
+        self.assertEqual([b'abc'], writer.chunks)
+        self.assertTrue(writer.closed)
+
+        writer = MemoryWriter(delay=0.01)
+        with self.assertRaises(ValueError):
+            with PipelinedWriter(writer, 4) as pipeline:
+                pipeline.write(b'abc')
+                raise ValueError('Request is failed')
+        # writer thread is finished before exception is propagated
+        self.assertFalse(pipeline._thread.is_alive())
+        self.assertTrue(writer.aborted)
+        self.assertFalse(writer.closed)
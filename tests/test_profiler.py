@@ -0,0 +1,67 @@
+from marshal import loads as marshal_loads
+import tracemalloc
+from unittest import TestCase
+
+from lib_profiler import ProfilingMiddleware
+
+
+class Route:
+    def __init__(self, method, rule):
+        self.method = method
+        self.rule = rule
+
+
+# WSGI application setting route like bottle does
+def app(environ, start_response):
+    environ['bottle.route'] = Route('GET', '/data/<name>')
+    # left allocated after request
+    environ['data'] = bytearray(100000)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'OK']
+
+
+def call(middleware, path, headers=None):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+    environ.update(headers or {})
+    return middleware(environ, lambda status, headers: None)
+
+
+class ProfilerTestCase(TestCase):
+
+    def test_token(self):
+        middleware = ProfilingMiddleware(app, token='secret')
+        self.assertEqual([b'OK'], call(middleware, '/data/a'))
+        call(middleware, '/data/b', {'HTTP_X_LIMBO_PROFILE': 'wrong'})
+        self.assertEqual([], middleware.get_routes())
+        call(middleware, '/data/c', {'HTTP_X_LIMBO_PROFILE': 'secret'})
+        self.assertEqual(['GET /data/<name>'], middleware.get_routes())
+        self.assertTrue(middleware.is_token_valid('secret'))
+        self.assertFalse(middleware.is_token_valid(''))
+        self.assertFalse(ProfilingMiddleware(app).is_token_valid(''))
+
+    def test_sample_rate(self):
+        # memory mode starts tracing of the whole process
+        self.addCleanup(tracemalloc.stop)
+        middleware = ProfilingMiddleware(app, sample_rate=1,
+                                         modes=['cpu', 'memory'],
+                                         skip_paths=['/skip/'])
+        call(middleware, '/skip/a')
+        self.assertEqual([], middleware.get_routes())
+        call(middleware, '/data/a')
+        call(middleware, '/data/b')
+        report = middleware.render_report()
+        self.assertIn('== GET /data/<name>: 2 requests', report)
+        self.assertIn('(app)', report)
+        self.assertIn('test_profiler.py:', report)
+
+        stats = marshal_loads(middleware.get_pstats_dump('GET /data/<name>'))
+        functions = [function for filename, line, function in stats]
+        self.assertIn('app', functions)
+        self.assertIsNone(middleware.get_pstats_dump('GET /other'))
+
+        middleware.reset()
+        self.assertEqual([], middleware.get_routes())
+
+    def test_unsupported_mode(self):
+        with self.assertRaises(Exception):
+            ProfilingMiddleware(app, modes=['gpu'])
@@ -1,13 +1,21 @@
 #!/usr/bin/python3
 
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from http.client import HTTPConnection
+from json import loads as json_loads
 from numpy import random
-from os import path as os_path, environ as os_environ
-from requests import get as requests_get, post as requests_post
+from os import listdir as os_listdir, path as os_path, \
+    environ as os_environ
+from requests import delete as requests_delete, get as requests_get, \
+    post as requests_post, put as requests_put
+from socket import create_connection as socket_create_connection, \
+    SHUT_WR as socket_SHUT_WR
 from subprocess import Popen as subprocess_Popen
 from sys import argv as sys_argv
 from tempfile import TemporaryDirectory
-from time import strftime as time_strftime
+from time import sleep, strftime as time_strftime
 from unittest import TestCase
 from urllib.parse import urlparse as urllib_urlparse
 
@@ -70,7 +78,8 @@ def wait_net_service(host, port, timeout=None):
             return True
 
 
-def run_child_server(server_name, host, port):
+# extra_env is dictionary of additional server environment variables
+def run_child_server(server_name, host, port, extra_env=None):
     script_dir = os_path.dirname(os_path.abspath(__file__))
     root_dir = os_path.join(script_dir, '..')
     server_py = os_path.join(root_dir, 'server.py')
@@ -83,6 +92,8 @@ def run_child_server(server_name, host, port):
     subenv['LIMBO_LISTEN_HOST'] = host
     subenv['LIMBO_LISTEN_PORT'] = str(port)
     subenv['LIMBO_STORAGE_DIRECTORY'] = tmpdir.name
+    if extra_env is not None:
+        subenv.update(extra_env)
 
     pid = subprocess_Popen(['python', server_py], cwd=root_dir, env=subenv)
     try:
@@ -102,6 +113,11 @@ class ServerTestCase(TestCase):
         self._text_filename_postfix = '.txt'
         self._server_name = None
         self._base_url = None
+        self._profile_token = None
+        self._storage_directory = None
+        self._max_storage_bytes = 0
+        self._hash_algorithm = ''
+        self._server_threads = 16
 
     def CheckHttpError(self, r):
         if r.status_code != 200:
@@ -149,6 +165,33 @@ class ServerTestCase(TestCase):
 
         self.CheckHttpError(r)
 
+    # Uploads file with resumable upload protocol
+    def UploadFileInChunks(self, original_filename, filedata, chunk_size):
+        url = self._base_url + '/cgi/upload/session/'
+        log('Request: POST ' + url)
+        formdata = {'fileName': original_filename, 'size': len(filedata)}
+        r = requests_post(url, data=formdata)
+        self.assertEqual(201, r.status_code)
+        url += r.json()['session_id']
+
+        # parts are uploaded concurrently in reverse order
+        def upload_part(offset):
+            log('Request: PUT ' + url + '?offset=' + str(offset))
+            r = requests_put(url, params={'offset': offset},
+                             data=filedata[offset:offset + chunk_size])
+            self.CheckHttpError(r)
+
+        offsets = reversed(range(0, len(filedata), chunk_size))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(upload_part, offsets))
+
+        log('Request: POST ' + url + '/commit')
+        formdata = {}
+        if self._hash_algorithm == 'sha256':
+            formdata['hash'] = sha256(filedata).hexdigest()
+        r = requests_post(url + '/commit', data=formdata)
+        self.CheckHttpError(r)
+
     def UploadText(self, title, text):
         url = self._base_url + '/cgi/addtext/'
         log('Request: POST ' + url)
@@ -184,6 +227,10 @@ class ServerTestCase(TestCase):
         log('File URL: ' + files[0]['url'])
         self.assertEqual(name, files[0]['display_filename'])
         self.assertEqual(len(data), files[0]['size'])
+        if self._hash_algorithm == 'sha256':
+            self.assertEqual(sha256(data).hexdigest(), files[0]['hash'])
+        else:
+            self.assertIsNone(files[0]['hash'])
         url_filename = files[0]['url_filename']
         data2 = self.DownloadFile(files[0]['url'])
         self.assertEqual(data2, data)
@@ -207,6 +254,72 @@ class ServerTestCase(TestCase):
         self.RemoveFile(url_filename)
         self.assertEqual(0, len(self.GetStoredFiles()))
 
+    def DoTestDownloadRanges(self):
+        self.OnTestStart('DownloadRanges')
+        self.RemoveAllFiles()
+        data = get_random_bytes(100000, 42)
+        self.UploadFile('file.dat', data)
+        url = self._base_url + self.GetStoredFiles()[0]['url']
+
+        log('Request: GET ' + url + ' (range)')
+        r = requests_get(url, headers={'Range': 'bytes=1000-1999'})
+        self.assertEqual(206, r.status_code)
+        self.assertEqual('bytes 1000-1999/100000',
+                         r.headers['Content-Range'])
+        self.assertEqual(data[1000:2000], r.content)
+
+        log('Request: GET ' + url + ' (multiple ranges)')
+        r = requests_get(url, headers={'Range': 'bytes=0-9,-10'})
+        self.assertEqual(206, r.status_code)
+        self.assertTrue(r.headers['Content-Type'].startswith(
+            'multipart/byteranges; boundary='))
+        self.assertIn(data[:10], r.content)
+        self.assertIn(data[-10:], r.content)
+
+        log('Request: GET ' + url + ' (unsatisfiable range)')
+        r = requests_get(url, headers={'Range': 'bytes=100000-'})
+        self.assertEqual(416, r.status_code)
+
+        log('Request: GET ' + url + ' (conditional)')
+        etag = requests_get(url).headers['ETag']
+        r = requests_get(url, headers={'If-None-Match': etag})
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(b'', r.content)
+
+        self.RemoveAllFiles()
+
+    def DoTestUploadSession(self):
+        self.OnTestStart('UploadSession')
+        self.RemoveAllFiles()
+        data = get_random_bytes(300000, 42)
+        self.UploadFileInChunks('file.dat', data, 100000)
+        files = self.GetStoredFiles()
+        self.assertEqual(1, len(files))
+        self.assertEqual(len(data), files[0]['size'])
+        self.assertEqual(data, self.DownloadFile(files[0]['url']))
+
+        url = self._base_url + '/cgi/upload/session/'
+        r = requests_post(url, data={'fileName': 'file2.dat', 'size': 10})
+        url += r.json()['session_id']
+        log('Request: PUT ' + url + ' (wrong offset)')
+        r = requests_put(url, params={'offset': 11}, data=b'abcde')
+        self.assertEqual(409, r.status_code)
+        log('Request: PUT ' + url + ' (data exceeds size)')
+        r = requests_put(url, params={'offset': 0}, data=b'x' * 12)
+        self.assertEqual(409, r.status_code)
+        r = requests_put(url, params={'offset': 5}, data=b'fghij')
+        self.CheckHttpError(r)
+        self.assertEqual(0, r.json()['offset'])
+        self.assertEqual([[5, 10]], requests_get(url).json()['ranges'])
+        log('Request: POST ' + url + '/commit (incomplete)')
+        r = requests_post(url + '/commit', data='')
+        self.assertEqual(409, r.status_code)
+        log('Request: DELETE ' + url)
+        self.CheckHttpError(requests_delete(url))
+        self.assertEqual(404, requests_get(url).status_code)
+
+        self.RemoveAllFiles()
+
     def DoTestFewFiles(self):
         self.OnTestStart('FewFiles')
         self.RemoveAllFiles()
@@ -230,6 +343,234 @@ class ServerTestCase(TestCase):
         self.RemoveAllFiles()
         self.assertEqual(0, len(self.GetStoredFiles()))
 
+    def DoTestEnumerate(self):
+        self.OnTestStart('Enumerate')
+        self.RemoveAllFiles()
+        for name in ['file1.txt', 'file2.txt', 'file3.txt']:
+            self.UploadFile(name, b'abc')
+        url = self._base_url + '/cgi/enumerate/'
+
+        # pages:
+        r = requests_get(url, params={'limit': 2})
+        self.CheckHttpError(r)
+        page1 = r.json()
+        self.assertEqual(2, len(page1['files']))
+        r = requests_get(url, params={'limit': 2,
+                                      'cursor': page1['next_cursor']})
+        self.CheckHttpError(r)
+        page2 = r.json()
+        self.assertEqual(1, len(page2['files']))
+        self.assertIsNone(page2['next_cursor'])
+        self.assertEqual(['file1.txt', 'file2.txt', 'file3.txt'],
+                         sorted(item['url_filename'] for item
+                                in page1['files'] + page2['files']))
+
+        # unchanged listing is not sent again:
+        r = requests_get(url)
+        self.CheckHttpError(r)
+        self.assertEqual(3, len(r.json()))
+        r = requests_get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(304, r.status_code)
+
+        # changes since previous listing:
+        self.UploadFile('file4.txt', b'abcd')
+        self.RemoveFile('file1.txt')
+        r = requests_get(url, params={'since': page2['version']})
+        self.CheckHttpError(r)
+        delta = r.json()
+        self.assertFalse(delta['reset'])
+        self.assertEqual(['file4.txt'],
+                         [item['url_filename'] for item in delta['files']])
+        self.assertEqual(['file1.txt'], delta['removed'])
+
+        # unknown version: full listing
+        r = requests_get(url, params={'since': 'unknown:0'})
+        self.CheckHttpError(r)
+        delta = r.json()
+        self.assertTrue(delta['reset'])
+        self.assertEqual(3, len(delta['files']))
+        self.RemoveAllFiles()
+
+    # Returns fields of the first 'changes' event of /cgi/events/
+    def GetListingEvent(self, headers=None):
+        url = self._base_url + '/cgi/events/'
+        log('Request: GET ' + url)
+        r = requests_get(url, headers=headers, stream=True, timeout=30)
+        self.CheckHttpError(r)
+        self.assertTrue(
+            r.headers['Content-Type'].startswith('text/event-stream'))
+        event = {}
+        try:
+            # asyncio server doesn't close event stream
+            for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+                if not line and 'data' in event:
+                    break
+                name, _, value = line.partition(': ')
+                event[name] = value
+        finally:
+            r.close()
+        return event
+
+    def DoTestEvents(self):
+        self.OnTestStart('Events')
+        self.RemoveAllFiles()
+        self.UploadFile('file1.txt', b'abc')
+        event = self.GetListingEvent()
+        self.assertEqual('changes', event['event'])
+        changes = json_loads(event['data'])
+        self.assertTrue(changes['reset'])
+        self.assertEqual(['file1.txt'], [item['url_filename']
+                                         for item in changes['files']])
+
+        self.UploadFile('file2.txt', b'abc')
+        self.RemoveFile('file1.txt')
+        event = self.GetListingEvent({'Last-Event-ID': event['id']})
+        changes = json_loads(event['data'])
+        self.assertFalse(changes['reset'])
+        self.assertEqual(['file2.txt'], [item['url_filename']
+                                         for item in changes['files']])
+        self.assertEqual(['file1.txt'], changes['removed'])
+        self.RemoveAllFiles()
+
+    def DoTestListPage(self):
+        self.OnTestStart('ListPage')
+        self.UploadFile('file1.txt', b'abc')
+        url = self._base_url + '/list/'
+        log('Request: GET ' + url)
+        r = requests_get(url)
+        self.CheckHttpError(r)
+        self.assertIn('listViewport', r.text)
+        # page shell doesn't depend on stored files:
+        self.assertNotIn('file1.txt', r.text)
+        r = requests_get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(304, r.status_code)
+        self.RemoveAllFiles()
+
+    def DoTestMetrics(self):
+        self.OnTestStart('Metrics')
+        self.RemoveAllFiles()
+        self.UploadFile('file1.txt', b'abc')
+        url = self._base_url + '/cgi/metrics'
+        log('Request: GET ' + url)
+        r = requests_get(url)
+        self.CheckHttpError(r)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        lines = r.text.splitlines()
+        # values of other metrics depend on worker process answered
+        self.assertIn('limbo_stored_files 1', lines)
+        self.assertIn('limbo_stored_bytes 3', lines)
+        self.assertIn('# TYPE limbo_http_request_duration_seconds histogram',
+                      lines)
+        self.assertIn('# TYPE limbo_upload_bytes_total counter', lines)
+        self.RemoveAllFiles()
+
+    # Sends POST request with multipart body by raw socket. Unlike
+    # requests library it allows broken requests. Returns response
+    # received until connection is closed by server.
+    def SendRawUpload(self, headers, body, shutdown):
+        url = urllib_urlparse(self._base_url + '/cgi/upload/')
+        log('Request: POST ' + url.geturl() + ' (raw)')
+        head = 'POST ' + url.path + ' HTTP/1.1\r\n' + \
+            'Host: ' + url.netloc + '\r\n' + \
+            'Content-Type: multipart/form-data; boundary=' + \
+            'Ab522e64be24449aa3131245da23b3yZ\r\n'
+        for name, value in headers:
+            head += name + ': ' + value + '\r\n'
+        head += 'Connection: close\r\n\r\n'
+        with socket_create_connection((url.hostname, url.port), 10) as s:
+            s.sendall(head.encode('latin-1') + body)
+            if shutdown:
+                s.shutdown(socket_SHUT_WR)
+            response = b''
+            while True:
+                data = s.recv(65536)
+                if not data:
+                    break
+                response += data
+        return response
+
+    def DoTestTruncatedUpload(self):
+        self.OnTestStart('TruncatedUpload')
+        self.RemoveAllFiles()
+        boundary = b'Ab522e64be24449aa3131245da23b3yZ'
+        payload = b'--' + boundary + b'\r\nContent-Disposition: form-data' \
+            + b'; name="file"; filename="truncated.dat"\r\n\r\n' \
+            + get_random_bytes(300000, 42) + b'\r\n--' + boundary + b'--\r\n'
+        response = self.SendRawUpload(
+            [('Content-Length', str(len(payload)))],
+            payload[:len(payload) // 2], True)
+        # some third-party servers close connection without response
+        if response or self._server_name in ['asyncio', 'threaded']:
+            self.assertIn(b' 400 ', response.split(b'\r\n')[0])
+        self.assertEqual(0, len(self.GetStoredFiles()))
+        if self._storage_directory is not None:
+            # temp file may be removed after connection is closed
+            temp_directory = os_path.join(self._storage_directory,
+                                          'incomplete')
+            for attempt in range(50):
+                if not os_listdir(temp_directory):
+                    break
+                sleep(0.1)
+            self.assertEqual([], os_listdir(temp_directory))
+
+    # Upload larger than storage quota is rejected before its body is sent
+    def DoTestExpectContinue(self):
+        self.OnTestStart('ExpectContinue')
+        if self._server_name != 'asyncio' or self._max_storage_bytes == 0:
+            return
+        response = self.SendRawUpload(
+            [('Content-Length', str(self._max_storage_bytes + 1)),
+             ('Expect', '100-continue')], b'', False)
+        self.assertTrue(response.startswith(b'HTTP/1.1 507 '))
+        self.assertNotIn(b'100 Continue', response)
+
+    # Persistent connections of pages polling events don't hold all worker
+    # threads of threaded server
+    def DoTestIdleConnections(self):
+        self.OnTestStart('IdleConnections')
+        if self._server_name != 'threaded':
+            return
+        url = urllib_urlparse(self._base_url)
+        connections = []
+        try:
+            for index in range(self._server_threads):
+                connection = HTTPConnection(url.hostname, url.port, timeout=10)
+                connections.append(connection)
+                connection.request('GET', '/cgi/events/')
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(200, response.status)
+                self.assertNotEqual('close', response.getheader('Connection'))
+            # idle timeout is 5 seconds
+            url = self._base_url + '/cgi/enumerate/'
+            log('Request: GET ' + url)
+            r = requests_get(url, timeout=3)
+            self.CheckHttpError(r)
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def DoTestProfile(self):
+        self.OnTestStart('Profile')
+        url = self._base_url + '/cgi/profile/'
+        log('Request: GET ' + url)
+        r = requests_get(url)
+        self.assertEqual(404, r.status_code)
+        if self._profile_token is None:
+            return
+        headers = {'X-Limbo-Profile': self._profile_token}
+        requests_get(self._base_url + '/cgi/enumerate/', headers=headers)
+        r = requests_get(url, headers=headers)
+        self.CheckHttpError(r)
+        self.assertIn('== GET /cgi/enumerate/: 1 requests', r.text)
+        self.assertIn('(cgi_enumerate)', r.text)
+        r = requests_get(url, params={'format': 'pstats',
+                                      'route': 'GET /cgi/enumerate/'},
+                         headers=headers)
+        self.CheckHttpError(r)
+        r = requests_post(url + 'reset/', headers=headers)
+        self.CheckHttpError(r)
+
     def DoAllTests(self, server_name, base_url):
         self._server_name = server_name
         self._base_url = base_url.rstrip('/')
@@ -257,27 +598,56 @@ class ServerTestCase(TestCase):
         if self._server_name != 'paste':
             self.DoTestUploadFile(filename, b'some text')
 
+        self.DoTestDownloadRanges()
+        self.DoTestUploadSession()
         self.DoTestFewFiles()
+        self.DoTestEnumerate()
+        self.DoTestEvents()
+        self.DoTestListPage()
+        self.DoTestMetrics()
+        self.DoTestTruncatedUpload()
+        self.DoTestExpectContinue()
+        self.DoTestIdleConnections()
+        self.DoTestProfile()
 
         self.RemoveAllFiles()
         self.assertEqual(0, len(self.GetStoredFiles()))
 
-    def RunServerAndDoAllTests(self, server_name):
+    def RunServerAndDoAllTests(self, server_name, extra_env=None):
         global DEFAULT_LISTEN_HOST, DEFAULT_LISTEN_PORT
         host = DEFAULT_LISTEN_HOST
         port = DEFAULT_LISTEN_PORT
         base_url = 'http://' + host + ':' + str(port)
         log('RunServerAndDoAllTests("' + server_name + '") start')
-        tmpdir, pid = run_child_server(server_name, host, port)
+        self._profile_token = (extra_env or {}).get('LIMBO_PROFILE_TOKEN')
+        self._max_storage_bytes = int((extra_env or {}).get(
+            'LIMBO_MAX_STORAGE_BYTES', '0'))
+        self._hash_algorithm = (extra_env or {}).get('LIMBO_HASH_ALGORITHM',
+                                                     '')
+        self._server_threads = int((extra_env or {}).get(
+            'LIMBO_SERVER_THREADS', '16'))
+        tmpdir, pid = run_child_server(server_name, host, port, extra_env)
+        self._storage_directory = tmpdir.name
 
         with tmpdir:
             try:
                 self.DoAllTests(server_name, base_url)
             finally:
                 pid.terminate()
+                # next test uses the same port
+                pid.wait()
 
         log('RunServerAndDoAllTests("' + self._server_name + '") finished')
 
+    def test_asyncio(self):
+        self.RunServerAndDoAllTests('asyncio',
+                                    {'LIMBO_MAX_STORAGE_BYTES': '100000000',
+                                     'LIMBO_HASH_ALGORITHM': 'sha256'})
+
+    def test_asyncio_prefork(self):
+        self.RunServerAndDoAllTests('asyncio',
+                                    {'LIMBO_WORKER_PROCESSES': '4'})
+
     def test_cherrypy(self): self.RunServerAndDoAllTests('cherrypy')
 
     # def test_flup(self): self.RunServerAndDoAllTests('flup')
@@ -293,9 +663,26 @@ class ServerTestCase(TestCase):
 
     def test_twisted(self): self.RunServerAndDoAllTests('twisted')
 
+    def test_threaded(self):
+        self.RunServerAndDoAllTests('threaded',
+                                    {'LIMBO_HASH_ALGORITHM': 'sha256'})
+
+    def test_threaded_profiling(self):
+        self.RunServerAndDoAllTests('threaded',
+                                    {'LIMBO_PROFILE_TOKEN': 'test-token',
+                                     'LIMBO_PROFILE_MODES': 'cpu,memory'})
+
+    def test_threaded_prefork(self):
+        self.RunServerAndDoAllTests('threaded',
+                                    {'LIMBO_WORKER_PROCESSES': '4'})
+
     def test_waitress(self): self.RunServerAndDoAllTests('waitress')
 
-    # def test_wsgiref(self): self.RunServerAndDoAllTests('wsgiref')
+    def test_upload_pipeline(self):
+        self.RunServerAndDoAllTests('waitress',
+                                    {'LIMBO_UPLOAD_PIPELINE_CHUNKS': '4'})
+
+    def test_wsgiref(self): self.RunServerAndDoAllTests('wsgiref')
 
 
 if __name__ == '__main__':
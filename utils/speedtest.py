@@ -3,11 +3,13 @@
 from datetime import datetime
 from numpy import random
 from os import path as os_path, environ as os_environ
-from requests import get as requests_get, post as requests_post
+from requests import get as requests_get, post as requests_post, \
+    put as requests_put
+from requests.exceptions import ConnectionError
 from subprocess import Popen as subprocess_Popen
 from sys import argv as sys_argv
 from tempfile import TemporaryDirectory
-from time import strftime as time_strftime
+from time import sleep as time_sleep, strftime as time_strftime
 
 LISTEN_HOST = '127.0.0.1'
 LISTEN_PORT = 35080
@@ -24,8 +26,11 @@ def get_random_bytes(size, seed):
 
 class SpeedTest:
 
-    def __init__(self):
+    # mode is 'multipart' (/cgi/upload/) or 'session' (resumable upload
+    # session with raw request body)
+    def __init__(self, mode='multipart'):
         self._base_url = None
+        self._mode = mode
 
     def RunServer(self, server_name, port):
         script_dir = os_path.dirname(os_path.abspath(__file__))
@@ -40,8 +45,9 @@ class SpeedTest:
         subenv['LIMBO_LISTEN_HOST'] = LISTEN_HOST
         subenv['LIMBO_LISTEN_PORT'] = str(port)
         subenv['LIMBO_STORAGE_DIRECTORY'] = tmpdirname.name
-        # don't waste time for saving files:
-        subenv['LIMBO_DISABLE_STORAGE'] = '1'
+        # don't waste time for saving files
+        # (set LIMBO_DISABLE_STORAGE=0 to measure storage settings):
+        subenv.setdefault('LIMBO_DISABLE_STORAGE', '1')
 
         pid = subprocess_Popen(['python', server_py], cwd=root_dir, env=subenv)
         return [tmpdirname, pid]
@@ -59,6 +65,14 @@ class SpeedTest:
         files = sorted(files, key=lambda item: item['display_filename'])
         return files
 
+    def WaitServer(self, timeout_seconds):
+        for attempt in range(timeout_seconds * 10):
+            try:
+                return self.GetStoredFiles()
+            except ConnectionError:
+                time_sleep(0.1)
+        return self.GetStoredFiles()
+
     def UploadFile(self, original_filename, filedata):
         url = self._base_url + '/cgi/upload/'
         log('Request: POST ' + url)
@@ -85,6 +99,18 @@ class SpeedTest:
 
         self.CheckHttpError(r)
 
+    def UploadFileRaw(self, original_filename, filedata):
+        url = self._base_url + '/cgi/upload/session/'
+        log('Request: POST ' + url)
+        formdata = {'fileName': original_filename, 'size': len(filedata)}
+        r = requests_post(url, data=formdata)
+        if r.status_code != 201:
+            raise Exception('Bad server reply code: ' + str(r.status_code))
+        url += r.json()['session_id']
+        log('Request: PUT ' + url)
+        r = requests_put(url, params={'offset': 0}, data=filedata)
+        self.CheckHttpError(r)
+
     def DoAllTests(self, server_name):
         global LISTEN_PORT
         port = LISTEN_PORT
@@ -95,13 +121,16 @@ class SpeedTest:
 
         with tmpdirname:
             try:
-                self.GetStoredFiles()
+                self.WaitServer(10)
 
                 data = get_random_bytes(800123123, 42)
 
                 log('===============================================')
                 time1 = datetime.now()
-                self.UploadFile('some_file.dat', data)
+                if self._mode == 'session':
+                    self.UploadFileRaw('some_file.dat', data)
+                else:
+                    self.UploadFile('some_file.dat', data)
                 time2 = datetime.now()
                 log('===============================================')
                 MB = 1024 * 1024
@@ -120,7 +149,10 @@ class SpeedTest:
 
 
 if __name__ == '__main__':
+    # LIMBO_UPLOAD_* environment variables are passed to server
+    # to compare upload settings
     server_name = sys_argv[1] if len(sys_argv) > 1 else 'cherrypy'
-    log('Speed testing ' + server_name + '...')
-    test = SpeedTest()
+    mode = sys_argv[2] if len(sys_argv) > 2 else 'multipart'
+    log('Speed testing ' + server_name + ' (' + mode + ')...')
+    test = SpeedTest(mode)
     test.DoAllTests(server_name)